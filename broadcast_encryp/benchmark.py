@@ -0,0 +1,376 @@
+"""Headless, reproducible benchmark of the broadcast server.
+
+Runs a matrix of configurations on one Linux (or any) machine with no video
+files and no network access. For every combination of stream count,
+resolution, codec, pattern, decryption on/off and render worker count it
+starts ``broadcast.py`` and one multi-source ``stream.py`` publishing
+synthetic frames (``capture.SyntheticSource``), watches each stream with a
+headless viewer, and after a warm-up measures for a fixed window:
+
+- delivered fps and capture-to-viewer latency percentiles,
+- CPU and RSS of the server and of the publisher, child processes included,
+- the server's own per-stage timings and drops, scraped from ``/metrics``.
+
+Results are written as one JSON file (or Parquet, if pandas is installed)
+tagged with the run's metadata, so runs before and after a change compare
+directly:
+
+    python benchmark.py --streams 1,4 --resolutions 640x360,1280x720 --codecs jpeg,tiles \\
+        --decrypt on,off --workers 4,16 --duration 20 --tag baseline
+
+This replaces ``run.py``, which needed Windows paths and downloaded videos,
+slept fixed amounts, and only logged process CPU and memory to a CSV.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import platform
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime, timezone
+
+import psutil
+import socketio
+
+from capture import SYNTHETIC_PATTERNS, SYNTHETIC_PREFIX
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+NAMESPACE = "/video"
+
+STARTUP_TIMEOUT = 60.0  # Seconds for the server to answer and every stream to be listed
+SAMPLE_INTERVAL = 0.5  # Seconds between CPU/RSS samples
+
+METRIC_LINE = re.compile(r'^(\w+)\{([^}]*)\} (\S+)$')
+METRIC_LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def csv_list(kind=str):
+    return lambda value: [kind(item) for item in value.split(",") if item]
+
+
+parser = argparse.ArgumentParser(description="Benchmark the broadcast server over a matrix of configurations")
+parser.add_argument("--streams", type=csv_list(int), default=[1, 4], help="Stream counts, e.g. 1,4,16")
+parser.add_argument("--resolutions", type=csv_list(), default=["640x360", "1280x720"],
+                    help="Publisher frame sizes, e.g. 640x360,1920x1080")
+parser.add_argument("--codecs", type=csv_list(), default=["jpeg"], help="Publisher codecs: jpeg,tiles")
+parser.add_argument("--patterns", type=csv_list(), default=["moving"],
+                    help=f"Synthetic patterns: {','.join(SYNTHETIC_PATTERNS)}")
+parser.add_argument("--decrypt", type=csv_list(), default=["on"], help="Server-side decryption: on,off")
+parser.add_argument("--workers", type=csv_list(int), default=[16], help="Server render worker counts")
+parser.add_argument("--server", choices=["threading", "asgi"], default="threading", help="Server mode to benchmark")
+parser.add_argument("--rendition", type=str, default="360p", help="Rendition every viewer watches")
+parser.add_argument("--warmup", type=float, default=5.0, help="Seconds to run before measuring")
+parser.add_argument("--duration", type=float, default=20.0, help="Seconds measured per configuration")
+parser.add_argument("--tag", type=str, default="untagged", help="Label stored with the results, e.g. a branch name")
+parser.add_argument("--output", type=str, default=None,
+                    help="Results file, .json or .parquet (default: benchmark_<tag>_<time>.json)")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=HERE, capture_output=True, text=True,
+                              timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers, or None if it is empty."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+
+def fetch(url, timeout=5.0):
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return response.read().decode("utf-8")
+
+
+def scrape_stages(url):
+    """Per-stage ``(sum, count)`` of the server's stage histogram, and its total drops, from /metrics."""
+    stages, dropped = {}, 0.0
+    for line in fetch(f"{url}/metrics").splitlines():
+        match = METRIC_LINE.match(line)
+        if match is None:
+            continue
+        name, labels, value = match.group(1), dict(METRIC_LABEL.findall(match.group(2))), float(match.group(3))
+        if name == "broadcast_stage_seconds_sum":
+            stages.setdefault(labels["stage"], [0.0, 0.0])[0] += value
+        elif name == "broadcast_stage_seconds_count":
+            stages.setdefault(labels["stage"], [0.0, 0.0])[1] += value
+        elif name == "broadcast_frames_dropped_total":
+            dropped += value
+    return stages, dropped
+
+
+class Viewer:
+    """A headless page: watches one stream at a fixed rendition and counts what arrives."""
+
+    def __init__(self, url, stream_id, rendition, decrypt):
+        self.url = url
+        self.stream_id = stream_id
+        self.rendition = rendition
+        self.decrypt = decrypt
+        self.listed = asyncio.Event()
+        self.measuring = False
+        self.frames = 0
+        self.bytes = 0
+        self.latencies = []
+        self.sio = socketio.AsyncClient()
+        self.sio.on("stream_list_update", self.on_stream_list, namespace=NAMESPACE)
+        self.sio.on("broadcast_frame", self.on_frame, namespace=NAMESPACE)
+        self.sio.on("broadcast_frames", self.on_frames, namespace=NAMESPACE)
+
+    async def start(self):
+        await self.sio.connect(self.url, namespaces=[NAMESPACE])
+        await self.sio.emit("get_stream_list", namespace=NAMESPACE)
+        await asyncio.wait_for(self.listed.wait(), STARTUP_TIMEOUT)
+        await self.sio.emit("select_stream", {"stream_id": self.stream_id, "rendition": self.rendition},
+                            namespace=NAMESPACE)
+        if not self.decrypt:
+            await self.sio.emit("toggle_decryption", {"stream_id": self.stream_id}, namespace=NAMESPACE)
+
+    async def on_stream_list(self, streams):
+        if self.stream_id in streams:
+            self.listed.set()
+
+    async def on_frame(self, data):
+        if not self.measuring or data["stream_id"] != self.stream_id or data["rendition"] != self.rendition:
+            return
+        self.frames += 1
+        self.bytes += len(data["frame"])
+        if data.get("captured_at"):
+            self.latencies.append(time.time() - data["captured_at"])  # Same host, same clock
+
+    async def on_frames(self, batch):
+        for data in batch["frames"]:
+            await self.on_frame(data)
+
+    async def stop(self):
+        if self.sio.connected:
+            await self.sio.disconnect()
+
+
+class ResourceSampler:
+    """CPU and RSS of a process tree, sampled at a fixed interval."""
+
+    def __init__(self, pid):
+        self.root = psutil.Process(pid)
+        self.processes = {}  # pid -> psutil.Process whose cpu_percent counter is primed
+        self.cpu = []
+        self.rss = []
+
+    def sample(self):
+        try:
+            tree = [self.root] + self.root.children(recursive=True)
+        except psutil.NoSuchProcess:
+            return
+        cpu = rss = 0.0
+        for process in tree:
+            known = self.processes.get(process.pid)
+            try:
+                if known is None:
+                    process.cpu_percent(None)  # The first call only primes the counter
+                    self.processes[process.pid] = known = process
+                else:
+                    cpu += known.cpu_percent(None)
+                rss += known.memory_info().rss
+            except psutil.NoSuchProcess:
+                self.processes.pop(process.pid, None)
+        self.cpu.append(cpu)
+        self.rss.append(rss / 1024 ** 2)
+
+    def summary(self):
+        cpu = self.cpu[1:] or self.cpu  # The first sample only primes the counters
+        return {
+            "cpu_percent_mean": sum(cpu) / len(cpu) if cpu else None,
+            "cpu_percent_max": max(cpu) if cpu else None,
+            "rss_mb_max": max(self.rss) if self.rss else None,
+        }
+
+
+async def wait_for_server(url, process):
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    loop = asyncio.get_running_loop()
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"broadcast.py exited with status {process.returncode}")
+        try:
+            await loop.run_in_executor(None, fetch, url, 1.0)
+            return
+        except (urllib.error.URLError, OSError):
+            await asyncio.sleep(0.2)
+    raise RuntimeError("broadcast.py did not start answering in time")
+
+
+def stop_process(process):
+    if process is not None and process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def read_log(log):
+    log.seek(0)
+    return log.read().decode("utf-8", "replace")[-2000:]
+
+
+async def run_config(config, args):
+    """Run one configuration and return its measurements."""
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    names = [f"bench-{index}" for index in range(config["streams"])]
+    loop = asyncio.get_running_loop()
+    server = publisher = None
+    viewers = []
+    with tempfile.TemporaryFile() as server_log, tempfile.TemporaryFile() as publisher_log:
+        try:
+            server = subprocess.Popen(
+                [sys.executable, "broadcast.py", "--host", "127.0.0.1", "--port", str(port),
+                 "--server", args.server, "--workers", str(config["workers"])],
+                cwd=HERE, stdout=subprocess.DEVNULL, stderr=server_log,
+            )
+            await wait_for_server(url, server)
+
+            command = [sys.executable, "stream.py", "--server-url", url, "--frame-size", config["resolution"],
+                       "--codec", config["codec"]]
+            for name in names:
+                command += ["--stream-name", name, "--source", f"{SYNTHETIC_PREFIX}{config['pattern']}"]
+            publisher = subprocess.Popen(command, cwd=HERE, stdout=subprocess.DEVNULL, stderr=publisher_log)
+
+            viewers = [Viewer(url, name, args.rendition, config["decrypt"]) for name in names]
+            await asyncio.gather(*(viewer.start() for viewer in viewers))
+            await asyncio.sleep(args.warmup)
+
+            stages_before, dropped_before = await loop.run_in_executor(None, scrape_stages, url)
+            samplers = {"server": ResourceSampler(server.pid), "publisher": ResourceSampler(publisher.pid)}
+            for viewer in viewers:
+                viewer.measuring = True
+            started = time.monotonic()
+            while time.monotonic() - started < args.duration:
+                for sampler in samplers.values():
+                    sampler.sample()
+                await asyncio.sleep(SAMPLE_INTERVAL)
+            elapsed = time.monotonic() - started
+            for viewer in viewers:
+                viewer.measuring = False
+            stages_after, dropped_after = await loop.run_in_executor(None, scrape_stages, url)
+
+            for process, name in ((server, "broadcast.py"), (publisher, "stream.py")):
+                if process.poll() is not None:
+                    raise RuntimeError(f"{name} exited during the run")
+        except Exception as e:
+            logs = {"server_log": read_log(server_log), "publisher_log": read_log(publisher_log)}
+            return {"config": config, "error": f"{type(e).__name__}: {e}", **logs}
+        finally:
+            for viewer in viewers:
+                await viewer.stop()
+            stop_process(publisher)
+            stop_process(server)
+
+    fps = {viewer.stream_id: viewer.frames / elapsed for viewer in viewers}
+    latencies = [latency for viewer in viewers for latency in viewer.latencies]
+    stages = {}
+    for stage, (total, count) in stages_after.items():
+        before_total, before_count = stages_before.get(stage, (0.0, 0.0))
+        if count > before_count:
+            stages[stage] = 1000 * (total - before_total) / (count - before_count)
+    return {
+        "config": config,
+        "error": None,
+        "seconds": elapsed,
+        "fps_mean": sum(fps.values()) / len(fps),
+        "fps_min": min(fps.values()),
+        "fps_per_stream": fps,
+        "latency_ms": {
+            "p50": 1000 * percentile(latencies, 0.50) if latencies else None,
+            "p90": 1000 * percentile(latencies, 0.90) if latencies else None,
+            "p99": 1000 * percentile(latencies, 0.99) if latencies else None,
+            "samples": len(latencies),
+        },
+        "viewer_mbit_per_second": 8 * sum(viewer.bytes for viewer in viewers) / elapsed / 1e6,
+        "server": samplers["server"].summary(),
+        "publisher": samplers["publisher"].summary(),
+        "server_stage_ms": stages,
+        "server_dropped": dropped_after - dropped_before,
+    }
+
+
+def matrix(args):
+    for streams, resolution, codec, pattern, decrypt, workers in itertools.product(
+            args.streams, args.resolutions, args.codecs, args.patterns, args.decrypt, args.workers):
+        yield {
+            "streams": streams,
+            "resolution": resolution,
+            "codec": codec,
+            "pattern": pattern,
+            "decrypt": decrypt == "on",
+            "workers": workers,
+        }
+
+
+def write_results(results, path):
+    if path.endswith(".parquet"):
+        import pandas  # Only needed for Parquet output
+        rows = pandas.json_normalize([{**run, "metadata": results["metadata"]} for run in results["runs"]])
+        rows.to_parquet(path)
+    else:
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+async def main(args):
+    started_at = datetime.now(timezone.utc)
+    metadata = {
+        "tag": args.tag,
+        "started_at": started_at.isoformat(),
+        "git_commit": git_commit(),
+        "host": platform.node(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpu_count": psutil.cpu_count(),
+        "memory_gb": psutil.virtual_memory().total / 1024 ** 3,
+        "server": args.server,
+        "rendition": args.rendition,
+        "warmup": args.warmup,
+        "duration": args.duration,
+        "argv": sys.argv[1:],
+    }
+    configs = list(matrix(args))
+    runs = []
+    for index, config in enumerate(configs, start=1):
+        print(f"[{index}/{len(configs)}] {config}", flush=True)
+        result = await run_config(config, args)
+        if result["error"]:
+            print(f"    failed: {result['error']}", flush=True)
+        else:
+            print(f"    {result['fps_mean']:.1f} fps, p50 latency {result['latency_ms']['p50']} ms, "
+                  f"server CPU {result['server']['cpu_percent_mean']:.0f}%", flush=True)
+        runs.append(result)
+    metadata["finished_at"] = datetime.now(timezone.utc).isoformat()
+
+    output = args.output or f"benchmark_{args.tag}_{started_at.strftime('%Y%m%d-%H%M%S')}.json"
+    write_results({"metadata": metadata, "runs": runs}, output)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parser.parse_args()))
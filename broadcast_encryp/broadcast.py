@@ -1,210 +1,182 @@
 ﻿import threading
-import queue
 import logging
-import base64
-import pickle
-from flask import Flask, render_template, request
+import argparse
+import os
+import sys
+from flask import Flask, Response, render_template, request
 from flask_socketio import SocketIO
-from quantcrypt.kem import Kyber
-from Crypto.Cipher import ChaCha20_Poly1305
-import numpy as np
-import cv2
-from concurrent.futures import ThreadPoolExecutor
+from frame_buffer import POLICIES, DROP_OLDEST
+from relay import NAMESPACE, RELAY_MODES, create_relay
+from renditions import DEFAULT_LADDER
+import cluster
+import profiler
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from crypto_common import suites
 
-executor = ThreadPoolExecutor(max_workers=16)  # Adjust based on CPU cores
 # Configure logging
 logging.basicConfig(level=logging.CRITICAL, format="%(asctime)s - %(levelname)s - %(message)s")
 logging.getLogger().setLevel(logging.CRITICAL)
 
+parser = argparse.ArgumentParser(description="Relay encrypted video streams to browser viewers")
+parser.add_argument("--server", choices=["threading", "asgi"], default="threading",
+                    help="Flask-SocketIO threading server, or asyncio Socket.IO under uvicorn")
+parser.add_argument("--host", type=str, default="0.0.0.0")
+parser.add_argument("--port", type=int, default=5000)
+parser.add_argument("--queue-size", type=int, default=8, help="Frames buffered per stream before dropping")
+parser.add_argument("--drop-policy", choices=POLICIES, default=DROP_OLDEST, help="Which frame to drop when a stream's buffer is full")
+parser.add_argument("--workers", type=int, default=16, help="Render workers shared by all streams")  # Adjust based on CPU cores
+parser.add_argument("--inflight", type=int, default=4, help="Frames decrypted/decoded concurrently per stream")
+parser.add_argument("--render-pool", choices=["thread", "process"], default="thread",
+                    help="Run decrypt/decode/resize/encode in threads or in worker processes")
+parser.add_argument("--relay-mode", choices=RELAY_MODES, default="passthrough",
+                    help="passthrough: forward JPEGs already at 640x360 without decoding them; transcode: always re-encode")
+parser.add_argument("--renditions", type=str, default=DEFAULT_LADDER,
+                    help="Rendition ladder viewers choose from, as name=WIDTHxHEIGHT@QUALITY,...")
+parser.add_argument("--batch-ms", type=float, default=0.0,
+                    help="Send viewers their frames in one broadcast_frames message every this many ms (0: one message per frame)")
+parser.add_argument("--cluster", type=int, default=1, help="Run this many worker processes behind a shared broker")
+parser.add_argument("--backend", type=str, default="local",
+                    help="State backend: local, or a broker address (unix:/path, tcp:host:port, pipe:name)")
+parser.add_argument("--public-host", type=str, default="localhost", help="Host name publishers use to reach workers")
+parser.add_argument("--key-ttl", type=float, default=3600.0, help="Seconds a stream key stays cached for resumption")
+parser.add_argument("--key-grace", type=float, default=10.0, help="Seconds an old key stays valid after a rekey")
+parser.add_argument("--rekey-interval", type=float, default=300.0, help="Ask publishers to rekey after this many seconds (0 to disable)")
+parser.add_argument("--aead", choices=suites.AEAD_CHOICES, default="auto",
+                    help="Frame cipher to prefer when publishers offer several; auto benchmarks them at startup")
+parser.add_argument("--record-dir", type=str, default=None,
+                    help="Record every stream, still encrypted, under this directory for replay (off by default)")
+parser.add_argument("--record-key-file", type=str, default=None,
+                    help="Key sealing the recordings' frame keys, created if missing; required with --record-dir and kept outside it")
+parser.add_argument("--record-segment-mb", type=float, default=64.0, help="Size of each preallocated recording segment")
+parser.add_argument("--record-segments", type=int, default=16, help="Recording segments kept per stream; older ones are deleted")
+parser.add_argument("--profile-token", type=str, default=None,
+                    help="Token /profile requests must send in X-Profile-Token (without one, /profile only serves localhost)")
+parser.add_argument("--worker-index", type=int, default=None, help=argparse.SUPPRESS)  # Set by the cluster launcher
+# Only read the command line when run as a script, so the module can be imported
+args = parser.parse_args(None if __name__ == "__main__" else [])
+if args.record_dir:
+    # The key must not sit next to the recordings it protects
+    if not args.record_key_file:
+        parser.error("--record-dir needs --record-key-file")
+    record_dir = os.path.join(os.path.realpath(args.record_dir), "")
+    if os.path.realpath(args.record_key_file).startswith(record_dir):
+        parser.error("--record-key-file must be outside --record-dir")
+
 app = Flask(__name__)
 socketio = SocketIO(app, cors_allowed_origins="*", engineio_logger=False, max_http_buffer_size=50 * 1024 * 1024, async_mode="threading")
 
-kyber = Kyber()
-shared_secrets = {}
-stream_list = []
-frame_queues = {}
-client_streams = {}
 
-# Global toggle for decryption
-decrypt_enabled = True
+class FlaskTransport:
+    """Relay transport for the Flask-SocketIO threading server: one thread per stream."""
+
+    def emit(self, event, data, to=None):
+        socketio.emit(event, data, namespace=NAMESPACE, to=to)
+
+    def enter_room(self, sid, room):
+        socketio.server.enter_room(sid, room, namespace=NAMESPACE)
+
+    def leave_room(self, sid, room):
+        socketio.server.leave_room(sid, room, namespace=NAMESPACE)
+
+    def start_stream(self, relay, stream_id):
+        threading.Thread(target=relay.process_frames, args=(stream_id,), daemon=True).start()
+
+
+launching_cluster = args.cluster > 1 and args.worker_index is None
+relay = None if args.server == "asgi" or launching_cluster else create_relay(FlaskTransport(), args)
 
 @app.route("/")
 def index():
     logging.info("Serving index.html")
     return render_template("index.html")
 
+@app.route("/metrics")
+def metrics():
+    # Prometheus text exposition format
+    return Response(relay.metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/profile")
+def profile():
+    # Samples every thread for ?seconds=, returned as ?mode=collapsed|pstats|text
+    if not profiler.authorized(request.remote_addr, request.headers.get("X-Profile-Token"), args.profile_token):
+        return Response("Forbidden\n", status=403, mimetype="text/plain")
+    try:
+        content_type, body = profiler.profile(float(request.args.get("seconds", profiler.DEFAULT_SECONDS)),
+                                              request.args.get("mode", "collapsed"),
+                                              float(request.args.get("interval", profiler.DEFAULT_INTERVAL)))
+    except profiler.ProfilerBusy as e:
+        return Response(f"{e}\n", status=409, mimetype="text/plain")
+    except ValueError as e:
+        return Response(f"{e}\n", status=400, mimetype="text/plain")
+    return Response(body, mimetype=content_type)
+
 @socketio.on("connect", namespace="/video")
 def handle_connect():
-    logging.info("Client connected to /video")
-    socketio.emit("stream_list_update", stream_list, namespace="/video")
+    relay.connect(request.sid)
+
 @socketio.on("disconnect", namespace="/video")
 def handle_disconnect():
-    global client_streams, stream_list, shared_secrets, frame_queues
-    sid = request.sid
-    logging.info(f"Client {sid} disconnected from /video")
-    if sid in client_streams:
-        stream_id = client_streams[sid]
-        if stream_id in stream_list:
-            stream_list.remove(stream_id)
-        if stream_id in shared_secrets:
-            del shared_secrets[stream_id]
-        if stream_id in frame_queues:
-            del frame_queues[stream_id]
-        del client_streams[sid]
-        socketio.emit("stream_list_update", stream_list, namespace="/video")
-         
-            
-            
+    relay.disconnect(request.sid)
+
+@socketio.on("select_stream", namespace="/video")
+def handle_select_stream(data):
+    relay.select_stream(request.sid, data)
+
+@socketio.on("watch_thumbnails", namespace="/video")
+def handle_watch_thumbnails(data):
+    relay.watch_thumbnails(request.sid, data)
+
+@socketio.on("delivery_report", namespace="/video")
+def handle_delivery_report(data):
+    relay.delivery_report(request.sid, data)
+
 @socketio.on("register_stream", namespace="/video")
 def register_stream(data):
-    global stream_list, client_streams
-    stream_id = data["stream_id"]
-    if stream_id not in stream_list:
-        stream_list.append(stream_id)
-        client_streams[request.sid] = stream_id
-        logging.info(f"New stream registered: {stream_id} by client {request.sid}")
-        socketio.emit("stream_list_update", stream_list, namespace="/video")
-
-        
+    relay.register_stream(request.sid, data)
+
 @socketio.on("get_stream_list", namespace="/video")
 def get_stream_list():
-    print(stream_list)
-    socketio.emit("stream_list_update", stream_list, namespace="/video", to=request.sid)
-    
-    
+    relay.get_stream_list(request.sid)
 
 @socketio.on("key_exchange", namespace="/video")
 def handle_key_exchange(data):
-    try:
-        client_data = pickle.loads(data)
-        client_public_key = base64.b64decode(client_data["public_key"])
-        stream_id = client_data["stream_id"]
-        logging.debug(f"Key exchange for stream {stream_id} started")
-
-        ciphertext, shared_secret = kyber.encaps(client_public_key)
-        shared_secrets[stream_id] = shared_secret
-        response = {
-            "ciphertext": base64.b64encode(ciphertext).decode("utf-8"),
-            "stream_id": stream_id,
-        }
-        socketio.emit("key_exchange_response", pickle.dumps(response), namespace="/video")
-        logging.info(f"Key exchange completed for stream {stream_id}")
-    except Exception as e:
-        logging.error(f"Error handling key exchange: {e}")
+    relay.key_exchange(request.sid, data)
 
 @socketio.on("video_frame", namespace="/video")
 def handle_video_frame(data):
-    global shared_secrets, frame_queues
-    try:
-        frame_data = pickle.loads(data)
-        stream_id = frame_data["stream_id"]
-        shared_secret = shared_secrets.get(stream_id)
-
-        if not shared_secret:
-            logging.error(f"No shared secret for stream {stream_id}")
-            return
-
-        # Create a queue for the stream if it doesn't exist
-        if stream_id not in frame_queues:
-            frame_queues[stream_id] = queue.Queue()
-            threading.Thread(target=process_frames, args=(stream_id, shared_secret), daemon=True).start()
-
-        # Add the frame data to the stream's queue
-        frame_queues[stream_id].put(frame_data)
-
-    except Exception as e:
-        logging.error(f"Failed to enqueue frame for stream {stream_id}: {e}")
-
-def process_frames(stream_id, shared_secret):
-    global frame_queues, decrypt_enabled
-    chacha20_key = shared_secret[:32]
-    
-    while True:
-        frame_data = frame_queues[stream_id].get()
-        if frame_data is None:
-            break
-
-        if decrypt_enabled:
-            # Decrypt and decode normally
-            future = executor.submit(decrypt_and_decode_frame, frame_data, chacha20_key)
-            frame = future.result()
-
-            if frame is not None:
-                frame = cv2.resize(frame, (640, 360))
-                ret, buffer = cv2.imencode('.jpg', frame)
-                if ret:
-                    socketio.emit(
-                        "broadcast_frame",
-                        {
-                            "stream_id": stream_id,
-                            "frame": base64.b64encode(buffer.tobytes()).decode("utf-8"),
-                        },
-                        namespace="/video",
-                    )
-            else:
-                logging.error(f"Failed to process frame for stream {stream_id}")
-        else:
-            # Decryption disabled: generate color static from encrypted data
-            try:
-                encrypted_frame = base64.b64decode(frame_data["frame"])
-                
-                width, height = 640, 360
-                num_pixels = width * height  # 230,400
-                channels = 3  # For color (BGR)
-                total_bytes_needed = num_pixels * channels  # 691,200
-
-                # If not enough data, repeat
-                if len(encrypted_frame) < total_bytes_needed:
-                    repeats = (total_bytes_needed // len(encrypted_frame)) + 1
-                    extended_data = (encrypted_frame * repeats)[:total_bytes_needed]
-                else:
-                    extended_data = encrypted_frame[:total_bytes_needed]
-
-                # Create a color image (BGR) from the bytes
-                static_frame = np.frombuffer(extended_data, dtype=np.uint8)
-                static_frame = static_frame.reshape((height, width, channels))
-
-                # Encode to JPEG
-                ret, buffer = cv2.imencode('.jpg', static_frame)
-                if ret:
-                    socketio.emit(
-                        "broadcast_frame",
-                        {
-                            "stream_id": stream_id,
-                            "frame": base64.b64encode(buffer.tobytes()).decode("utf-8"),
-                        },
-                        namespace="/video",
-                    )
-                    logging.info(f"Sent color static frame for stream {stream_id}")
-                else:
-                    logging.error(f"Failed to encode static frame for stream {stream_id}")
-            except Exception as e:
-                logging.error(f"Failed to produce static frame: {e}")
-
-
-def decrypt_and_decode_frame(frame_data, key):
-    """Decrypt and decode a single frame."""
-    try:
-        nonce = base64.b64decode(frame_data["nonce"])
-        encrypted_frame = base64.b64decode(frame_data["frame"])
-        tag = base64.b64decode(frame_data["tag"])
+    relay.video_frame(request.sid, data)
+
+@socketio.on("video_frames", namespace="/video")
+def handle_video_frames(data):
+    relay.video_frames(request.sid, data)
+
+@socketio.on("replay_stream", namespace="/video")
+def handle_replay_stream(data):
+    relay.replay_stream(request.sid, data)
+
+@socketio.on("stop_replay", namespace="/video")
+def handle_stop_replay(data=None):
+    relay.stop_replay(request.sid, data)
 
-        cipher = ChaCha20_Poly1305.new(key=key, nonce=nonce)
-        decrypted_frame = cipher.decrypt_and_verify(encrypted_frame, tag)
+@socketio.on("e2e_join", namespace="/video")
+def handle_e2e_join(data):
+    relay.e2e_join(request.sid, data)
 
-        frame = np.frombuffer(decrypted_frame, dtype=np.uint8)
-        return cv2.imdecode(frame, cv2.IMREAD_COLOR)
-    except Exception as e:
-        logging.error(f"Failed to decrypt or decode frame: {e}")
-        return None
+@socketio.on("e2e_key", namespace="/video")
+def handle_e2e_key(data):
+    relay.e2e_key(request.sid, data)
 
 @socketio.on("toggle_decryption", namespace="/video")
-def toggle_decryption():
-    global decrypt_enabled
-    decrypt_enabled = not decrypt_enabled
-    logging.info(f"Decryption enabled: {decrypt_enabled}")
-    socketio.emit("decryption_status", {"enabled": decrypt_enabled}, namespace="/video")
+def toggle_decryption(data=None):
+    relay.toggle_decryption(request.sid, data)
 
 if __name__ == "__main__":
     logging.info("Starting broadcast server")
-    socketio.run(app, host="0.0.0.0", port=5000, debug=False)
+    if launching_cluster:
+        cluster.run_cluster(args, __file__)
+    elif args.server == "asgi":
+        import broadcast_asgi
+        broadcast_asgi.run(args)
+    else:
+        socketio.run(app, host=args.host, port=args.port, debug=False)
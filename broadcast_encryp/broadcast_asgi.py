@@ -0,0 +1,189 @@
+"""Asyncio/ASGI server mode for the broadcast server.
+
+Serves the same ``/video`` events as ``broadcast.py`` from a
+``socketio.AsyncServer`` under uvicorn. Streams are processed by one asyncio
+task each instead of one OS thread each, and the CPU-heavy work (Kyber
+encapsulation, decrypt/decode/resize/encode) runs on executors so the event
+loop only shuffles bytes.
+
+Run it with ``python broadcast.py --server asgi``.
+"""
+import asyncio
+import inspect
+import logging
+from pathlib import Path
+
+import socketio
+import uvicorn
+from fastapi import FastAPI, Header, Request
+from fastapi.responses import HTMLResponse, PlainTextResponse, Response
+
+import profiler
+from relay import NAMESPACE, create_relay
+
+INDEX_HTML = (Path(__file__).parent / "templates" / "index.html").read_text(encoding="utf-8-sig")
+
+app = FastAPI()
+sio = socketio.AsyncServer(async_mode="asgi", cors_allowed_origins="*", max_http_buffer_size=50 * 1024 * 1024)
+asgi_app = socketio.ASGIApp(sio, app)
+
+relay = None
+profile_token = None
+
+
+class AsyncTransport:
+    """Relay transport for the asyncio server.
+
+    Relay methods are synchronous, so emits are scheduled on the event loop,
+    thread-safely when they come from an executor thread.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self.tasks = set()
+
+    def bind(self, loop):
+        self.loop = loop
+
+    def _schedule(self, result):
+        if not inspect.isawaitable(result):
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            task = asyncio.ensure_future(result)
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        else:
+            asyncio.run_coroutine_threadsafe(result, self.loop)
+
+    def emit(self, event, data, to=None):
+        self._schedule(sio.emit(event, data, namespace=NAMESPACE, to=to))
+
+    def enter_room(self, sid, room):
+        self._schedule(sio.enter_room(sid, room, namespace=NAMESPACE))
+
+    def leave_room(self, sid, room):
+        self._schedule(sio.leave_room(sid, room, namespace=NAMESPACE))
+
+    def start_stream(self, relay, stream_id):
+        task = self.loop.create_task(relay.process_frames_async(stream_id))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+
+transport = AsyncTransport()
+
+
+@app.get("/", response_class=HTMLResponse)
+async def index():
+    logging.info("Serving index.html")
+    return INDEX_HTML
+
+
+@app.get("/metrics")
+async def metrics():
+    # Prometheus text exposition format
+    return PlainTextResponse(relay.metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/profile")
+async def profile(request: Request, seconds: float = profiler.DEFAULT_SECONDS, mode: str = "collapsed",
+                  interval: float = profiler.DEFAULT_INTERVAL, x_profile_token: str = Header(None)):
+    # Samples every thread (the event loop included) from an executor thread
+    if not profiler.authorized(request.client.host if request.client else None, x_profile_token, profile_token):
+        return PlainTextResponse("Forbidden\n", status_code=403)
+    try:
+        content_type, body = await asyncio.get_running_loop().run_in_executor(
+            None, profiler.profile, seconds, mode, interval)
+    except profiler.ProfilerBusy as e:
+        return PlainTextResponse(f"{e}\n", status_code=409)
+    except ValueError as e:
+        return PlainTextResponse(f"{e}\n", status_code=400)
+    return Response(body, media_type=content_type)
+
+
+@sio.on("connect", namespace=NAMESPACE)
+async def handle_connect(sid, environ):
+    transport.bind(asyncio.get_running_loop())
+    relay.connect(sid)
+
+
+@sio.on("disconnect", namespace=NAMESPACE)
+async def handle_disconnect(sid):
+    relay.disconnect(sid)
+
+
+@sio.on("select_stream", namespace=NAMESPACE)
+async def handle_select_stream(sid, data):
+    relay.select_stream(sid, data)
+
+
+@sio.on("watch_thumbnails", namespace=NAMESPACE)
+async def handle_watch_thumbnails(sid, data):
+    relay.watch_thumbnails(sid, data)
+
+
+@sio.on("delivery_report", namespace=NAMESPACE)
+async def handle_delivery_report(sid, data):
+    relay.delivery_report(sid, data)
+
+
+@sio.on("register_stream", namespace=NAMESPACE)
+async def register_stream(sid, data):
+    relay.register_stream(sid, data)
+
+
+@sio.on("get_stream_list", namespace=NAMESPACE)
+async def get_stream_list(sid):
+    relay.get_stream_list(sid)
+
+
+@sio.on("key_exchange", namespace=NAMESPACE)
+async def handle_key_exchange(sid, data):
+    # KEM encapsulation is CPU-bound; keep it off the event loop
+    await asyncio.get_running_loop().run_in_executor(None, relay.key_exchange, sid, data)
+
+
+@sio.on("video_frame", namespace=NAMESPACE)
+async def handle_video_frame(sid, data):
+    relay.video_frame(sid, data)
+
+
+@sio.on("video_frames", namespace=NAMESPACE)
+async def handle_video_frames(sid, data):
+    relay.video_frames(sid, data)
+
+
+@sio.on("replay_stream", namespace=NAMESPACE)
+async def handle_replay_stream(sid, data):
+    relay.replay_stream(sid, data)
+
+
+@sio.on("stop_replay", namespace=NAMESPACE)
+async def handle_stop_replay(sid, data=None):
+    relay.stop_replay(sid, data)
+
+
+@sio.on("e2e_join", namespace=NAMESPACE)
+async def handle_e2e_join(sid, data):
+    relay.e2e_join(sid, data)
+
+
+@sio.on("e2e_key", namespace=NAMESPACE)
+async def handle_e2e_key(sid, data):
+    relay.e2e_key(sid, data)
+
+
+@sio.on("toggle_decryption", namespace=NAMESPACE)
+async def toggle_decryption(sid, data=None):
+    relay.toggle_decryption(sid, data)
+
+
+def run(args):
+    global relay, profile_token
+    relay = create_relay(transport, args)
+    profile_token = args.profile_token
+    uvicorn.run(asgi_app, host=args.host, port=args.port)
@@ -0,0 +1,212 @@
+"""Clock-driven frame capture for publishers.
+
+``CaptureThread`` reads and resizes frames on its own thread, so decoding a
+file or waiting on a camera never blocks the event loop that sends frames.
+Frames are released on a monotonic deadline schedule at the target frame
+rate, which may change while running (backpressure lowers it):
+
+- a file source follows the wall clock: frames between deadlines are skipped
+  with ``grab()`` (no decode), and when playback falls far behind it seeks
+  ahead with ``CAP_PROP_POS_FRAMES`` instead of grabbing its way there;
+- a camera is read continuously so its buffer never goes stale, and only
+  frames that meet a deadline are kept;
+- a missed deadline is dropped, not made up for with a burst.
+
+Released frames go to a small asyncio queue. If the sender falls behind, the
+oldest waiting frame is replaced rather than queueing up latency.
+
+A source named ``synthetic:PATTERN[@WIDTHxHEIGHT]`` generates frames instead
+of reading a file or camera (see ``SyntheticSource``), for benchmarks and
+headless tests.
+"""
+import asyncio
+import logging
+import threading
+import time
+
+import cv2
+import numpy as np
+
+QUEUE_SIZE = 2
+SEEK_AFTER = 1.0  # Seconds behind the clock before a file source seeks instead of grabbing
+REPORT_INTERVAL = 5.0
+
+SYNTHETIC_PREFIX = "synthetic:"
+SYNTHETIC_PATTERNS = ("moving", "noise", "static")
+SYNTHETIC_FPS = 30.0
+NOISE_FRAMES = 8  # Noise frames generated up front and cycled
+
+
+class SyntheticSource:
+    """Generated frames behind the parts of the ``cv2.VideoCapture`` interface CaptureThread uses.
+
+    ``moving`` scrolls colour bars over a gradient (every tile changes),
+    ``static`` moves a small box over a fixed picture (few tiles change), and
+    ``noise`` is random pixels (incompressible).
+    """
+
+    def __init__(self, spec, size):
+        pattern, _, frame_size = spec[len(SYNTHETIC_PREFIX):].partition("@")
+        if pattern not in SYNTHETIC_PATTERNS:
+            raise ValueError(f"Unknown synthetic pattern: {pattern} (expected one of {', '.join(SYNTHETIC_PATTERNS)})")
+        width, height = (int(side) for side in frame_size.lower().split("x")) if frame_size else size
+        self.pattern = pattern
+        self.position = 0
+
+        rng = np.random.default_rng(0)
+        if pattern == "noise":
+            self._noise = rng.integers(0, 256, (NOISE_FRAMES, height, width, 3), dtype=np.uint8)
+            return
+        # Twice as wide as the frame, so scrolling is a slice
+        x = np.arange(2 * width)
+        background = np.empty((height, 2 * width, 3), dtype=np.uint8)
+        background[..., 0] = (x * 255 // (2 * width))[None, :]
+        background[..., 1] = (np.arange(height) * 255 // max(height - 1, 1))[:, None]
+        background[..., 2] = np.where((x // max(width // 8, 1)) % 2, 200, 40)[None, :]
+        self._background = background
+        self._width = width
+        self._box = max(8, min(width, height) // 10)
+
+    def isOpened(self):
+        return True
+
+    def grab(self):
+        self.position += 1
+        return True
+
+    def read(self):
+        index = self.position
+        self.position += 1
+        if self.pattern == "noise":
+            return True, self._noise[index % NOISE_FRAMES].copy()
+        if self.pattern == "moving":
+            offset = (index * 8) % self._width
+            return True, np.ascontiguousarray(self._background[:, offset:offset + self._width])
+        frame = self._background[:, :self._width].copy()
+        height, width = frame.shape[:2]
+        left = (index * 4) % max(width - self._box, 1)
+        top = (index * 2) % max(height - self._box, 1)
+        frame[top:top + self._box, left:left + self._box] = 255
+        return True, frame
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FPS:
+            return SYNTHETIC_FPS
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return float(self.position)
+        return 0.0
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            self.position = int(value)
+            return True
+        return False
+
+    def release(self):
+        pass
+
+
+class CaptureThread:
+    def __init__(self, source, size, target_fps, name="capture"):
+        self.source = source
+        self.size = size
+        self.target_fps = target_fps  # Callable returning the current target frame rate
+        self.name = name
+        self.camera = source == "camera"
+        self.frames = None
+        self._loop = None
+        self._stop = threading.Event()
+
+        # Counters for reporting
+        self.delivered = 0
+        self.dropped = 0
+        self.seeks = 0
+        self.replaced = 0  # Captured in time but overwritten before the sender took them
+        self.achieved_fps = 0.0
+
+    def start(self, loop):
+        """Open the source and start capturing. Returns False if the source cannot be opened."""
+        self._loop = loop
+        self.frames = asyncio.Queue(maxsize=QUEUE_SIZE)
+        if self.source.startswith(SYNTHETIC_PREFIX):
+            self.cap = SyntheticSource(self.source, self.size)
+        else:
+            self.cap = cv2.VideoCapture(0 if self.camera else self.source)
+        if not self.cap.isOpened():
+            logging.error(f"Failed to open video source: {self.source}")
+            return False
+        threading.Thread(target=self._run, name=f"{self.name}-capture", daemon=True).start()
+        return True
+
+    def stop(self):
+        self._stop.set()
+
+    async def get(self):
+        """``(frame, captured_at)`` for the next frame (wall-clock capture time), or None at the end of the source."""
+        return await self.frames.get()
+
+    def _deliver(self, item):
+        # Runs on the event loop; the end-of-source None replaces a waiting frame too, so it is never lost
+        if self.frames.full():
+            self.frames.get_nowait()
+            if item is not None:
+                self.replaced += 1
+        self.frames.put_nowait(item)
+
+    def _run(self):
+        source_fps = self.cap.get(cv2.CAP_PROP_FPS) or 30.0
+        start = time.monotonic()
+        deadline = start
+        report_at = start + REPORT_INTERVAL
+        reported = 0
+        try:
+            while not self._stop.is_set():
+                period = 1.0 / max(self.target_fps(), 0.1)
+                now = time.monotonic()
+                if now < deadline:
+                    if self.camera:
+                        self.cap.grab()  # Keep draining the camera; only the latest frame matters
+                        continue
+                    time.sleep(deadline - now)
+                    now = time.monotonic()
+                elif now - deadline > period:
+                    # Missed one or more deadlines: drop them rather than bursting to catch up
+                    self.dropped += int((now - deadline) / period)
+                    deadline = now
+
+                if not self.camera and not self._catch_up(now - start, source_fps):
+                    break
+                ret, frame = self.cap.read()
+                captured_at = time.time()
+                if not ret:
+                    logging.info(f"End of video source {self.source}")
+                    break
+                frame = cv2.resize(frame, self.size)
+                self._loop.call_soon_threadsafe(self._deliver, (frame, captured_at))
+                self.delivered += 1
+                deadline += period
+
+                if now >= report_at:
+                    self.achieved_fps = (self.delivered - reported) / (now - report_at + REPORT_INTERVAL)
+                    reported = self.delivered
+                    report_at = now + REPORT_INTERVAL
+                    logging.info(f"{self.name}: {self.achieved_fps:.1f} fps of {self.target_fps():.1f} target "
+                                 f"({self.dropped} dropped, {self.replaced} replaced, {self.seeks} seeks)")
+        finally:
+            self.cap.release()
+            if not self._loop.is_closed():
+                self._loop.call_soon_threadsafe(self._deliver, None)
+
+    def _catch_up(self, elapsed, source_fps):
+        """Move a file source to where the clock says playback should be. False at the end."""
+        wanted = int(elapsed * source_fps)
+        position = int(self.cap.get(cv2.CAP_PROP_POS_FRAMES))
+        behind = wanted - position
+        if behind > SEEK_AFTER * source_fps:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, wanted)
+            self.seeks += 1
+            return True
+        for _ in range(behind):
+            if not self.cap.grab():  # Skip without decoding
+                return False
+        return True
@@ -0,0 +1,62 @@
+"""Run the broadcast server as a broker plus several worker processes.
+
+Ingest streams are sharded across workers by a stable hash of their stream
+id; a publisher that registers with the wrong worker is redirected to its
+owner. Viewers can connect to any worker, and rendered frames reach them over
+the broker's message bus.
+"""
+import logging
+import os
+import socket
+import subprocess
+import sys
+import zlib
+
+from state_backend import AUTHKEY_ENV, Broker, authkey_from_env, new_authkey, parse_address
+
+
+def shard_for(stream_id, cluster_size):
+    """Index of the worker that ingests ``stream_id``."""
+    return zlib.crc32(stream_id.encode("utf-8")) % cluster_size
+
+
+def worker_urls(host, base_port, cluster_size):
+    return [f"http://{host}:{base_port + index}" for index in range(cluster_size)]
+
+
+def default_backend():
+    if hasattr(socket, "AF_UNIX"):
+        return "unix:/tmp/broadcast-broker.sock"
+    return "tcp:127.0.0.1:6789"
+
+
+def run_cluster(args, script):
+    """Start a broker and ``args.cluster`` workers on consecutive ports, then wait for them."""
+    spec = args.backend if args.backend != "local" else default_backend()
+    # A fresh key per cluster unless the operator set one; workers get it in their environment
+    authkey = authkey_from_env() or new_authkey()
+    broker = Broker(parse_address(spec), authkey).start()
+    env = dict(os.environ, **{AUTHKEY_ENV: authkey.hex()})
+    logging.info(f"Broker listening on {spec}")
+
+    workers = []
+    for index in range(args.cluster):
+        # Later flags win, so the worker's own settings simply follow ours
+        command = [sys.executable, script] + sys.argv[1:] + [
+            "--worker-index", str(index),
+            "--backend", spec,
+            "--port", str(args.port + index),
+        ]
+        workers.append(subprocess.Popen(command, env=env))
+
+    try:
+        for worker in workers:
+            worker.wait()
+    except KeyboardInterrupt:
+        logging.info("Stopping broadcast workers")
+    finally:
+        for worker in workers:
+            if worker.poll() is None:
+                worker.terminate()
+                worker.wait()
+        broker.close()
@@ -0,0 +1,96 @@
+"""Bounded per-stream ingest buffers.
+
+``FrameBuffer`` replaces the unbounded ``queue.Queue`` that sat between
+``handle_video_frame`` and ``process_frames``. When the buffer is full one of
+the drop policies below decides which frame is discarded, so memory and
+latency stay bounded when processing falls behind.
+"""
+import asyncio
+import threading
+from collections import deque
+
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+KEYFRAMES_ONLY = "keyframes-only"
+POLICIES = (DROP_OLDEST, DROP_NEWEST, KEYFRAMES_ONLY)
+
+
+class FrameBuffer:
+    def __init__(self, capacity=8, policy=DROP_OLDEST):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown drop policy: {policy}")
+        self.capacity = capacity
+        self.policy = policy
+        self.dropped = 0
+        self.received = 0
+        self._frames = deque()  # (frame, keyframe)
+        self._closed = False
+        self._cond = threading.Condition()
+        self._ready = None  # asyncio.Event, created by the first get_async()
+
+    def put(self, frame, keyframe=True):
+        """Add a frame, applying the drop policy. Returns False if it was dropped."""
+        with self._cond:
+            self.received += 1
+            if len(self._frames) >= self.capacity and not self._make_room(keyframe):
+                self.dropped += 1
+                return False
+            self._frames.append((frame, keyframe))
+            self._cond.notify()
+            if self._ready is not None:
+                self._ready.set()
+            return True
+
+    def _make_room(self, keyframe):
+        if self.policy == DROP_NEWEST:
+            return False
+        if self.policy == KEYFRAMES_ONLY:
+            # Shed queued delta frames first; a new delta frame is not worth a keyframe
+            deltas = [entry for entry in self._frames if not entry[1]]
+            if deltas:
+                self._frames = deque(entry for entry in self._frames if entry[1])
+                self.dropped += len(deltas)
+                return True
+            if not keyframe:
+                return False
+        self._frames.popleft()
+        self.dropped += 1
+        return True
+
+    def get(self, timeout=None):
+        """Block until a frame is available. Returns None once the buffer is closed."""
+        with self._cond:
+            while not self._frames and not self._closed:
+                if not self._cond.wait(timeout):
+                    return None
+            if not self._frames:
+                return None
+            return self._frames.popleft()[0]
+
+    async def get_async(self):
+        """Await a frame on the event loop. Only valid when puts happen on that same loop."""
+        while True:
+            with self._cond:
+                if self._frames:
+                    return self._frames.popleft()[0]
+                if self._closed:
+                    return None
+                if self._ready is None:
+                    self._ready = asyncio.Event()
+                self._ready.clear()
+            await self._ready.wait()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._frames.clear()
+            self._cond.notify_all()
+            if self._ready is not None:
+                self._ready.set()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def __len__(self):
+        return len(self._frames)
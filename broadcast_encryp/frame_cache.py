@@ -0,0 +1,66 @@
+"""Bounded cache of encoded frames shared by every viewer of a stream.
+
+Frames are encoded once and stored under ``(stream_id, sequence, rendition)``
+so late joiners can be sent the current picture immediately and any
+per-viewer delivery path can reuse the bytes instead of re-encoding.
+"""
+import threading
+from collections import OrderedDict, deque
+
+
+class FrameCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024, frames_per_stream=2):
+        self.max_bytes = max_bytes
+        self.frames_per_stream = frames_per_stream
+        self._entries = OrderedDict()  # (stream_id, sequence, rendition) -> bytes, LRU order
+        self._history = {}  # (stream_id, rendition) -> deque of cached sequences
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def put(self, stream_id, sequence, rendition, data):
+        key = (stream_id, sequence, rendition)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = data
+            self._bytes += len(data)
+            history = self._history.setdefault((stream_id, rendition), deque())
+            history.append(sequence)
+
+            # Keep only the newest frames of this stream/rendition...
+            while len(history) > self.frames_per_stream:
+                self._remove((stream_id, history[0], rendition))
+            # ...and stay inside the global memory budget (least recently used first)
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                self._remove(next(iter(self._entries)))
+
+    def latest(self, stream_id, rendition):
+        """Return ``(sequence, data)`` for the newest cached frame, or None."""
+        with self._lock:
+            history = self._history.get((stream_id, rendition))
+            if not history:
+                return None
+            key = (stream_id, history[-1], rendition)
+            self._entries.move_to_end(key)
+            return history[-1], self._entries[key]
+
+    def drop_stream(self, stream_id):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == stream_id]:
+                self._remove(key)
+
+    def _remove(self, key):
+        stream_id, sequence, rendition = key
+        self._bytes -= len(self._entries.pop(key))
+        history = self._history[(stream_id, rendition)]
+        history.remove(sequence)
+        if not history:
+            del self._history[(stream_id, rendition)]
+
+    @property
+    def size_bytes(self):
+        """Bytes of encoded frames held, reported as ``broadcast_frame_cache_bytes``."""
+        return self._bytes
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,144 @@
+"""Cached stream key material, session resumption and rekey scheduling.
+
+Every established secret becomes a numbered key epoch of its stream. Frames
+name the epoch they were sealed under, and when a newer epoch arrives the
+older ones stay valid for a short grace period, so frames already in flight
+still decrypt and a rekey never stalls the stream.
+
+A full key exchange also issues a resumption ticket. A publisher that
+reconnects within the TTL proves it still holds the secret and gets a new
+epoch derived from the old secret, without another Kyber encapsulation.
+"""
+import hmac
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from crypto_common.session import StreamSession, resume_proof, resumed_secret
+
+TICKET_SIZE = 16
+SALT_SIZE = 16
+
+
+class _Epoch:
+    def __init__(self, secret, session, established_at, expires_at):
+        self.secret = secret
+        self.session = session
+        self.established_at = established_at
+        self.expires_at = expires_at
+
+
+class _StreamKeys:
+    def __init__(self):
+        self.epochs = {}  # epoch number -> _Epoch
+        self.current = -1
+        self.ticket = None
+        self.rekey_requested_at = None
+
+
+class KeyManager:
+    def __init__(self, ttl=3600.0, grace=10.0, rekey_after=300.0):
+        self.ttl = ttl  # How long a secret stays usable (and resumable) after it is established
+        self.grace = grace  # How long an epoch stays valid once a newer one exists
+        self.rekey_after = rekey_after  # Age at which publishers are asked to rekey; 0 disables
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    def establish(self, stream_id, shared_secret, new_ticket=True):
+        """Start a new epoch for ``stream_id``. Returns ``(epoch, ticket)``."""
+        now = time.monotonic()
+        with self._lock:
+            keys = self._streams.setdefault(stream_id, _StreamKeys())
+            epoch = keys.current + 1
+            for old in keys.epochs.values():
+                old.expires_at = min(old.expires_at, now + self.grace)
+            keys.epochs[epoch] = _Epoch(shared_secret, StreamSession(shared_secret, stream_id, epoch=epoch),
+                                        now, now + self.ttl)
+            keys.current = epoch
+            keys.rekey_requested_at = None
+            if new_ticket or keys.ticket is None:
+                keys.ticket = os.urandom(TICKET_SIZE)
+            self._prune(keys, now)
+            return epoch, keys.ticket
+
+    def adopt(self, stream_id, epoch, shared_secret):
+        """Install an epoch negotiated by another worker (via the state backend)."""
+        now = time.monotonic()
+        with self._lock:
+            keys = self._streams.setdefault(stream_id, _StreamKeys())
+            if epoch not in keys.epochs:
+                keys.epochs[epoch] = _Epoch(shared_secret, StreamSession(shared_secret, stream_id, epoch=epoch),
+                                            now, now + self.ttl)
+                keys.current = max(keys.current, epoch)
+
+    def resume(self, stream_id, ticket, client_salt, proof):
+        """Validate a resumption request. Returns ``(epoch, server_salt, secret)``, or None."""
+        now = time.monotonic()
+        with self._lock:
+            keys = self._streams.get(stream_id)
+            if keys is None or keys.ticket is None or not hmac.compare_digest(keys.ticket, ticket):
+                return None
+            current = keys.epochs.get(keys.current)
+            if current is None or current.expires_at <= now:
+                return None
+            if not hmac.compare_digest(resume_proof(current.secret, ticket, client_salt), proof):
+                return None
+            secret = current.secret
+        server_salt = os.urandom(SALT_SIZE)
+        secret = resumed_secret(secret, stream_id, client_salt, server_salt)
+        epoch, _ = self.establish(stream_id, secret, new_ticket=False)
+        return epoch, server_salt, secret
+
+    def lookup(self, stream_id, epoch):
+        """``(secret, StreamSession)`` for a frame's epoch, or None if it is unknown or expired."""
+        with self._lock:
+            keys = self._streams.get(stream_id)
+            entry = keys.epochs.get(epoch) if keys else None
+            if entry is None or entry.expires_at <= time.monotonic():
+                return None
+            return entry.secret, entry.session
+
+    def current(self, stream_id):
+        """``(epoch, secret)`` of the newest epoch, or None."""
+        with self._lock:
+            keys = self._streams.get(stream_id)
+            if keys is None or keys.current not in keys.epochs:
+                return None
+            return keys.current, keys.epochs[keys.current].secret
+
+    def due_for_rekey(self):
+        """Streams whose current epoch is old enough to rekey and have not been asked yet."""
+        if not self.rekey_after:
+            return []
+        now = time.monotonic()
+        due = []
+        with self._lock:
+            for stream_id, keys in self._streams.items():
+                current = keys.epochs.get(keys.current)
+                if current is None or keys.rekey_requested_at is not None:
+                    continue
+                if now - current.established_at >= self.rekey_after:
+                    keys.rekey_requested_at = now
+                    due.append(stream_id)
+        return due
+
+    def expire(self):
+        """Forget epochs, and streams, whose TTL has run out."""
+        now = time.monotonic()
+        with self._lock:
+            for stream_id in list(self._streams):
+                keys = self._streams[stream_id]
+                self._prune(keys, now)
+                if not keys.epochs:
+                    del self._streams[stream_id]
+
+    def drop(self, stream_id):
+        with self._lock:
+            self._streams.pop(stream_id, None)
+
+    @staticmethod
+    def _prune(keys, now):
+        for epoch in [epoch for epoch, entry in keys.epochs.items() if entry.expires_at <= now]:
+            del keys.epochs[epoch]
@@ -0,0 +1,219 @@
+"""Counters, gauges and histograms for the broadcast server's ``/metrics`` endpoint.
+
+A small Prometheus text-format registry, so scraping needs no extra
+dependency. Metrics are labelled by position:
+
+    frames.inc(stream_id)
+    latency.observe(0.042, stream_id, "decode")
+
+``RelayMetrics`` declares everything the relay records. Per-frame stage
+timings come from the publisher (carried in the frame header, see
+``wire.Timing``), from the relay itself and from the render jobs
+(``pipeline.timed``).
+"""
+import bisect
+import math
+import threading
+import time
+
+# Seconds; frame stages run from well under a millisecond to whole seconds under load
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+RATE_WINDOW = 5  # Seconds averaged by Rate
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._series = {}  # label values -> value
+        self._lock = threading.Lock()
+
+    def remove(self, label, value):
+        """Forget every series whose ``label`` is ``value`` (a stream that went away)."""
+        index = self.labels.index(label)
+        with self._lock:
+            for key in [key for key in self._series if key[index] == value]:
+                del self._series[key]
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, "", value) for key, value in self._series.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, extra, value in self.samples():
+            lines.append(f"{name}{_format_labels(self.labels, key, extra)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._series[labels] = self._series.get(labels, 0) + amount
+
+    def set(self, value, *labels):
+        """Set a total counted elsewhere (e.g. a buffer's drop count)."""
+        with self._lock:
+            self._series[labels] = value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._series[labels] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]  # Buckets, +Inf, sum
+            series[bisect.bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            series = [(key, list(values)) for key, values in self._series.items()]
+        for key, values in series:
+            total = 0
+            for bound, count in zip(self.buckets + (math.inf,), values):
+                total += count
+                samples.append((f"{self.name}_bucket", key, f'le="{_format_value(bound)}"', total))
+            samples.append((f"{self.name}_sum", key, "", values[-1]))
+            samples.append((f"{self.name}_count", key, "", total))
+        return samples
+
+
+class Rate:
+    """Events per second over the last few whole seconds, per key."""
+
+    def __init__(self, window=RATE_WINDOW):
+        self.window = window
+        self._counts = {}  # key -> {second: count}
+        self._lock = threading.Lock()
+
+    def mark(self, key, amount=1):
+        second = int(time.monotonic())
+        with self._lock:
+            counts = self._counts.setdefault(key, {})
+            counts[second] = counts.get(second, 0) + amount
+            if len(counts) > self.window + 1:
+                for old in [old for old in counts if old < second - self.window]:
+                    del counts[old]
+
+    def rates(self):
+        """``{key: per-second rate}``, from the last ``window`` completed seconds."""
+        now = int(time.monotonic())
+        with self._lock:
+            return {key: sum(count for second, count in counts.items() if now - self.window <= second < now)
+                    / self.window for key, counts in self._counts.items()}
+
+    def remove(self, match):
+        with self._lock:
+            for key in [key for key in self._counts if match(key)]:
+                del self._counts[key]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []  # Called before rendering, to refresh gauges from live state
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def remove(self, label, value):
+        for metric in self.metrics:
+            if label in metric.labels:
+                metric.remove(label, value)
+
+    def render(self):
+        """The registry in Prometheus text exposition format."""
+        for collect in self.collectors:
+            collect()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class RelayMetrics(Registry):
+    """Everything the relay records, per stream."""
+
+    def __init__(self):
+        super().__init__()
+        self.frames_received = self.add(Counter(
+            "broadcast_frames_received_total", "Frames received from publishers", ["stream"]))
+        self.bytes_received = self.add(Counter(
+            "broadcast_bytes_received_total", "Ciphertext bytes received from publishers", ["stream"]))
+        self.frames_dropped = self.add(Counter(
+            "broadcast_frames_dropped_total", "Frames dropped by the stream's ingest buffer", ["stream"]))
+        self.frames_sent = self.add(Counter(
+            "broadcast_frames_sent_total", "Frames sent to viewers, per rendition", ["stream", "rendition"]))
+        self.bytes_sent = self.add(Counter(
+            "broadcast_bytes_sent_total", "JPEG bytes sent to viewers, per rendition", ["stream", "rendition"]))
+        self.queue_depth = self.add(Gauge(
+            "broadcast_queue_depth", "Frames waiting in the stream's ingest buffer", ["stream"]))
+        self.ingest_fps = self.add(Gauge(
+            "broadcast_ingest_fps", "Frames per second received from the publisher", ["stream"]))
+        self.output_fps = self.add(Gauge(
+            "broadcast_output_fps", "Frames per second sent, per rendition", ["stream", "rendition"]))
+        self.frame_cache_bytes = self.add(Gauge(
+            "broadcast_frame_cache_bytes", "Bytes of encoded frames held in the shared frame cache"))
+        self.stage_seconds = self.add(Histogram(
+            "broadcast_stage_seconds",
+            "Time a frame spends in each stage: encode, encrypt (publisher), network, queue, decrypt, decode, "
+            "resize, reencode, static, broadcast", ["stream", "stage"]))
+        self.latency_seconds = self.add(Histogram(
+            "broadcast_latency_seconds", "Capture to broadcast, per frame", ["stream"]))
+        self.viewer_latency_seconds = self.add(Histogram(
+            "broadcast_viewer_latency_seconds", "Capture to arrival at the viewer's page, as reported by it",
+            ["stream"]))
+
+        self.ingest_rate = Rate()
+        self.output_rate = Rate()
+
+    def remove_stream(self, stream_id):
+        self.remove("stream", stream_id)
+        self.ingest_rate.remove(lambda key: key == stream_id)
+        self.output_rate.remove(lambda key: key[0] == stream_id)
+
+    def refresh_rates(self):
+        for stream_id, rate in self.ingest_rate.rates().items():
+            self.ingest_fps.set(rate, stream_id)
+        for (stream_id, rendition), rate in self.output_rate.rates().items():
+            self.output_fps.set(rate, stream_id, rendition)
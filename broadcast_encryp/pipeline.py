@@ -0,0 +1,252 @@
+"""Per-stream frame rendering pipeline for the broadcast server.
+
+The render functions here are plain module-level functions of picklable
+arguments so they can run in either a thread pool or a process pool.
+``FramePipeline`` keeps several of them in flight per stream and hands the
+results back strictly in sequence order.
+
+``render_ladder`` decrypts and decodes a frame once and scales it into every
+rendition that has viewers, largest first, each from the one before. Publishers
+already send JPEG, so a rendition at (or above) the source size is the
+decrypted bytes as they are; when that is all anyone watches, no pixels are
+decoded at all.
+
+Tile codec frames (``crypto_common.codec``) depend on the frame before, so the
+relay decodes them in order on the stream's own thread and only hands the
+finished picture to ``scale_ladder`` on the pool.
+
+Render jobs run through ``timed``, which returns how long each stage (decrypt,
+decode, resize, reencode, static) took alongside the result, for the relay's
+metrics. ``stage()`` is a no-op outside ``timed``.
+"""
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from crypto_common.suites import cipher_class
+
+# Static previews are noise, so they are small, coarse and reused for several frames
+STATIC_SIZE = (320, 180)
+STATIC_QUALITY = 30
+_static = threading.local()  # Per-thread preallocated preview picture
+_timing = threading.local()  # Stage durations of the job running on this thread
+
+# JPEG start-of-frame markers (SOF0-SOF15, less DHT, JPG and DAC) carry the image size
+SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+# One cipher (and so one set of per-thread scratch buffers) per stream key
+MAX_CIPHERS = 256
+_ciphers = {}
+
+
+def cipher_for(key, aead):
+    """The cipher for a stream key under the AEAD its cipher suite negotiated."""
+    cipher = _ciphers.get((key, aead))
+    if cipher is None:
+        if len(_ciphers) >= MAX_CIPHERS:
+            _ciphers.clear()  # Keys of departed streams; cheap to rebuild
+        cipher = _ciphers[(key, aead)] = cipher_class(aead)(key)
+    return cipher
+
+
+def stage(name):
+    """Close the current stage of a timed job: the time since the previous mark is added to ``name``."""
+    stages = getattr(_timing, "stages", None)
+    if stages is None:
+        return
+    now = time.perf_counter()
+    stages[name] = stages.get(name, 0.0) + now - _timing.mark
+    _timing.mark = now
+
+
+def timed(fn, *args):
+    """Run a render function. Returns ``(result, {stage: seconds})``."""
+    _timing.stages = {}
+    _timing.mark = time.perf_counter()
+    try:
+        result = fn(*args)
+        return result, _timing.stages
+    finally:
+        _timing.stages = None
+
+
+def jpeg_size(data):
+    """``(width, height)`` from a JPEG's frame header, without decoding it. None if not found."""
+    view = memoryview(data)
+    if len(view) < 4 or view[0] != 0xFF or view[1] != 0xD8:
+        return None
+    offset = 2
+    while offset + 4 <= len(view):
+        if view[offset] != 0xFF:
+            return None
+        marker = view[offset + 1]
+        if marker == 0xFF:
+            offset += 1  # Fill byte
+            continue
+        if marker == 0xD9 or marker == 0xDA:
+            return None  # End of image, or scan data before any frame header
+        length = struct.unpack_from("!H", view, offset + 2)[0]
+        if marker in SOF_MARKERS:
+            if offset + 9 > len(view):
+                return None
+            height, width = struct.unpack_from("!HH", view, offset + 5)
+            return width, height
+        offset += 2 + length
+    return None
+
+
+def scale_ladder(frame, renditions, rendered=None):
+    """Scale a decoded frame into each rendition not yet in ``rendered``. Returns ``{name: JPEG bytes}``."""
+    rendered = {} if rendered is None else rendered
+    source_size = (frame.shape[1], frame.shape[0])
+    for rendition in renditions:
+        if rendition.name in rendered:
+            continue
+        size = (rendition.width, rendition.height)
+        if rendition.width >= source_size[0] and rendition.height >= source_size[1]:
+            size = source_size  # Never upscale
+        # Shared scaling stage: each rendition is scaled from the previous, larger one
+        if (frame.shape[1], frame.shape[0]) != size:
+            frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+            stage("resize")
+        ret, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, rendition.quality])
+        stage("reencode")
+        if ret:
+            rendered[rendition.name] = buffer.tobytes()
+    return rendered
+
+
+def render_ladder(frame_data, key, renditions, passthrough, aead):
+    """Decrypt a JPEG frame into each of ``renditions`` (largest first): ``{name: JPEG bytes}`` or None."""
+    try:
+        decrypted_frame = cipher_for(key, aead).decrypt(frame_data.nonce, frame_data.payload, frame_data.tag)
+        stage("decrypt")
+        rendered = {}
+        source_size = jpeg_size(decrypted_frame) if passthrough else None
+        if source_size is not None:
+            # The publisher's own JPEG serves every rendition at or above its size
+            source_jpeg = None
+            for rendition in renditions:
+                if rendition.width >= source_size[0] and rendition.height >= source_size[1]:
+                    if source_jpeg is None:
+                        source_jpeg = bytes(decrypted_frame)  # Copy out of the per-thread scratch buffer
+                    rendered[rendition.name] = source_jpeg
+            if len(rendered) == len(renditions):
+                return rendered
+        frame = cv2.imdecode(np.frombuffer(decrypted_frame, dtype=np.uint8), cv2.IMREAD_COLOR)
+        stage("decode")
+        if frame is None:
+            return None
+    except Exception as e:
+        logging.error(f"Failed to decrypt or decode frame: {e}")
+        return None
+    return scale_ladder(frame, renditions, rendered)
+
+
+def render_static_frame(frame_data):
+    """Render color static from the still-encrypted payload. Returns JPEG bytes or None."""
+    try:
+        encrypted_frame = np.frombuffer(frame_data.payload, dtype=np.uint8)
+        width, height = STATIC_SIZE
+        needed = width * height * 3  # BGR
+
+        if encrypted_frame.size >= needed:
+            # Enough ciphertext: view it as the picture, no copy
+            static_frame = encrypted_frame[:needed].reshape((height, width, 3))
+        else:
+            # Tile the ciphertext into a preallocated picture, doubling the filled part each step
+            static_frame = getattr(_static, "picture", None)
+            if static_frame is None:
+                static_frame = _static.picture = np.empty((height, width, 3), dtype=np.uint8)
+            flat = static_frame.reshape(-1)
+            filled = encrypted_frame.size
+            if filled == 0:
+                flat[:] = 0
+            else:
+                flat[:filled] = encrypted_frame
+                while filled < needed:
+                    step = min(filled, needed - filled)
+                    flat[filled:filled + step] = flat[:step]
+                    filled += step
+
+        ret, buffer = cv2.imencode('.jpg', static_frame, [cv2.IMWRITE_JPEG_QUALITY, STATIC_QUALITY])
+        stage("static")
+        return buffer.tobytes() if ret else None
+    except Exception as e:
+        logging.error(f"Failed to produce static frame: {e}")
+        return None
+
+
+class StaticLadder(dict):
+    """Renditions rendered from ciphertext without decrypting it, so nothing about the frame was authenticated."""
+
+
+def render_static_ladder(frame_data, names):
+    """Color static for every wanted rendition; the browser scales the one picture."""
+    data = render_static_frame(frame_data)
+    if data is None:
+        return None
+    return StaticLadder((name, data) for name in names)
+
+
+def reuse_static_ladder(data, names):
+    """A previous static preview, sent again for the wanted renditions."""
+    return StaticLadder((name, data) for name in names)
+
+
+class FramePipeline:
+    """Keeps up to ``inflight`` render jobs running and releases results in order.
+
+    Jobs are queued in arrival order and a finished job is only released once
+    every job before it has finished too, so fast workers never overtake slow
+    ones. Results older than the last one released are discarded.
+    """
+
+    def __init__(self, executor, inflight=4):
+        self.executor = executor
+        self.inflight = max(1, inflight)
+        self._jobs = deque()  # (sequence, future) in submission order
+        self._last_sequence = -1
+
+    def submit(self, sequence, fn, *args):
+        """Queue a render job, first waiting for the oldest one if the pipeline is full."""
+        released = []
+        if len(self._jobs) >= self.inflight:
+            released.extend(self.ready(block=True))
+        self._jobs.append((sequence, self.executor.submit(fn, *args)))
+        return released
+
+    def ready(self, block=False):
+        """Return ``(sequence, result)`` for finished jobs at the head of the pipeline."""
+        released = []
+        while self._jobs and (block or self._jobs[0][1].done()):
+            sequence, future = self._jobs.popleft()
+            block = False  # Only wait for the oldest job
+            try:
+                result = future.result()
+            except Exception as e:
+                logging.error(f"Render job for frame {sequence} failed: {e}")
+                continue
+            if sequence < self._last_sequence:
+                continue  # Arrived out of order and already superseded
+            self._last_sequence = sequence
+            released.append((sequence, result))
+        return released
+
+    def drain(self):
+        released = []
+        while self._jobs:
+            released.extend(self.ready(block=True))
+        return released
+
+    @property
+    def pending(self):
+        return len(self._jobs)
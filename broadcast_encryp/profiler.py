@@ -0,0 +1,164 @@
+"""On-demand sampling profiler for the broadcast server.
+
+``GET /profile?seconds=5&mode=collapsed`` samples the stack of every thread
+(stream workers, render pool threads, the server's own) for a few seconds
+and returns:
+
+- ``collapsed``: one ``thread;frame;frame... count`` line per distinct stack,
+  for flamegraph.pl or speedscope;
+- ``pstats``: a marshalled stats file for ``pstats.Stats`` or snakeviz;
+- ``text``: the top functions by cumulative time, as ``pstats`` prints them.
+
+Stack traces show the relay's internals, so with ``--profile-token`` a request
+must send the token in an ``X-Profile-Token`` header; without one, only
+clients on this host are served.
+
+Nothing is installed while no profile is being taken, so it costs nothing
+until asked for. Render jobs in ``--render-pool process`` workers run in
+other processes and are not sampled.
+"""
+import collections
+import hmac
+import io
+import ipaddress
+import marshal
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+
+MODES = ("collapsed", "pstats", "text")
+DEFAULT_SECONDS = 5.0
+MAX_SECONDS = 60.0
+DEFAULT_INTERVAL = 0.005  # 200 samples per second per thread
+TEXT_LIMIT = 60  # Functions listed by the text mode
+
+_lock = threading.Lock()  # One profile at a time
+
+
+class ProfilerBusy(RuntimeError):
+    """Raised when a profile is requested while another is being taken."""
+
+
+def _thread_names():
+    # Numbers collapse, so every render pool thread or stream worker lands in one group
+    return {thread.ident: re.sub(r"\d+", "N", thread.name) for thread in threading.enumerate()}
+
+
+def sample(seconds, interval=DEFAULT_INTERVAL):
+    """Sample all other threads' stacks.
+
+    Returns a ``Counter`` of ``(thread, stack root first)`` -> samples, and the
+    measured seconds between samples (longer than ``interval`` under load).
+    """
+    if not _lock.acquire(blocking=False):
+        raise ProfilerBusy("A profile is already being taken")
+    try:
+        own = threading.get_ident()
+        samples = collections.Counter()
+        names = _thread_names()
+        names_at = time.monotonic()
+        started = names_at
+        deadline = started + min(seconds, MAX_SECONDS)
+        rounds = 0
+        while time.monotonic() < deadline:
+            rounds += 1
+            if time.monotonic() - names_at > 1.0:
+                names, names_at = _thread_names(), time.monotonic()
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                stack.reverse()
+                samples[(names.get(ident, "unknown"), tuple(stack))] += 1
+            time.sleep(interval)
+        return samples, (time.monotonic() - started) / max(rounds, 1)
+    finally:
+        _lock.release()
+
+
+def collapsed(samples):
+    """Samples in collapsed-stack format."""
+    lines = []
+    for (thread, stack), count in samples.most_common():
+        frames = [thread] + [f"{name} ({os.path.basename(filename)}:{line})" for filename, line, name in stack]
+        lines.append(f"{';'.join(frames)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def to_stats(samples, period):
+    """Samples as a ``pstats`` stats dict: ``{function: (cc, nc, tt, ct, callers)}``.
+
+    A sample counts as one call of every function on its stack (recursion
+    counted once), and as ``period`` seconds of own time for the function on top.
+    """
+    entries = {}
+    for (thread, stack), count in samples.items():
+        seconds = count * period
+        seen = set()
+        for index, function in enumerate(stack):
+            entry = entries.setdefault(function, [0, 0, 0.0, 0.0, {}])
+            leaf = index == len(stack) - 1
+            if leaf:
+                entry[2] += seconds
+            if function in seen:
+                continue
+            seen.add(function)
+            entry[0] += count
+            entry[1] += count
+            entry[3] += seconds
+            if index:
+                edge = entry[4].setdefault(stack[index - 1], [0, 0, 0.0, 0.0])
+                edge[0] += count
+                edge[1] += count
+                edge[2] += seconds if leaf else 0.0
+                edge[3] += seconds
+    return {function: (cc, nc, tt, ct, {caller: tuple(edge) for caller, edge in callers.items()})
+            for function, (cc, nc, tt, ct, callers) in entries.items()}
+
+
+class _SampledProfile:
+    """Enough of a profiler object for ``pstats.Stats`` to load sampled stats."""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def authorized(remote_addr, offered, token=None):
+    """Whether a profile request may run: it must carry ``token`` if one is set, or come from this host."""
+    if token:
+        return offered is not None and hmac.compare_digest(offered.encode(), token.encode())
+    try:
+        address = ipaddress.ip_address(remote_addr or "")
+    except ValueError:
+        return False
+    if getattr(address, "ipv4_mapped", None):
+        address = address.ipv4_mapped  # ::ffff:127.0.0.1 from a dual-stack socket
+    return address.is_loopback
+
+
+def profile(seconds=DEFAULT_SECONDS, mode="collapsed", interval=DEFAULT_INTERVAL):
+    """Take a profile. Returns ``(content type, body)``; raises ProfilerBusy or ValueError."""
+    if mode not in MODES:
+        raise ValueError(f"Unknown profile mode: {mode} (expected one of {', '.join(MODES)})")
+    interval = max(interval, 0.001)
+    samples, period = sample(seconds, interval)
+    if mode == "collapsed":
+        return "text/plain", collapsed(samples)
+    stats = to_stats(samples, period)
+    if mode == "pstats":
+        return "application/octet-stream", marshal.dumps(stats)
+    if not stats:
+        return "text/plain", "No samples\n"
+    output = io.StringIO()
+    pstats.Stats(_SampledProfile(stats), stream=output).sort_stats("cumulative").print_stats(TEXT_LIMIT)
+    return "text/plain", output.getvalue()
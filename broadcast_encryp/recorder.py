@@ -0,0 +1,335 @@
+"""Recording of still-encrypted frames, for rewind and incident replay.
+
+Each stream's frame messages are appended exactly as received (still
+encrypted, never decoded) to segment files under ``--record-dir``. Segments
+are preallocated and memory-mapped, so recording a frame is one copy into the
+map. A sidecar index holds one fixed-size entry per frame:
+
+    sequence(8) received_at(8) offset(8) length(4) epoch(2) flags(1)
+
+It is also kept in memory as arrays, so a replay finds its first frame by time
+or sequence with a binary search and reads frames as views of the map.
+
+Replays need a stream's keys long after the KeyManager has expired them, so
+every segment also stores the frame key, nonce prefix and AEAD of each epoch
+it holds, sealed under the recording key (``--record-key-file``, created on
+first use and kept outside the record directory). The KEM secret those keys
+were derived from is never stored. Anyone with the recordings but not that
+key learns nothing about the video.
+
+A new segment starts when the current one is full and whenever the publisher
+starts a new session (its sequence numbers restart and its epochs are
+renumbered), so each segment's sequences and epochs are unambiguous. The
+oldest segments are deleted beyond ``max_segments`` per stream.
+
+Only the worker that ingests a stream writes its recording, and only the
+writer trims a segment file to the frames it holds, when it finishes it.
+Loading segments from disk never changes them, since another process may
+still have them mapped for writing.
+"""
+import bisect
+import glob
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+from array import array
+from urllib.parse import quote, unquote
+
+import wire
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from crypto_common.frame_crypto import FrameCipher, KEY_SIZE
+
+INDEX_ENTRY = struct.Struct("!QdQIHB")
+SEALED_KEY = struct.Struct("!HB12s16sH")  # epoch, AEAD, nonce, tag, length; then the sealed frame key || nonce prefix
+AEAD_IDS = ["chacha20-poly1305", "aes-gcm"]  # Stored as the index (see crypto_common.suites)
+
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+DEFAULT_MAX_SEGMENTS = 16
+INDEX_FLUSH_INTERVAL = 1.0  # Seconds of index a crash can lose at most; keyframes are flushed at once
+RECORDING_KEY_SIZE = 32
+
+
+def load_recording_key(path):
+    """The recording key in ``path``, generated (readable by the owner only) if the file does not exist."""
+    try:
+        with open(path, "rb") as f:
+            return f.read(RECORDING_KEY_SIZE)
+    except FileNotFoundError:
+        key = os.urandom(RECORDING_KEY_SIZE)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            return load_recording_key(path)  # Another cluster worker got there first
+        with os.fdopen(fd, "wb") as f:
+            f.write(key)
+        return key
+
+
+class Segment:
+    """One segment file, its in-memory index and the epoch keys its frames were sealed under."""
+
+    def __init__(self, base, mapped, used, writable):
+        self.base = base
+        self.map = mapped
+        self.used = used
+        self.writable = writable
+        self.sequences = array("Q")
+        self.times = array("d")
+        self.offsets = array("Q")
+        self.lengths = array("I")
+        self.epochs = array("H")
+        self.flags = array("B")
+        self.frame_keys = {}  # epoch -> (frame key, nonce prefix or b"" for frames that carry nonces, AEAD name)
+        self._index_file = None
+        self._keys_file = None
+        self._index_flushed = 0.0  # received_at of the last index flush
+
+    @classmethod
+    def create(cls, base, size):
+        with open(base + ".seg", "w+b") as f:
+            f.truncate(size)  # Preallocate
+            mapped = mmap.mmap(f.fileno(), size)
+        segment = cls(base, mapped, 0, True)
+        segment._index_file = open(base + ".idx", "ab")
+        segment._keys_file = open(base + ".keys", "ab")
+        return segment
+
+    @classmethod
+    def load(cls, base, cipher):
+        """Open a segment read-only, mapping only the frames its index holds."""
+        segment = cls(base, None, 0, False)
+        with open(base + ".idx", "rb") as f:
+            index = f.read()
+        for entry in INDEX_ENTRY.iter_unpack(index[:len(index) - len(index) % INDEX_ENTRY.size]):
+            segment._add_entry(*entry)
+            segment.used = max(segment.used, entry[2] + entry[3])
+        with open(base + ".keys", "rb") as f:
+            keys = f.read()
+        offset = 0
+        while offset + SEALED_KEY.size <= len(keys):
+            epoch, aead, nonce, tag, length = SEALED_KEY.unpack_from(keys, offset)
+            offset += SEALED_KEY.size
+            try:
+                opened = bytes(cipher.decrypt(nonce, keys[offset:offset + length], tag))
+                segment.frame_keys[epoch] = (opened[:KEY_SIZE], opened[KEY_SIZE:], AEAD_IDS[aead])
+            except ValueError:
+                logging.error(f"Recording key does not open the keys of {base}")
+            offset += length
+        if segment.used:
+            with open(base + ".seg", "rb") as f:
+                segment.map = mmap.mmap(f.fileno(), segment.used, access=mmap.ACCESS_READ)
+        return segment
+
+    def _add_entry(self, sequence, received_at, offset, length, epoch, flags):
+        self.sequences.append(sequence)
+        self.times.append(received_at)
+        self.offsets.append(offset)
+        self.lengths.append(length)
+        self.epochs.append(epoch)
+        self.flags.append(flags)
+
+    def __len__(self):
+        return len(self.sequences)
+
+    def fits(self, size):
+        return self.writable and self.used + size <= len(self.map)
+
+    def append(self, frame, message, received_at):
+        size = len(message)
+        offset = self.used
+        self.map[offset:offset + size] = message
+        self.used += size
+        self._add_entry(frame.sequence, received_at, offset, size, frame.epoch, frame.flags)
+        self._index_file.write(INDEX_ENTRY.pack(frame.sequence, received_at, offset, size, frame.epoch, frame.flags))
+        # The frame is already in the map; without its index entry a crash would trim it away on load
+        if frame.flags & wire.FLAG_KEYFRAME or received_at - self._index_flushed >= INDEX_FLUSH_INTERVAL:
+            self._index_file.flush()
+            self._index_flushed = received_at
+
+    def add_key(self, epoch, frame_key, nonce_prefix, aead, cipher):
+        if epoch in self.frame_keys:
+            return
+        self.frame_keys[epoch] = (bytes(frame_key), bytes(nonce_prefix), aead)
+        nonce, sealed, tag = cipher.encrypt(bytes(frame_key) + bytes(nonce_prefix))
+        entry = SEALED_KEY.pack(epoch, AEAD_IDS.index(aead), nonce, tag, len(sealed))
+        self._keys_file.write(entry + bytes(sealed))
+        self._keys_file.flush()
+
+    def finish(self):
+        """Stop appending and trim the file to the frames it holds. The map stays open for replays."""
+        if not self.writable:
+            return
+        self.writable = False
+        self._index_file.close()
+        self._keys_file.close()
+        self.map.flush()
+        try:
+            os.truncate(self.base + ".seg", self.used)  # Nothing reads the map past ``used``
+        except OSError as e:
+            logging.warning(f"Could not trim recording segment {self.base}: {e}")  # Mapped files on Windows
+
+    def entry(self, index):
+        """``(sequence, received_at, epoch, flags, message view)`` of the frame at ``index``."""
+        offset, length = self.offsets[index], self.lengths[index]
+        return (self.sequences[index], self.times[index], self.epochs[index], self.flags[index],
+                memoryview(self.map)[offset:offset + length])
+
+    def keyframe_at_or_before(self, index):
+        while index > 0 and not self.flags[index] & wire.FLAG_KEYFRAME:
+            index -= 1
+        return index
+
+    def delete(self):
+        self.finish()
+        try:
+            if self.map is not None:
+                self.map.close()
+        except BufferError:
+            pass  # A replay still holds a view; the map goes when it does
+        for extension in (".seg", ".idx", ".keys"):
+            try:
+                os.remove(self.base + extension)
+            except OSError as e:
+                logging.warning(f"Could not delete {self.base + extension}: {e}")
+
+
+class Recording:
+    """All segments of one stream, oldest first."""
+
+    def __init__(self, directory, segment_size, max_segments, cipher):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.cipher = cipher
+        self.segments = []
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        for index_path in sorted(glob.glob(os.path.join(directory, "*.idx"))):
+            base = index_path[:-len(".idx")]
+            try:
+                segment = Segment.load(base, self.cipher)
+            except (OSError, ValueError) as e:
+                logging.error(f"Skipping unreadable recording segment {base}: {e}")
+                continue
+            if len(segment):
+                self.segments.append(segment)
+
+    def record(self, frame, message, received_at, frame_key, nonce_prefix, aead):
+        if len(message) > self.segment_size:
+            logging.warning(f"Frame {frame.sequence} is larger than a recording segment; not recorded")
+            return
+        with self.lock:
+            current = self.segments[-1] if self.segments else None
+            new_session = current is not None and len(current) and frame.sequence < current.sequences[-1]
+            if current is None or new_session or not current.fits(len(message)):
+                current = self._start_segment(received_at)
+            current.add_key(frame.epoch, frame_key, nonce_prefix, aead, self.cipher)
+            current.append(frame, message, received_at)
+
+    def _start_segment(self, received_at):
+        if self.segments:
+            self.segments[-1].finish()
+        base = os.path.join(self.directory, f"{int(received_at * 1000):015d}")
+        while os.path.exists(base + ".idx"):
+            base += "_"
+        segment = Segment.create(base, self.segment_size)
+        self.segments.append(segment)
+        while len(self.segments) > self.max_segments:
+            self.segments.pop(0).delete()
+        return segment
+
+    def range(self):
+        """``(first, last)`` recorded times, or None if nothing is recorded."""
+        with self.lock:
+            segments = [segment for segment in self.segments if len(segment)]
+            if not segments:
+                return None
+            return segments[0].times[0], segments[-1].times[-1]
+
+    def seek(self, at_time=None, sequence=None):
+        """Position ``(segment, index)`` of the first frame to replay, backed up to a keyframe.
+
+        ``at_time`` finds the first frame received at or after it; ``sequence``
+        the frame with that sequence number in the newest session holding it.
+        Returns None if there is no such frame.
+        """
+        with self.lock:
+            segments = [segment for segment in self.segments if len(segment)]
+            if not segments:
+                return None
+            if sequence is not None:
+                for segment in reversed(segments):
+                    if segment.sequences[0] <= sequence <= segment.sequences[-1]:
+                        return segment, segment.keyframe_at_or_before(bisect.bisect_left(segment.sequences, sequence))
+                return None
+            starts = [segment.times[0] for segment in segments]
+            position = max(0, bisect.bisect_right(starts, at_time) - 1)
+            segment = segments[position]
+            index = bisect.bisect_left(segment.times, at_time)
+            if index == len(segment):
+                if position + 1 == len(segments):
+                    return None
+                segment, index = segments[position + 1], 0
+            return segment, segment.keyframe_at_or_before(index)
+
+    def next_position(self, segment, index):
+        """The position after ``(segment, index)``, following into newer segments; None at the end for now."""
+        with self.lock:
+            if index + 1 < len(segment):
+                return segment, index + 1
+            if segment in self.segments:
+                position = self.segments.index(segment)
+                for newer in self.segments[position + 1:]:
+                    if len(newer):
+                        return newer, 0
+            return None
+
+    def finish(self):
+        with self.lock:
+            if self.segments:
+                self.segments[-1].finish()
+
+
+class Recorder:
+    """Recordings of every stream, under one directory."""
+
+    def __init__(self, directory, key, segment_size=DEFAULT_SEGMENT_SIZE, max_segments=DEFAULT_MAX_SEGMENTS):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max(1, max_segments)
+        self.cipher = FrameCipher(key)
+        self.recordings = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def recording(self, stream_id, create=True):
+        """The stream's Recording, loading what is on disk the first time. None if absent and not ``create``."""
+        with self._lock:
+            recording = self.recordings.get(stream_id)
+            if recording is None:
+                path = os.path.join(self.directory, quote(stream_id, safe=""))
+                if not create and not os.path.isdir(path):
+                    return None
+                recording = self.recordings[stream_id] = Recording(path, self.segment_size, self.max_segments,
+                                                                   self.cipher)
+            return recording
+
+    def record(self, stream_id, frame, message, received_at, frame_key, nonce_prefix, aead):
+        try:
+            self.recording(stream_id).record(frame, message, received_at, frame_key, nonce_prefix, aead)
+        except OSError as e:
+            logging.error(f"Failed to record frame {frame.sequence} of stream {stream_id}: {e}")
+
+    def finish(self, stream_id):
+        recording = self.recordings.get(stream_id)
+        if recording is not None:
+            recording.finish()
+
+    def streams(self):
+        """Stream ids with recordings on disk."""
+        return sorted(unquote(name) for name in os.listdir(self.directory)
+                      if os.path.isdir(os.path.join(self.directory, name)))
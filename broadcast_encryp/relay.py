@@ -0,0 +1,1130 @@
+"""Transport-independent state and event handling for the broadcast server.
+
+``Relay`` owns everything the server knows about streams and viewers and
+implements each Socket.IO event as a method taking the caller's sid. State
+that several worker processes must agree on goes through a state backend
+(see ``state_backend.py``). The
+Flask-SocketIO threading server (``broadcast.py``) and the asyncio/ASGI server
+(``broadcast_asgi.py``) are thin adapters around it that supply a transport:
+
+    transport.emit(event, data, to=None)
+    transport.enter_room(sid, room)
+    transport.leave_room(sid, room)
+    transport.start_stream(relay, stream_id)
+"""
+import asyncio
+import base64
+import logging
+import math
+import os
+import pickle
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+import wire
+from cluster import shard_for, worker_urls
+from frame_buffer import FrameBuffer, DROP_OLDEST
+from frame_cache import FrameCache
+from key_manager import KeyManager
+from metrics import RelayMetrics
+from recorder import Recorder, load_recording_key
+from pipeline import (FramePipeline, StaticLadder, cipher_for, render_ladder, render_static_ladder,
+                      reuse_static_ladder, scale_ladder, timed)
+from renditions import AUTO, DEFAULT_LADDER, E2E, THUMBNAIL_EVERY, THUMBNAILS, Ladder, Selection, parse_ladder
+from state_backend import LocalBackend, connect_backend
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from crypto_common import suites
+from crypto_common.codec import TileCodec
+from crypto_common.frame_crypto import NONCE_SIZE
+from crypto_common.session import ReplayWindow
+
+NAMESPACE = "/video"
+
+# Backpressure signalling towards publishers
+BACKPRESSURE_INTERVAL = 1.0  # Minimum seconds between repeated signals
+BACKPRESSURE_HIGH_WATER = 0.75  # Fraction of the buffer that counts as congested
+
+# How decrypted frames become the output rendition
+RELAY_MODES = ["passthrough", "transcode"]
+
+# How often cached keys are expired and due rekeys requested
+KEY_MAINTENANCE_INTERVAL = 1.0
+
+# Minimum seconds between asking a tile codec publisher for a keyframe
+KEYFRAME_REQUEST_INTERVAL = 1.0
+
+# Frames that reuse one rendered static preview while decryption is off
+STATIC_REUSE = 5
+
+# Viewer batches (broadcast_frames) are sent early once they hold this many bytes
+BATCH_MAX_BYTES = 1024 * 1024
+
+# Latency samples taken from one delivery report
+MAX_LATENCY_SAMPLES = 256
+
+# Frames per stream whose receive times are kept for latency metrics (more than are ever queued or in flight)
+FRAME_CLOCKS = 64
+
+# Suite of publishers that offer none (they predate cipher suites)
+LEGACY_SUITE = "kyber+chacha20-poly1305"
+
+# Replays of recorded streams: how far back by default, the longest pause replayed as-is,
+# and how long to wait for new frames once a replay has caught up with the live stream
+REPLAY_DEFAULT_SECONDS = 30.0
+REPLAY_MAX_GAP = 2.0
+REPLAY_IDLE = 5.0
+
+
+def stream_room(stream_id, rendition):
+    return f"stream:{stream_id}:{rendition}"
+
+
+def make_executor(render_pool="thread", workers=16):
+    if render_pool == "process":
+        return ProcessPoolExecutor(max_workers=workers)
+    return ThreadPoolExecutor(max_workers=workers)
+
+
+class Relay:
+    def __init__(self, transport, executor, queue_size=8, drop_policy=DROP_OLDEST, inflight=4,
+                 render_pool="thread", backend=None, worker_index=0, cluster_urls=None, keys=None,
+                 relay_mode="passthrough", ladder=None, batch_interval=0.0, recorder=None, aead="auto"):
+        self.transport = transport
+        self.executor = executor
+        self.queue_size = queue_size
+        self.drop_policy = drop_policy
+        self.inflight = inflight
+        self.render_pool = render_pool
+        self.relay_mode = relay_mode
+        self.ladder = ladder or Ladder(parse_ladder(DEFAULT_LADDER))
+
+        # Scale-out: shared state, and which worker ingests which stream
+        self.backend = backend or LocalBackend()
+        self.worker_index = worker_index
+        self.cluster_urls = cluster_urls or []
+        self.remote_watchers = {}  # stream_id -> {other worker: renditions its viewers want}
+        for stream_id, workers in self.backend.watchers().items():
+            workers.discard(worker_index)
+            if workers:
+                # Until they say otherwise, assume they want everything
+                everything = set(self.ladder.names) | {THUMBNAILS}
+                self.remote_watchers[stream_id] = {worker: set(everything) for worker in workers}
+        self.backend.subscribe(self.on_bus_message)
+
+        # Cipher suites: every KEM is accepted; the AEAD preferred is the fastest here unless --aead says otherwise
+        self.aead = aead
+        logging.info(f"AEAD preference: {', '.join(suites.aead_preference(aead))}")  # Benchmarks them once
+        self.stream_aeads = {}  # stream_id -> AEAD its publisher negotiated
+        self.keys = keys or KeyManager()  # Key epochs per stream; outlive the publisher's connection
+        self.replay_windows = {}  # stream_id -> ReplayWindow; sequence numbers carry on across epochs
+        self.counter_nonce_streams = set()  # Streams sending sequence-derived nonces (wire v2+)
+        self.frame_queues = {}
+        self.client_streams = {}  # publisher sid -> streams it publishes (one connection may carry many)
+        self.viewers = {}  # stream_id -> {rendition (or THUMBNAILS): set of viewer sids}
+        self.selections = {}  # viewer sid -> Selection of the stream it watches
+        self.thumbnail_streams = {}  # viewer sid -> streams shown in its grid
+        self.sent_frames = {}  # (stream_id, rendition) -> frames sent, for automatic selection
+        self.viewers_lock = threading.Lock()
+        self.frame_cache = FrameCache(max_bytes=64 * 1024 * 1024, frames_per_stream=2)
+        self.backpressure_state = {}  # stream_id -> {"active", "sent_at", "dropped"}
+        self.tile_decoders = {}  # stream_id -> TileCodec holding the stream's current picture
+        self.e2e_streams = set()  # Streams sealed for their viewers only: forwarded as received, never decrypted
+        self.keyframe_requested = {}  # stream_id -> when a keyframe was last asked for
+
+        # Streams shown as encrypted static instead of being decrypted, toggled per stream
+        self.decryption_disabled = set()
+        self.static_previews = {}  # stream_id -> {"sequence", "data"} of the last static preview
+
+        # Batched fan-out: frames collected per viewer and sent as one broadcast_frames message per tick
+        self.batch_interval = batch_interval
+        self.outbox = {}  # viewer sid -> [frame dicts]
+        self.outbox_bytes = {}  # viewer sid -> bytes waiting
+        self.outbox_lock = threading.Lock()
+        if batch_interval > 0:
+            threading.Thread(target=self.flush_batches, daemon=True).start()
+
+        # Metrics for /metrics, and each recent frame's [captured_at, received_at, dequeued_at] wall-clock times
+        self.metrics = RelayMetrics()
+        self.metrics.collectors.append(self.collect_metrics)
+        self.frame_clocks = {}  # stream_id -> OrderedDict of sequence -> times
+
+        # Recording of still-encrypted frames (see recorder.py), and each replaying viewer's stop event
+        self.recorder = recorder
+        self.replays = {}  # viewer sid -> threading.Event
+        self.forwarded_replays = set()  # Our viewers whose replays run on the stream's owning worker
+
+        threading.Thread(target=self.maintain_keys, daemon=True).start()
+
+    # Socket.IO events
+
+    def connect(self, sid):
+        logging.info("Client connected to /video")
+        self.transport.emit("rendition_ladder", self.ladder.describe(), to=sid)
+        self.transport.emit("stream_list_update", self.backend.streams())
+
+    def disconnect(self, sid):
+        logging.info(f"Client {sid} disconnected from /video")
+        self.remove_viewer(sid)
+        self.stop_replay(sid)
+        streams = self.client_streams.pop(sid, ())
+        for stream_id in streams:
+            # Keys stay cached until they expire, so the publisher can resume
+            self.backend.remove_stream(stream_id)
+            self.e2e_streams.discard(stream_id)
+            if self.recorder is not None:
+                self.recorder.finish(stream_id)
+            self.counter_nonce_streams.discard(stream_id)
+            if stream_id in self.frame_queues:
+                self.frame_queues.pop(stream_id).close()
+            self.backpressure_state.pop(stream_id, None)
+            self.frame_cache.drop_stream(stream_id)
+            self.tile_decoders.pop(stream_id, None)
+            self.keyframe_requested.pop(stream_id, None)
+            for key in [key for key in self.sent_frames if key[0] == stream_id]:
+                self.sent_frames.pop(key, None)
+            self.frame_clocks.pop(stream_id, None)
+            self.metrics.remove_stream(stream_id)
+        if streams:
+            self.announce_streams()
+
+    def select_stream(self, sid, data):
+        """Watch a stream, at a named rendition or (the default) one picked from delivery reports."""
+        stream_id = data["stream_id"]
+        self.stop_replay(sid)  # Back to live
+        previous = self.selections.pop(sid, None)
+        if previous is not None:
+            self.unsubscribe(sid, previous.stream_id, previous.rendition)
+        e2e = stream_id in self.e2e_streams
+        rendition = E2E if e2e else data.get("rendition", AUTO)
+        selection = self.selections[sid] = Selection(self.ladder, stream_id, rendition)
+        self.subscribe(sid, stream_id, selection.rendition)
+        logging.info(f"Client {sid} now watching stream {stream_id} at {selection.rendition}")
+        self.announce_rendition(sid, selection)
+        if e2e:
+            # The page must get the group key from the publisher before it can show anything
+            self.transport.emit("e2e_required", {"stream_id": stream_id}, to=sid)
+        self.transport.emit("decryption_status", {"stream_id": stream_id,
+                                                  "enabled": self.decrypt_enabled(stream_id)}, to=sid)
+
+    def watch_thumbnails(self, sid, data):
+        """Subscribe a viewer's stream grid to low-rate thumbnails of the given streams."""
+        wanted = set(data["stream_ids"])
+        current = self.thumbnail_streams.get(sid, set())
+        for stream_id in current - wanted:
+            self.unsubscribe(sid, stream_id, THUMBNAILS)
+        for stream_id in wanted - current:
+            self.subscribe(sid, stream_id, THUMBNAILS)
+        self.thumbnail_streams[sid] = wanted
+
+    def delivery_report(self, sid, data):
+        """A viewer's count of frames received since its last report; may move it up or down the ladder.
+
+        Reports also carry the capture-to-arrival latency of the frames the page received.
+        """
+        selection = self.selections.get(sid)
+        if selection is not None and data.get("stream_id") == selection.stream_id:
+            # Only for the stream the viewer watches, so clients cannot invent metric labels
+            samples = data.get("latency")
+            for latency in samples[:MAX_LATENCY_SAMPLES] if isinstance(samples, list) else ():
+                if isinstance(latency, (int, float)) and math.isfinite(latency):
+                    self.metrics.viewer_latency_seconds.observe(max(0.0, latency), selection.stream_id)
+        if selection is None or data.get("stream_id") != selection.stream_id \
+                or data.get("rendition") != selection.rendition:
+            return  # About a subscription that has since changed
+        frames = data.get("frames")
+        if not isinstance(frames, int) or isinstance(frames, bool) or frames < 0:
+            return
+        sent = self.sent_frames.get((selection.stream_id, selection.rendition), 0)
+        rendition = selection.on_report(frames, sent)
+        if rendition is None:
+            return
+        logging.info(f"Client {sid} switching from {selection.rendition} to {rendition}")
+        self.unsubscribe(sid, selection.stream_id, selection.rendition)
+        selection.switch(rendition)
+        self.subscribe(sid, selection.stream_id, rendition)
+        self.announce_rendition(sid, selection)
+
+    def register_stream(self, sid, data):
+        stream_id = data["stream_id"]
+        if not self.owns(stream_id):
+            url = self.cluster_urls[shard_for(stream_id, len(self.cluster_urls))]
+            logging.info(f"Redirecting stream {stream_id} to {url}")
+            self.transport.emit("stream_redirect", {"stream_id": stream_id, "url": url}, to=sid)
+            return
+        if self.backend.add_stream(stream_id, self.worker_index):
+            self.client_streams.setdefault(sid, set()).add(stream_id)
+            logging.info(f"New stream registered: {stream_id} by client {sid}"
+                         f"{' (end-to-end encrypted)' if data.get('e2e') else ''}")
+            self.set_e2e(stream_id, bool(data.get("e2e")))
+            self.backend.publish({"type": "e2e_stream", "stream_id": stream_id, "e2e": bool(data.get("e2e"))})
+            if data.get("e2e"):
+                self.replay_windows[stream_id] = ReplayWindow()  # No key exchange to reset it
+            self.announce_streams()
+        elif stream_id not in self.client_streams.get(sid, ()):
+            if data.get("e2e"):
+                # No key exchange follows that could prove this is the same publisher reconnecting
+                self.transport.emit("stream_rejected", {"stream_id": stream_id,
+                                                        "error": "Stream is published by another client"}, to=sid)
+            else:
+                logging.info(f"Stream {stream_id} is already registered; {sid} can take it over by resuming")
+
+    def take_over_stream(self, sid, stream_id):
+        """Move a stream to its publisher's new connection; the old one no longer removes it on disconnect."""
+        for streams in list(self.client_streams.values()):
+            streams.discard(stream_id)
+        self.client_streams.setdefault(sid, set()).add(stream_id)
+        logging.info(f"Stream {stream_id} taken over by client {sid}")
+
+    def get_stream_list(self, sid):
+        self.transport.emit("stream_list_update", self.backend.streams(), to=sid)
+
+    def key_exchange(self, sid, data):
+        """Resume a cached session if the request proves it holds one, else run a KEM exchange.
+
+        The cipher suite is negotiated from the request's offer (see
+        ``crypto_common.suites``) every time. Only the stream's publisher may
+        run a full exchange: with ``rekey`` set it adds a new epoch next to
+        the current one, otherwise it replaces the stream's keys. Anyone else
+        is refused with ``stream_rejected`` unless it proves a resumption
+        ticket, which moves the stream to its connection (a publisher that
+        reconnected before its old connection was seen to drop).
+        """
+        try:
+            client_data = pickle.loads(data)
+            stream_id = client_data["stream_id"]
+            if not self.owns(stream_id):
+                return  # The publisher has been redirected to the owning worker
+            logging.debug(f"Key exchange for stream {stream_id} started")
+            suite = suites.negotiate(client_data.get("suites", [LEGACY_SUITE]), suites.KEMS, self.aead)
+            if suite is None:
+                logging.error(f"No acceptable cipher suite offered for stream {stream_id}: {client_data.get('suites')}")
+                return
+
+            response = {"stream_id": stream_id, "resumed": False, "suite": suites.suite_name(suite)}
+            resumed = None
+            if "ticket" in client_data:
+                resumed = self.keys.resume(
+                    stream_id,
+                    base64.b64decode(client_data["ticket"]),
+                    base64.b64decode(client_data["salt"]),
+                    base64.b64decode(client_data["proof"]),
+                )
+            publisher = stream_id in self.client_streams.get(sid, ())
+            if resumed is None and not publisher:
+                logging.warning(f"Refusing key exchange for stream {stream_id} from {sid}, which does not publish it")
+                self.transport.emit("stream_rejected", {"stream_id": stream_id,
+                                                        "error": "Stream is published by another client"}, to=sid)
+                return
+            if resumed is not None:
+                if not publisher:
+                    # The publisher reconnected before its old connection was seen to drop
+                    self.take_over_stream(sid, stream_id)
+                epoch, server_salt, shared_secret = resumed
+                response["resumed"] = True
+                response["salt"] = base64.b64encode(server_salt).decode("utf-8")
+            else:
+                client_public_key = base64.b64decode(client_data["public_key"])
+                ciphertext, shared_secret = suites.kem(suite.kem).encaps(client_public_key)
+                if not client_data.get("rekey"):
+                    # A new publisher: forget the old epochs and start a fresh replay window
+                    self.keys.drop(stream_id)
+                    self.replay_windows[stream_id] = ReplayWindow()
+                epoch, ticket = self.keys.establish(stream_id, shared_secret)
+                response["ciphertext"] = base64.b64encode(ciphertext).decode("utf-8")
+                response["ticket"] = base64.b64encode(ticket).decode("utf-8")
+
+            self.stream_aeads[stream_id] = suite.aead
+            self.backend.set_secret(stream_id, (epoch, shared_secret, suite.aead))
+            response["epoch"] = epoch
+            self.transport.emit("key_exchange_response", pickle.dumps(response), to=sid)
+            logging.info(f"Key exchange completed for stream {stream_id} "
+                         f"(epoch {epoch}, {suites.suite_name(suite)}, {'resumed' if resumed else 'new key'})")
+        except Exception as e:
+            logging.error(f"Error handling key exchange: {e}")
+
+    def video_frame(self, sid, data):
+        stream_id = None
+        received_at = time.time()
+        try:
+            frame = wire.decode_message(data)
+            stream_id = frame.stream_id
+            if stream_id not in self.client_streams.get(sid, ()):
+                logging.warning(f"Dropping frame of stream {stream_id} from {sid}, which does not publish it")
+                return
+            if frame.flags & wire.FLAG_E2E:
+                self.forward_e2e(sid, frame, data, received_at)
+                return
+            if self.keys.lookup(stream_id, frame.epoch) is None and self.backend.distributed:
+                stored = self.backend.get_secret(stream_id)
+                if stored:
+                    epoch, shared_secret, aead = stored
+                    self.keys.adopt(stream_id, epoch, shared_secret)
+                    self.stream_aeads[stream_id] = aead
+
+            keys = self.keys.lookup(stream_id, frame.epoch)
+            if keys is None:
+                logging.error(f"No key for stream {stream_id} epoch {frame.epoch}")
+                return
+
+            if frame.nonce is None:
+                # Cheap early drop of replays; frames are marked once they authenticate
+                self.counter_nonce_streams.add(stream_id)
+                window = self.replay_windows.setdefault(stream_id, ReplayWindow())
+                if not window.check(frame.sequence):
+                    logging.warning(f"Dropping replayed frame {frame.sequence} for stream {stream_id}")
+                    return
+
+            # Create a bounded buffer for the stream if it doesn't exist
+            if stream_id not in self.frame_queues:
+                self.frame_queues[stream_id] = FrameBuffer(self.queue_size, self.drop_policy)
+                self.transport.start_stream(self, stream_id)
+
+            self.record_received(frame, received_at)
+            if self.recorder is not None:
+                # Stored as received: still encrypted, with the epoch's frame key sealed alongside
+                shared_secret, session = keys
+                if frame.nonce is None:
+                    frame_key, nonce_prefix = session.key, session.nonce_prefix
+                else:
+                    frame_key, nonce_prefix = shared_secret[:32], b""  # Legacy frames are sealed under the secret
+                self.recorder.record(stream_id, frame, data, received_at, frame_key, nonce_prefix,
+                                     self.aead_for(stream_id))
+
+            # Add the frame to the stream's buffer, dropping per policy when full
+            ingest = self.frame_queues[stream_id]
+            ingest.put(frame, keyframe=bool(frame.flags & wire.FLAG_KEYFRAME))
+            self.signal_backpressure(stream_id, ingest, sid)
+
+        except Exception as e:
+            logging.error(f"Failed to enqueue frame for stream {stream_id}: {e}")
+
+    def video_frames(self, sid, data):
+        """A batch of frame messages, possibly of several streams, sent as one message."""
+        try:
+            messages = wire.unpack_batch(data)
+        except wire.WireFormatError as e:
+            logging.error(f"Bad frame batch from {sid}: {e}")
+            return
+        for message in messages:
+            self.video_frame(sid, message)
+
+    def forward_e2e(self, sid, frame, data, received_at):
+        """Send an end-to-end encrypted frame to its viewers as received: the relay holds no key for it."""
+        stream_id = frame.stream_id
+        # Unauthenticated here, but only the publisher's own connection gets this far (see video_frame)
+        window = self.replay_windows.setdefault(stream_id, ReplayWindow())
+        if not window.mark(frame.sequence):
+            logging.warning(f"Dropping replayed frame {frame.sequence} for stream {stream_id}")
+            return
+        self.record_received(frame, received_at)
+        if E2E in self.wanted_renditions(stream_id):
+            captured_at = frame.timing.captured_at if frame.timing is not None else None
+            self.emit_frame(stream_id, frame.sequence, data if isinstance(data, bytes) else bytes(data), E2E,
+                            captured_at=captured_at)
+
+    def e2e_join(self, sid, data):
+        """A viewer's public key for the group key of the end-to-end stream it watches; passed to the publisher."""
+        stream_id = data.get("stream_id")
+        selection = self.selections.get(sid)
+        if selection is None or selection.stream_id != stream_id or selection.rendition != E2E:
+            return
+        self.to_publisher("e2e_join", {"stream_id": stream_id, "viewer": sid, "public_key": data["public_key"]})
+
+    def e2e_key(self, sid, data):
+        """The group key wrapped by a publisher for one viewer; passed on unopened."""
+        stream_id = data.get("stream_id")
+        if stream_id not in self.client_streams.get(sid, ()):
+            return
+        message = {key: data[key] for key in ("stream_id", "epoch", "public_key", "nonce", "wrapped")}
+        self.transport.emit("e2e_key", message, to=data["viewer"])
+        if self.backend.distributed:
+            self.backend.publish({"type": "e2e_key", "viewer": data["viewer"], "message": message})
+
+    def to_publisher(self, event, message):
+        """Send an event to a stream's publisher, through the bus if another worker ingests it."""
+        sid = self.publishers().get(message["stream_id"])
+        if sid is not None:
+            self.transport.emit(event, message, to=sid)
+        elif self.backend.distributed:
+            self.backend.publish({"type": "to_publisher", "event": event, "message": message})
+
+    def set_e2e(self, stream_id, e2e):
+        if e2e:
+            self.e2e_streams.add(stream_id)
+            # A new publisher has a new group key: its viewers join again
+            with self.viewers_lock:
+                sids = list(self.viewers.get(stream_id, {}).get(E2E, ()))
+            for sid in sids:
+                self.transport.emit("e2e_required", {"stream_id": stream_id}, to=sid)
+        else:
+            self.e2e_streams.discard(stream_id)
+
+    def toggle_decryption(self, sid, data=None):
+        """Toggle decryption of one stream: the one named, or else the one the viewer watches."""
+        stream_id = (data or {}).get("stream_id")
+        if stream_id is None:
+            selection = self.selections.get(sid)
+            if selection is None:
+                return
+            stream_id = selection.stream_id
+        enabled = not self.decrypt_enabled(stream_id)
+        self.set_decryption(stream_id, enabled)
+        self.backend.publish({"type": "decryption", "stream_id": stream_id, "enabled": enabled})
+
+    def set_decryption(self, stream_id, enabled):
+        if enabled:
+            self.decryption_disabled.discard(stream_id)
+            self.static_previews.pop(stream_id, None)
+        else:
+            self.decryption_disabled.add(stream_id)
+        logging.info(f"Decryption of stream {stream_id} enabled: {enabled}")
+        self.transport.emit("decryption_status", {"stream_id": stream_id, "enabled": enabled})
+
+    def decrypt_enabled(self, stream_id):
+        return stream_id not in self.decryption_disabled
+
+    def publishers(self):
+        """stream_id -> sid of the connection publishing it."""
+        return {stream_id: sid for sid, streams in list(self.client_streams.items()) for stream_id in list(streams)}
+
+    # Scale-out
+
+    def owns(self, stream_id):
+        """Whether this worker ingests ``stream_id`` (always true outside a cluster)."""
+        if len(self.cluster_urls) < 2:
+            return True
+        return shard_for(stream_id, len(self.cluster_urls)) == self.worker_index
+
+    def announce_streams(self):
+        streams = self.backend.streams()
+        self.transport.emit("stream_list_update", streams)
+        self.backend.publish({"type": "streams", "streams": streams})
+
+    def set_watching(self, stream_id):
+        """Record which renditions this worker's viewers want, so the stream's owner renders them."""
+        renditions = self.local_renditions(stream_id)
+        self.backend.set_watching(self.worker_index, stream_id, bool(renditions))
+        self.backend.publish({"type": "watching", "worker": self.worker_index, "stream_id": stream_id,
+                              "watching": bool(renditions), "renditions": sorted(renditions)})
+
+    def on_bus_message(self, message):
+        """Handle a message published by another worker."""
+        kind = message["type"]
+        if kind == "frame":
+            stream_id = message["stream_id"]
+            if self.local_renditions(stream_id):
+                self.emit_frame(stream_id, message["sequence"], message["frame"], message["rendition"],
+                                forward=False, captured_at=message.get("captured_at"))
+        elif kind == "streams":
+            self.transport.emit("stream_list_update", message["streams"])
+        elif kind == "watching":
+            workers = self.remote_watchers.setdefault(message["stream_id"], {})
+            if message["watching"]:
+                workers[message["worker"]] = set(message["renditions"])
+            else:
+                workers.pop(message["worker"], None)
+        elif kind == "worker_gone":
+            for workers in self.remote_watchers.values():
+                workers.pop(message["worker"], None)
+            self.transport.emit("stream_list_update", message["streams"])
+        elif kind == "decryption":
+            self.set_decryption(message["stream_id"], message["enabled"])
+        elif kind == "e2e_stream":
+            self.set_e2e(message["stream_id"], message["e2e"])
+        elif kind == "to_publisher":
+            sid = self.publishers().get(message["message"]["stream_id"])
+            if sid is not None:
+                self.transport.emit(message["event"], message["message"], to=sid)
+        elif kind == "e2e_key":
+            self.transport.emit("e2e_key", message["message"], to=message["viewer"])  # A no-op unless ours
+        elif kind == "replay_stream":
+            if self.owns(message["data"].get("stream_id")):
+                self.replay_stream(message["viewer"], message["data"], remote=True)
+        elif kind == "stop_replay":
+            self.stop_replay(message["viewer"])
+        elif kind == "to_viewer":
+            self.transport.emit(message["event"], message["message"], to=message["viewer"])  # A no-op unless ours
+
+    # Metrics
+
+    def record_received(self, frame, received_at):
+        """Count an incoming frame and record the publisher's stage timings carried in its header."""
+        stream_id = frame.stream_id
+        metrics = self.metrics
+        metrics.frames_received.inc(stream_id)
+        metrics.bytes_received.inc(stream_id, amount=len(frame.payload))
+        metrics.ingest_rate.mark(stream_id)
+        captured_at = None
+        if frame.timing is not None:
+            captured_at = frame.timing.captured_at
+            metrics.stage_seconds.observe(frame.timing.encode_us / 1e6, stream_id, "encode")
+            metrics.stage_seconds.observe(frame.timing.encrypt_us / 1e6, stream_id, "encrypt")
+            # Across two clocks: only meaningful when they are synchronised
+            metrics.stage_seconds.observe(max(0.0, received_at - frame.timing.sent_at), stream_id, "network")
+        clocks = self.frame_clocks.setdefault(stream_id, OrderedDict())
+        clocks[frame.sequence] = [captured_at, received_at, None]
+        while len(clocks) > FRAME_CLOCKS:
+            clocks.popitem(last=False)
+
+    def record_dequeued(self, frame_data):
+        clock = self.frame_clocks.get(frame_data.stream_id, {}).get(frame_data.sequence)
+        if clock is not None:
+            clock[2] = time.time()
+            self.metrics.stage_seconds.observe(clock[2] - clock[1], frame_data.stream_id, "queue")
+
+    def record_rendered(self, stream_id, sequence, stages, broadcast_seconds):
+        """Record a rendered frame's server stages, and its capture-to-broadcast latency."""
+        for name, seconds in stages.items():
+            self.metrics.stage_seconds.observe(seconds, stream_id, name)
+        self.metrics.stage_seconds.observe(broadcast_seconds, stream_id, "broadcast")
+        clock = self.frame_clocks.get(stream_id, {}).get(sequence)
+        if clock is not None and clock[0] is not None:
+            self.metrics.latency_seconds.observe(max(0.0, time.time() - clock[0]), stream_id)
+
+    def captured_at(self, stream_id, sequence):
+        clock = self.frame_clocks.get(stream_id, {}).get(sequence)
+        return clock[0] if clock is not None else None
+
+    def collect_metrics(self):
+        """Refresh gauges from live state just before /metrics is rendered."""
+        for stream_id, ingest in list(self.frame_queues.items()):
+            self.metrics.queue_depth.set(len(ingest), stream_id)
+            self.metrics.frames_dropped.set(ingest.dropped, stream_id)
+        self.metrics.frame_cache_bytes.set(self.frame_cache.size_bytes)
+        self.metrics.refresh_rates()
+
+    # Key lifetime
+
+    def maintain_keys(self):
+        """Expire cached keys and ask publishers to rekey once their epoch is old enough."""
+        while True:
+            time.sleep(KEY_MAINTENANCE_INTERVAL)
+            try:
+                self.keys.expire()
+                for stream_id in list(self.replay_windows):
+                    if stream_id not in self.e2e_streams and self.keys.current(stream_id) is None:
+                        self.replay_windows.pop(stream_id, None)
+                publishers = self.publishers()
+                for stream_id in self.keys.due_for_rekey():
+                    if stream_id in publishers:
+                        logging.info(f"Requesting rekey for stream {stream_id}")
+                        self.transport.emit("rekey_request", {"stream_id": stream_id}, to=publishers[stream_id])
+            except Exception as e:
+                logging.error(f"Key maintenance failed: {e}")
+
+    # Viewers and backpressure
+
+    def subscribe(self, sid, stream_id, rendition):
+        self.transport.enter_room(sid, stream_room(stream_id, rendition))
+        with self.viewers_lock:
+            sids = self.viewers.setdefault(stream_id, {}).setdefault(rendition, set())
+            first_viewer = not sids
+            sids.add(sid)
+        if first_viewer:
+            self.set_watching(stream_id)
+
+        # Late joiners get the current picture straight from the cache
+        cached_rendition = self.ladder.thumbnail.name if rendition == THUMBNAILS else rendition
+        cached = self.frame_cache.latest(stream_id, cached_rendition)
+        if cached is not None:
+            sequence, frame = cached
+            message = {"stream_id": stream_id, "sequence": sequence, "rendition": rendition, "frame": frame}
+            if rendition == E2E:
+                message["e2e"] = True
+            self.transport.emit("broadcast_frame", message, to=sid)
+
+    def unsubscribe(self, sid, stream_id, rendition, leave_room=True):
+        if leave_room:
+            self.transport.leave_room(sid, stream_room(stream_id, rendition))
+        if rendition == E2E:
+            # The publisher rotates the group key so this viewer cannot read what follows
+            self.to_publisher("e2e_leave", {"stream_id": stream_id, "viewer": sid})
+        last_viewer = False
+        with self.viewers_lock:
+            renditions = self.viewers.get(stream_id, {})
+            sids = renditions.get(rendition)
+            if sids is not None and sid in sids:
+                sids.discard(sid)
+                if not sids:
+                    del renditions[rendition]
+                    last_viewer = True
+                if not renditions:
+                    self.viewers.pop(stream_id, None)
+        if last_viewer:
+            self.set_watching(stream_id)
+
+    def announce_rendition(self, sid, selection):
+        self.transport.emit("rendition_changed", {"stream_id": selection.stream_id,
+                                                  "rendition": selection.rendition,
+                                                  "auto": selection.auto}, to=sid)
+
+    def remove_viewer(self, sid):
+        """Drop all of a disconnected viewer's subscriptions."""
+        selection = self.selections.pop(sid, None)
+        if selection is not None:
+            self.unsubscribe(sid, selection.stream_id, selection.rendition, leave_room=False)
+        for stream_id in self.thumbnail_streams.pop(sid, ()):
+            self.unsubscribe(sid, stream_id, THUMBNAILS, leave_room=False)
+        with self.outbox_lock:
+            self.outbox.pop(sid, None)
+            self.outbox_bytes.pop(sid, None)
+
+    def local_renditions(self, stream_id):
+        with self.viewers_lock:
+            return set(self.viewers.get(stream_id, ()))
+
+    def wanted_renditions(self, stream_id):
+        """Renditions (and THUMBNAILS) wanted by viewers on any worker."""
+        wanted = self.local_renditions(stream_id)
+        for renditions in list(self.remote_watchers.get(stream_id, {}).values()):
+            wanted |= renditions
+        return wanted
+
+    def has_viewers(self, stream_id):
+        return bool(self.wanted_renditions(stream_id))
+
+    def signal_backpressure(self, stream_id, ingest, sid):
+        """Tell a publisher to slow down while its buffer is congested, and when it clears."""
+        now = time.monotonic()
+        state = self.backpressure_state.setdefault(stream_id, {"active": False, "sent_at": 0.0, "dropped": 0})
+        congested = ingest.dropped > state["dropped"] or len(ingest) >= ingest.capacity * BACKPRESSURE_HIGH_WATER
+        state["dropped"] = ingest.dropped
+
+        if congested and now - state["sent_at"] < BACKPRESSURE_INTERVAL:
+            return
+        if not congested and not state["active"]:
+            return
+
+        state["active"] = congested
+        state["sent_at"] = now
+        self.transport.emit(
+            "backpressure",
+            {
+                "stream_id": stream_id,
+                "congested": congested,
+                "queue_depth": len(ingest),
+                "capacity": ingest.capacity,
+                "dropped": ingest.dropped,
+            },
+            to=sid,
+        )
+        if congested:
+            logging.warning(f"Backpressure on stream {stream_id}: {ingest.dropped} frames dropped so far")
+
+    # Per-stream frame processing
+
+    def renditions_for(self, frame_data):
+        """The renditions to produce for a frame, or None to skip it.
+
+        Grid thumbnails only get every Nth frame. Tile codec frames are still
+        decoded while anyone watches, since every frame builds on the last.
+        """
+        wanted = self.wanted_renditions(frame_data.stream_id)
+        if not wanted:
+            return None
+        if THUMBNAILS in wanted and frame_data.sequence % THUMBNAIL_EVERY:
+            wanted.discard(THUMBNAILS)
+        renditions = self.ladder.select(wanted)
+        if not renditions and not frame_data.flags & wire.FLAG_TILES:
+            return None
+        return renditions
+
+    def request_keyframe(self, stream_id):
+        now = time.monotonic()
+        if now - self.keyframe_requested.get(stream_id, 0.0) < KEYFRAME_REQUEST_INTERVAL:
+            return
+        self.keyframe_requested[stream_id] = now
+        sid = self.publishers().get(stream_id)
+        if sid is not None:
+            logging.info(f"Requesting a keyframe for stream {stream_id}")
+            self.transport.emit("keyframe_request", {"stream_id": stream_id}, to=sid)
+
+    def aead_for(self, stream_id):
+        return self.stream_aeads.get(stream_id, suites.DEFAULT_AEAD)
+
+    def decode_tiles(self, frame_data, key):
+        """Decrypt a tile codec frame and paint it onto the stream's picture, in arrival order.
+
+        Returns a copy of the picture, or None while waiting for a keyframe.
+        """
+        stream_id = frame_data.stream_id
+        decoder = self.tile_decoders.setdefault(stream_id, TileCodec())
+        try:
+            started = time.perf_counter()
+            plaintext = cipher_for(key, self.aead_for(stream_id)).decrypt(frame_data.nonce, frame_data.payload,
+                                                                          frame_data.tag)
+            decrypted = time.perf_counter()
+            picture = decoder.decode(plaintext)
+            self.metrics.stage_seconds.observe(decrypted - started, stream_id, "decrypt")
+            self.metrics.stage_seconds.observe(time.perf_counter() - decrypted, stream_id, "decode")
+        except Exception as e:
+            logging.error(f"Failed to decrypt or decode tile frame for stream {stream_id}: {e}")
+            picture = None
+        if picture is None:
+            self.request_keyframe(stream_id)
+            return None
+        return picture.copy()  # The next frame paints over the decoder's own picture
+
+    def render_job(self, frame_data, renditions):
+        """Pick the render function and arguments for a frame, or None to drop it."""
+        keys = self.keys.lookup(frame_data.stream_id, frame_data.epoch)
+        if keys is None:
+            logging.warning(f"Dropping frame {frame_data.sequence} of stream {frame_data.stream_id}: key expired")
+            return None
+        shared_secret, session = keys
+        if frame_data.nonce is None:
+            # Counter nonce: rebuild it from the sequence number under the session key
+            frame_data = frame_data._replace(nonce=session.nonce(frame_data.sequence))
+            key = session.key
+        else:
+            key = shared_secret[:32]
+        decrypt = self.decrypt_enabled(frame_data.stream_id)
+        if decrypt and frame_data.flags & wire.FLAG_TILES:
+            picture = self.decode_tiles(frame_data, key)
+            if picture is None or not renditions:
+                return None
+            return scale_ladder, (picture, renditions)
+        if self.render_pool == "process":
+            # Worker processes need a picklable copy of the ciphertext
+            frame_data = frame_data._replace(payload=bytes(frame_data.payload))
+        if decrypt:
+            # Decrypt and decode once, then scale into each rendition
+            return render_ladder, (frame_data, key, renditions, self.relay_mode == "passthrough",
+                                   self.aead_for(frame_data.stream_id))
+        # Decryption disabled: color static from the encrypted data, reused for a few frames
+        names = [rendition.name for rendition in renditions]
+        preview = self.static_previews.get(frame_data.stream_id)
+        if preview and preview["data"] and 0 <= frame_data.sequence - preview["sequence"] < STATIC_REUSE:
+            return reuse_static_ladder, (preview["data"], names)
+        self.static_previews[frame_data.stream_id] = {"sequence": frame_data.sequence, "data": None}
+        return render_static_ladder, (frame_data, names)
+
+    def process_frames(self, stream_id):
+        """Threaded stream worker: render frames on the executor and emit them in order."""
+        ingest = self.frame_queues[stream_id]
+        pipeline = FramePipeline(self.executor, self.inflight)
+
+        while True:
+            # Emit whatever has finished rendering, in sequence order
+            for sequence, data in pipeline.ready():
+                self.emit_rendered(stream_id, sequence, data)
+
+            # Poll while jobs are in flight so finished frames are not held back
+            frame_data = ingest.get(timeout=0.005 if pipeline.pending else None)
+            if frame_data is None:
+                if ingest.closed:
+                    break
+                continue
+
+            # Nobody is watching: skip decrypt/resize/re-encode entirely
+            renditions = self.renditions_for(frame_data)
+            if renditions is None:
+                continue
+
+            self.record_dequeued(frame_data)
+            job = self.render_job(frame_data, renditions)
+            if job is None:
+                continue
+            fn, fn_args = job
+            for sequence, data in pipeline.submit(frame_data.sequence, timed, fn, *fn_args):
+                self.emit_rendered(stream_id, sequence, data)
+
+        pipeline.drain()
+
+    async def process_frames_async(self, stream_id):
+        """Asyncio stream worker: same pipeline as process_frames, without a thread per stream."""
+        ingest = self.frame_queues[stream_id]
+        jobs = asyncio.Queue(maxsize=max(1, self.inflight))  # Render futures in arrival order
+
+        async def submit():
+            while True:
+                frame_data = await ingest.get_async()
+                if frame_data is None:
+                    break
+                renditions = self.renditions_for(frame_data)
+                if renditions is None:
+                    continue
+                self.record_dequeued(frame_data)
+                if frame_data.flags & wire.FLAG_TILES:
+                    # Decrypting and painting tiles is CPU work, but must stay in order: one frame at a time
+                    loop = asyncio.get_running_loop()
+                    job = await loop.run_in_executor(None, self.render_job, frame_data, renditions)
+                else:
+                    job = self.render_job(frame_data, renditions)
+                if job is None:
+                    continue
+                fn, fn_args = job
+                future = asyncio.wrap_future(self.executor.submit(timed, fn, *fn_args))
+                await jobs.put((frame_data.sequence, future))
+            await jobs.put(None)
+
+        async def emit():
+            last_sequence = -1
+            while True:
+                job = await jobs.get()
+                if job is None:
+                    break
+                sequence, future = job
+                try:
+                    data = await future
+                except Exception as e:
+                    logging.error(f"Render job for frame {sequence} failed: {e}")
+                    continue
+                if sequence < last_sequence:
+                    continue  # Arrived out of order and already superseded
+                last_sequence = sequence
+                self.emit_rendered(stream_id, sequence, data)
+
+        await asyncio.gather(submit(), emit())
+
+    def emit_rendered(self, stream_id, sequence, result):
+        """Send a finished render job's ``(renditions, stage timings)`` to viewers."""
+        data, stages = result
+        if data is None:
+            logging.error(f"Failed to process frame for stream {stream_id}")
+            return
+        # Only frames that decrypted and authenticated count; static previews never opened the ciphertext
+        window = self.replay_windows.get(stream_id)
+        if (stream_id in self.counter_nonce_streams and window and not isinstance(data, StaticLadder)
+                and not window.mark(sequence)):
+            logging.warning(f"Dropping replayed frame {sequence} for stream {stream_id}")
+            return
+        preview = self.static_previews.get(stream_id)
+        if preview and preview["sequence"] == sequence and data:
+            preview["data"] = next(iter(data.values()))
+        started = time.perf_counter()
+        captured_at = self.captured_at(stream_id, sequence)
+        for rendition, frame in data.items():
+            self.emit_frame(stream_id, sequence, frame, rendition, captured_at=captured_at)
+        self.record_rendered(stream_id, sequence, stages, time.perf_counter() - started)
+
+    def emit_frame(self, stream_id, sequence, data, rendition, forward=True, captured_at=None):
+        """Cache an encoded JPEG and send it to the rendition's viewers as a binary attachment.
+
+        ``captured_at`` (the publisher's wall-clock capture time) lets pages report glass-to-glass latency.
+        """
+        self.frame_cache.put(stream_id, sequence, rendition, data)
+        rooms = [rendition]
+        if rendition == self.ladder.thumbnail.name:
+            rooms.append(THUMBNAILS)  # Stream grids share the smallest rendition
+        for room in rooms:
+            message = {
+                "stream_id": stream_id,
+                "sequence": sequence,
+                "rendition": room,
+                "frame": data,
+            }
+            if captured_at is not None:
+                message["captured_at"] = captured_at
+            if room == E2E:
+                message["e2e"] = True  # Still sealed: the page decrypts it
+            if self.batch_interval > 0:
+                self.queue_batched(stream_id, room, message)
+            else:
+                self.transport.emit("broadcast_frame", message, to=stream_room(stream_id, room))
+            key = (stream_id, room)
+            self.sent_frames[key] = self.sent_frames.get(key, 0) + 1
+            self.metrics.frames_sent.inc(stream_id, room)
+            self.metrics.bytes_sent.inc(stream_id, room, amount=len(data))
+            self.metrics.output_rate.mark(key)
+        # Viewers on other workers get the same encoded bytes over the bus
+        remote = list(self.remote_watchers.get(stream_id, {}).values())
+        if forward and any(renditions.intersection(rooms) for renditions in remote):
+            self.backend.publish({"type": "frame", "stream_id": stream_id, "sequence": sequence,
+                                  "rendition": rendition, "frame": data, "captured_at": captured_at})
+
+    def queue_batched(self, stream_id, rendition, message):
+        """Add a frame to the batch of every local viewer of the rendition."""
+        with self.viewers_lock:
+            sids = list(self.viewers.get(stream_id, {}).get(rendition, ()))
+        size = len(message["frame"])
+        full = []
+        with self.outbox_lock:
+            for sid in sids:
+                self.outbox.setdefault(sid, []).append(message)
+                self.outbox_bytes[sid] = self.outbox_bytes.get(sid, 0) + size
+                if self.outbox_bytes[sid] >= BATCH_MAX_BYTES:
+                    full.append((sid, self.outbox.pop(sid)))
+                    del self.outbox_bytes[sid]
+        for sid, frames in full:
+            self.transport.emit("broadcast_frames", {"frames": frames}, to=sid)
+
+    def flush_batches(self):
+        """Send each viewer's waiting frames as one broadcast_frames message, once per batch interval."""
+        while True:
+            time.sleep(self.batch_interval)
+            with self.outbox_lock:
+                outbox, self.outbox, self.outbox_bytes = self.outbox, {}, {}
+            for sid, frames in outbox.items():
+                try:
+                    self.transport.emit("broadcast_frames", {"frames": frames}, to=sid)
+                except Exception as e:
+                    logging.error(f"Failed to send frame batch to {sid}: {e}")
+
+    # Replay of recorded streams
+
+    def replay_stream(self, sid, data, remote=False):
+        """Replay a recorded stream to one viewer, instead of the live one.
+
+        Starts ``seconds_back`` before now (the default), at a wall-clock time
+        (``from_time``) or at a frame (``from_sequence``), and plays on, at
+        ``speed`` times the recorded pace, until it catches up with the live
+        stream or the viewer stops it.
+
+        Only the worker that ingests a stream reads its recording: other
+        workers pass the request on over the bus, and the owner sends the
+        replay back the same way (``remote``).
+        """
+        self.stop_replay(sid)
+        stream_id = data.get("stream_id")
+        if stream_id is not None and not remote and not self.owns(stream_id):
+            self.forwarded_replays.add(sid)
+            self.backend.publish({"type": "replay_stream", "viewer": sid, "data": data})
+            return
+        recording = None
+        if self.recorder is not None and stream_id is not None:
+            recording = self.recorder.recording(stream_id, create=False)
+        if recording is None:
+            self.to_viewer(sid, "replay_error", {"stream_id": stream_id, "error": "Stream is not recorded here"},
+                           remote)
+            return
+        if data.get("from_sequence") is not None:
+            position = recording.seek(sequence=int(data["from_sequence"]))
+        else:
+            from_time = data.get("from_time")
+            if from_time is None:
+                from_time = time.time() - float(data.get("seconds_back", REPLAY_DEFAULT_SECONDS))
+            position = recording.seek(at_time=float(from_time))
+        if position is None:
+            self.to_viewer(sid, "replay_error", {"stream_id": stream_id, "error": "Nothing recorded from there"},
+                           remote)
+            return
+        rendition = self.ladder.by_name.get(data.get("rendition"), self.ladder.default)
+        speed = max(0.1, float(data.get("speed", 1.0)))
+        stop = self.replays[sid] = threading.Event()
+        start, end = recording.range()
+        segment, index = position
+        logging.info(f"Client {sid} replaying stream {stream_id} from frame {segment.sequences[index]}")
+        self.to_viewer(sid, "replay_started", {"stream_id": stream_id, "rendition": rendition.name,
+                                               "from": segment.times[index], "start": start, "end": end}, remote)
+        threading.Thread(target=self.run_replay,
+                         args=(sid, stream_id, recording, position, rendition, speed, stop, remote),
+                         daemon=True).start()
+
+    def stop_replay(self, sid, data=None):
+        stop = self.replays.pop(sid, None)
+        if stop is not None:
+            stop.set()
+        if sid in self.forwarded_replays:
+            self.forwarded_replays.discard(sid)
+            self.backend.publish({"type": "stop_replay", "viewer": sid})
+
+    def to_viewer(self, sid, event, message, remote=False):
+        """Send an event to a viewer, through the bus if it is connected to another worker."""
+        if remote:
+            self.backend.publish({"type": "to_viewer", "viewer": sid, "event": event, "message": message})
+        else:
+            self.transport.emit(event, message, to=sid)
+
+    def run_replay(self, sid, stream_id, recording, position, rendition, speed, stop, remote=False):
+        """Replay thread: decrypt and render recorded frames, paced as they were received."""
+        segment, index = position
+        decoder = TileCodec()  # The replay's own picture, apart from the live stream's
+        anchor = None  # (recorded time, monotonic time) pacing is measured from
+        previous = None
+        try:
+            while not stop.is_set():
+                sequence, received_at, epoch, flags, message = segment.entry(index)
+                if anchor is None or received_at - previous > REPLAY_MAX_GAP:
+                    anchor = (received_at, time.monotonic())  # Skip over pauses in the recording
+                previous = received_at
+                delay = anchor[1] + (received_at - anchor[0]) / speed - time.monotonic()
+                if delay > 0 and stop.wait(delay):
+                    break
+                frame = self.render_recorded(segment, stream_id, message, epoch, rendition, decoder)
+                del message  # Views pin the segment's map
+                if frame is not None:
+                    self.to_viewer(sid, "broadcast_frame", {"stream_id": stream_id, "sequence": sequence,
+                                                            "rendition": rendition.name, "frame": frame,
+                                                            "replay": True, "recorded_at": received_at}, remote)
+                following = recording.next_position(segment, index)
+                waited = 0.0
+                while following is None and waited < REPLAY_IDLE and not stop.is_set():
+                    stop.wait(0.05)
+                    waited += 0.05
+                    following = recording.next_position(segment, index)
+                if following is None:
+                    break
+                segment, index = following
+        except (ValueError, IndexError) as e:
+            logging.error(f"Replay of stream {stream_id} for {sid} stopped: {e}")  # Segment deleted under it
+        if self.replays.get(sid) is stop:
+            del self.replays[sid]
+            self.to_viewer(sid, "replay_ended", {"stream_id": stream_id}, remote)
+
+    def render_recorded(self, segment, stream_id, message, epoch, rendition, decoder):
+        """Decrypt and render one recorded frame message for a replay. Returns JPEG bytes or None."""
+        if epoch not in segment.frame_keys:
+            return None
+        key, nonce_prefix, aead = segment.frame_keys[epoch]
+        try:
+            frame_data = wire.decode_message(message)
+        except Exception as e:
+            logging.error(f"Unreadable recorded frame of stream {stream_id}: {e}")
+            return None
+        if frame_data.nonce is None:
+            # Counter nonce, as StreamSession.nonce builds it
+            nonce = nonce_prefix + frame_data.sequence.to_bytes(NONCE_SIZE - len(nonce_prefix), "big")
+            frame_data = frame_data._replace(nonce=nonce)
+        if frame_data.flags & wire.FLAG_TILES:
+            try:
+                plaintext = cipher_for(key, aead).decrypt(frame_data.nonce, frame_data.payload, frame_data.tag)
+                picture = decoder.decode(plaintext)
+            except Exception as e:
+                logging.error(f"Failed to decrypt or decode recorded tile frame of stream {stream_id}: {e}")
+                return None
+            if picture is None:
+                return None  # Waiting for a keyframe
+            rendered = scale_ladder(picture, (rendition,))
+        else:
+            rendered = render_ladder(frame_data, key, (rendition,), self.relay_mode == "passthrough", aead) or {}
+        return rendered.get(rendition.name)
+
+
+def create_recorder(args):
+    """The Recorder for ``--record-dir``, or None when recording is off."""
+    if not args.record_dir:
+        return None
+    os.makedirs(args.record_dir, exist_ok=True)
+    return Recorder(args.record_dir, load_recording_key(args.record_key_file),
+                    segment_size=int(args.record_segment_mb * 1024 * 1024), max_segments=args.record_segments)
+
+
+def create_relay(transport, args):
+    """Build a Relay configured from the broadcast server's command-line arguments."""
+    worker_index = args.worker_index or 0
+    cluster_urls = []
+    if args.cluster > 1:
+        cluster_urls = worker_urls(args.public_host, args.port - worker_index, args.cluster)
+    return Relay(
+        transport,
+        make_executor(args.render_pool, args.workers),
+        queue_size=args.queue_size,
+        drop_policy=args.drop_policy,
+        inflight=args.inflight,
+        render_pool=args.render_pool,
+        backend=connect_backend(args.backend, worker_index),
+        worker_index=worker_index,
+        cluster_urls=cluster_urls,
+        keys=KeyManager(ttl=args.key_ttl, grace=args.key_grace, rekey_after=args.rekey_interval),
+        relay_mode=args.relay_mode,
+        ladder=Ladder(parse_ladder(args.renditions)),
+        batch_interval=args.batch_ms / 1000,
+        recorder=create_recorder(args),
+        aead=args.aead,
+    )
@@ -0,0 +1,109 @@
+"""Rendition ladder and per-viewer rendition choice.
+
+Each stream is scaled once per frame into every rendition somebody is
+watching (see ``pipeline.render_ladder``), and each viewer is sent one of
+them: the one it asked for, or in automatic mode one picked from the
+delivery reports its page sends back.
+"""
+from collections import namedtuple
+
+Rendition = namedtuple("Rendition", ["name", "width", "height", "quality"])
+
+DEFAULT_LADDER = "1080p=1920x1080@85,720p=1280x720@80,360p=640x360@75,180p=320x180@60"
+
+# Pseudo-rendition for the stream grid: the smallest rendition, at a reduced frame rate
+THUMBNAILS = "thumbnails"
+THUMBNAIL_EVERY = 10  # Grid previews get every Nth frame
+
+AUTO = "auto"
+
+# Pseudo-rendition of end-to-end encrypted streams: the publisher's ciphertext, forwarded as received
+E2E = "e2e"
+
+# Automatic selection thresholds, as received/sent frame ratios per report
+STEP_DOWN_BELOW = 0.85
+STEP_UP_ABOVE = 0.97
+STEP_UP_AFTER = 3  # Consecutive good reports before trying a larger rendition
+
+
+def parse_ladder(spec):
+    """Parse ``name=WIDTHxHEIGHT@QUALITY,...`` into renditions, largest first."""
+    ladder = []
+    for entry in spec.split(","):
+        name, _, rest = entry.strip().partition("=")
+        size, _, quality = rest.partition("@")
+        width, _, height = size.lower().partition("x")
+        if not name or not width or not height:
+            raise ValueError(f"Bad rendition: {entry!r} (expected name=WIDTHxHEIGHT@QUALITY)")
+        ladder.append(Rendition(name, int(width), int(height), int(quality or 80)))
+    if len({rendition.name for rendition in ladder}) != len(ladder):
+        raise ValueError("Rendition names must be unique")
+    return sorted(ladder, key=lambda rendition: rendition.width * rendition.height, reverse=True)
+
+
+class Ladder:
+    def __init__(self, renditions):
+        self.renditions = list(renditions)
+        self.by_name = {rendition.name: rendition for rendition in self.renditions}
+        self.thumbnail = self.renditions[-1]
+        # Viewers start at the largest rendition no wider than the old fixed 640x360 output
+        self.default = next((rendition for rendition in self.renditions if rendition.width <= 640),
+                            self.thumbnail)
+
+    @property
+    def names(self):
+        return [rendition.name for rendition in self.renditions]
+
+    def select(self, names):
+        """The renditions (largest first) needed for a set of wanted names, THUMBNAILS included."""
+        return tuple(rendition for rendition in self.renditions
+                     if rendition.name in names or (THUMBNAILS in names and rendition is self.thumbnail))
+
+    def step(self, name, direction):
+        """The next smaller (direction 1) or larger (direction -1) rendition name, or None."""
+        index = self.names.index(name) + direction
+        if 0 <= index < len(self.renditions):
+            return self.renditions[index].name
+        return None
+
+    def describe(self):
+        return {
+            "renditions": [{"name": r.name, "width": r.width, "height": r.height} for r in self.renditions],
+            "default": self.default.name,
+            "thumbnail": self.thumbnail.name,
+        }
+
+
+class Selection:
+    """A viewer's current rendition of the stream it watches, and how it has been keeping up."""
+
+    def __init__(self, ladder, stream_id, rendition=AUTO):
+        self.ladder = ladder
+        self.stream_id = stream_id
+        self.auto = rendition not in ladder.by_name and rendition != E2E
+        self.rendition = ladder.default.name if self.auto else rendition
+        self.sent_at_report = None  # Frames sent of this rendition as of the last report
+        self.good_reports = 0
+
+    def switch(self, rendition):
+        self.rendition = rendition
+        self.sent_at_report = None
+        self.good_reports = 0
+
+    def on_report(self, received, sent_total):
+        """Update from a delivery report. Returns the rendition to switch to, or None."""
+        sent = None if self.sent_at_report is None else sent_total - self.sent_at_report
+        self.sent_at_report = sent_total
+        if not self.auto or not sent:
+            return None
+        ratio = received / sent
+        if ratio < STEP_DOWN_BELOW:
+            return self.ladder.step(self.rendition, 1)
+        if ratio >= STEP_UP_ABOVE:
+            self.good_reports += 1
+            if self.good_reports >= STEP_UP_AFTER:
+                self.good_reports = 0
+                return self.ladder.step(self.rendition, -1)
+        else:
+            self.good_reports = 0
+        return None
@@ -0,0 +1,321 @@
+"""Shared state and message bus for running several broadcast workers.
+
+A backend holds what every worker needs to agree on (registered streams and
+their owning worker, key material, which workers have viewers for which
+streams) and carries messages between workers (rendered frames, stream list
+changes, decryption toggles).
+
+``LocalBackend`` keeps everything in-process and is what a single server
+uses. ``Broker`` serves the same state over a ``multiprocessing.connection``
+listener (a Unix socket, TCP port or Windows named pipe) and
+``BrokerBackend`` is the worker-side client for it. A broker can also run on
+a thread inside a test process.
+
+Brokers hand out every stream's key material and unpickle what workers send,
+so connections are authenticated with a secret key: ``run_cluster`` makes a
+random one per cluster and passes it to its workers in the
+``BROADCAST_BROKER_AUTHKEY`` environment variable (hex). Workers connecting to
+a broker started some other way need the variable set to the same key.
+"""
+import itertools
+import logging
+import os
+import threading
+from multiprocessing.connection import Listener, Client
+
+AUTHKEY_ENV = "BROADCAST_BROKER_AUTHKEY"
+AUTHKEY_SIZE = 32
+CALL_TIMEOUT = 10.0
+
+# State methods a broker will run on behalf of its workers
+BACKEND_METHODS = {
+    "add_stream", "remove_stream", "streams", "stream_owner",
+    "set_secret", "get_secret", "remove_secret",
+    "set_watching", "watchers",
+}
+
+
+class LocalBackend:
+    """In-process state. Messages are published to other workers, so here they go nowhere."""
+
+    distributed = False
+
+    def __init__(self):
+        self._streams = {}  # stream_id -> owning worker, in registration order
+        self._secrets = {}
+        self._watching = {}  # stream_id -> set of workers with viewers
+        self._lock = threading.Lock()
+
+    def add_stream(self, stream_id, worker_id):
+        """Register a stream. Returns False if it is already registered."""
+        with self._lock:
+            if stream_id in self._streams:
+                return False
+            self._streams[stream_id] = worker_id
+            return True
+
+    def remove_stream(self, stream_id):
+        with self._lock:
+            self._streams.pop(stream_id, None)
+            self._secrets.pop(stream_id, None)
+
+    def streams(self):
+        with self._lock:
+            return list(self._streams)
+
+    def stream_owner(self, stream_id):
+        return self._streams.get(stream_id)
+
+    def set_secret(self, stream_id, secret):
+        with self._lock:
+            self._secrets[stream_id] = secret
+
+    def get_secret(self, stream_id):
+        return self._secrets.get(stream_id)
+
+    def remove_secret(self, stream_id):
+        with self._lock:
+            self._secrets.pop(stream_id, None)
+
+    def set_watching(self, worker_id, stream_id, watching):
+        with self._lock:
+            workers = self._watching.setdefault(stream_id, set())
+            if watching:
+                workers.add(worker_id)
+            else:
+                workers.discard(worker_id)
+                if not workers:
+                    del self._watching[stream_id]
+
+    def watchers(self):
+        with self._lock:
+            return {stream_id: set(workers) for stream_id, workers in self._watching.items()}
+
+    def remove_worker(self, worker_id):
+        """Forget everything a worker owned. Returns the streams it was ingesting."""
+        with self._lock:
+            streams = [stream_id for stream_id, owner in self._streams.items() if owner == worker_id]
+            for stream_id in streams:
+                del self._streams[stream_id]
+                self._secrets.pop(stream_id, None)
+            for stream_id in list(self._watching):
+                self._watching[stream_id].discard(worker_id)
+                if not self._watching[stream_id]:
+                    del self._watching[stream_id]
+            return streams
+
+    def publish(self, message):
+        pass
+
+    def subscribe(self, handler):
+        pass
+
+    def close(self):
+        pass
+
+
+class _Peer:
+    def __init__(self, conn):
+        self.conn = conn
+        self.worker_id = None
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        with self.lock:
+            self.conn.send(message)
+
+
+class Broker:
+    """Serves a LocalBackend to worker processes and relays their messages."""
+
+    def __init__(self, address, authkey):
+        if isinstance(address, str) and os.path.exists(address):
+            os.unlink(address)  # Stale Unix socket from a previous run
+        self.listener = Listener(address, authkey=authkey)
+        self.address = self.listener.address
+        self.state = LocalBackend()
+        self._peers = set()
+        self._lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def serve_forever(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                break  # Listener closed
+            except Exception as e:
+                logging.error(f"Broker rejected a connection: {e}")
+                continue
+            peer = _Peer(conn)
+            with self._lock:
+                self._peers.add(peer)
+            threading.Thread(target=self._serve, args=(peer,), daemon=True).start()
+
+    def _serve(self, peer):
+        while True:
+            try:
+                message = peer.conn.recv()
+            except (EOFError, OSError):
+                break
+            kind = message[0]
+            if kind == "hello":
+                peer.worker_id = message[1]
+            elif kind == "call":
+                _, call_id, method, args = message
+                try:
+                    if method not in BACKEND_METHODS:
+                        raise ValueError(f"Unknown backend method: {method}")
+                    peer.send(("reply", call_id, getattr(self.state, method)(*args)))
+                except Exception as e:
+                    peer.send(("error", call_id, str(e)))
+            elif kind == "publish":
+                self._forward(message[1], exclude=peer)
+
+        with self._lock:
+            self._peers.discard(peer)
+        if peer.worker_id is not None:
+            streams = self.state.remove_worker(peer.worker_id)
+            logging.warning(f"Broadcast worker {peer.worker_id} left; dropped streams {streams}")
+            self._forward({"type": "worker_gone", "worker": peer.worker_id, "streams": self.state.streams()})
+
+    def _forward(self, message, exclude=None):
+        with self._lock:
+            peers = [peer for peer in self._peers if peer is not exclude]
+        for peer in peers:
+            try:
+                peer.send(("event", message))
+            except (EOFError, OSError):
+                pass  # Its reader thread will clean up
+
+    def close(self):
+        self.listener.close()
+
+
+class BrokerBackend:
+    """Worker-side client for a Broker. Same interface as LocalBackend."""
+
+    distributed = True
+
+    def __init__(self, address, worker_id, authkey):
+        self.worker_id = worker_id
+        self.conn = Client(address, authkey=authkey)
+        self._send_lock = threading.Lock()
+        self._calls = {}  # call id -> [Event, ok, result]
+        self._ids = itertools.count()
+        self._handlers = []
+        self._send(("hello", worker_id))
+        threading.Thread(target=self._read_loop, daemon=True).start()
+
+    def _send(self, message):
+        with self._send_lock:
+            self.conn.send(message)
+
+    def _read_loop(self):
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                logging.error("Lost connection to the broadcast broker")
+                break
+            kind = message[0]
+            if kind == "event":
+                for handler in self._handlers:
+                    try:
+                        handler(message[1])
+                    except Exception as e:
+                        logging.error(f"Bus handler failed: {e}")
+            elif kind in ("reply", "error"):
+                waiter = self._calls.pop(message[1], None)
+                if waiter is not None:
+                    waiter[1] = kind == "reply"
+                    waiter[2] = message[2]
+                    waiter[0].set()
+
+    def _call(self, method, *args):
+        call_id = next(self._ids)
+        waiter = self._calls[call_id] = [threading.Event(), False, None]
+        self._send(("call", call_id, method, args))
+        if not waiter[0].wait(CALL_TIMEOUT):
+            self._calls.pop(call_id, None)
+            raise TimeoutError(f"Broker did not answer {method}")
+        if not waiter[1]:
+            raise RuntimeError(f"Broker call {method} failed: {waiter[2]}")
+        return waiter[2]
+
+    def add_stream(self, stream_id, worker_id):
+        return self._call("add_stream", stream_id, worker_id)
+
+    def remove_stream(self, stream_id):
+        return self._call("remove_stream", stream_id)
+
+    def streams(self):
+        return self._call("streams")
+
+    def stream_owner(self, stream_id):
+        return self._call("stream_owner", stream_id)
+
+    def set_secret(self, stream_id, secret):
+        return self._call("set_secret", stream_id, secret)
+
+    def get_secret(self, stream_id):
+        return self._call("get_secret", stream_id)
+
+    def remove_secret(self, stream_id):
+        return self._call("remove_secret", stream_id)
+
+    def set_watching(self, worker_id, stream_id, watching):
+        return self._call("set_watching", worker_id, stream_id, watching)
+
+    def watchers(self):
+        return self._call("watchers")
+
+    def publish(self, message):
+        self._send(("publish", message))
+
+    def subscribe(self, handler):
+        """Call ``handler(message)`` for messages from other workers (on the reader thread)."""
+        self._handlers.append(handler)
+
+    def close(self):
+        self.conn.close()
+
+
+def parse_address(spec):
+    """Turn ``unix:/path``, ``tcp:host:port`` or ``pipe:name`` into a connection address."""
+    kind, _, rest = spec.partition(":")
+    if kind == "unix":
+        return rest
+    if kind == "tcp":
+        host, _, port = rest.rpartition(":")
+        return (host, int(port))
+    if kind == "pipe":
+        return rf"\\.\pipe\{rest}"
+    raise ValueError(f"Unknown backend address: {spec}")
+
+
+def new_authkey():
+    return os.urandom(AUTHKEY_SIZE)
+
+
+def authkey_from_env():
+    """The broker key set in the environment, or None."""
+    value = os.environ.get(AUTHKEY_ENV)
+    return bytes.fromhex(value) if value else None
+
+
+def connect_backend(spec, worker_id, authkey=None):
+    """Create the backend named by ``--backend``: ``local`` or a broker address.
+
+    Without ``authkey`` the broker key comes from the environment. Raises
+    ValueError if there is none.
+    """
+    if spec == "local":
+        return LocalBackend()
+    authkey = authkey or authkey_from_env()
+    if not authkey:
+        raise ValueError(f"No broker key: set {AUTHKEY_ENV} to the broker's key (hex)")
+    return BrokerBackend(parse_address(spec), worker_id, authkey)
@@ -1,149 +1,451 @@
 ﻿import socketio
 import base64
+import json
 import logging
 import argparse
-from quantcrypt.kem import Kyber
-from Crypto.Cipher import ChaCha20_Poly1305
+import os
+import sys
 import pickle
-import cv2
 import asyncio
 import concurrent.futures
 import time
+import wire
+from capture import CaptureThread
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from crypto_common.codec import make_codec
+from crypto_common import suites
+from crypto_common.frame_crypto import AesGcmFrameCipher
+from crypto_common.group_key import export_point, fingerprint, new_group_secret, new_identity, wrap_secret
+from crypto_common.session import StreamSession, resume_proof, resumed_secret
 
 logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
 
+DEFAULT_SOURCE = r"C:\Users\Parsa Rezaei\Crypto\broadcast_encryp\videos\BigBuckBunny.mp4"
+
 parser = argparse.ArgumentParser(description="Stream encrypted video to server")
-parser.add_argument('--stream-name', type=str, required=False, help='Unique stream identifier', default="Big Buck Bunny")
-parser.add_argument('--source', type=str, required=False, help="Video source: \"camera\" or file path", default=r"C:\Users\Parsa Rezaei\Crypto\broadcast_encryp\videos\BigBuckBunny.mp4")
+parser.add_argument('--stream-name', type=str, action='append', required=False,
+                    help='Unique stream identifier; repeat once per --source')
+parser.add_argument('--source', type=str, action='append', required=False,
+                    help="Video source: \"camera\", a file path, or synthetic:moving|static|noise[@WxH]; "
+                         "repeat to publish several streams from one process")
+parser.add_argument('--server-url', type=str, default="http://localhost:5000", help='Broadcast server to publish to')
+parser.add_argument('--manifest', type=str, default=None,
+                    help='JSON file listing streams to publish: [{"stream_name": ..., "source": ..., "codec": ...}, ...]')
+parser.add_argument('--frame-size', type=str, default='1280x720',
+                    help='Size frames are sent at, WIDTHxHEIGHT; 640x360 lets the server forward them without re-encoding')
+parser.add_argument('--codec', choices=['jpeg', 'tiles'], default='jpeg',
+                    help='jpeg: every frame whole; tiles: keyframes plus only the tiles that changed')
+parser.add_argument('--wire', choices=['binary', 'pickle'], default='binary', help='Frame message format sent to the server')
+parser.add_argument('--batch-ms', type=float, default=0.0,
+                    help='Send all streams\' frames as one video_frames message every this many ms (0: one message per frame)')
+parser.add_argument('--batch-bytes', type=int, default=1024 * 1024, help='Send a batch early once it holds this many bytes')
+parser.add_argument('--kem', choices=list(suites.KEMS), default='kyber', help='Key exchange offered to the server')
+parser.add_argument('--aead', choices=suites.AEAD_CHOICES, default='auto',
+                    help='Frame cipher to prefer; auto benchmarks them and prefers the fastest on this host')
+parser.add_argument('--e2e', action='store_true',
+                    help='End-to-end encryption: seal frames under a group key only viewers get; the server just forwards them')
 args = parser.parse_args()
+if args.e2e and args.wire != 'binary':
+    parser.error("--e2e needs --wire binary")
 
-STREAM_NAME = args.stream_name
-SOURCE = args.source
-SERVER_URL = "http://localhost:5000"
+FRAME_SIZE = tuple(int(side) for side in args.frame_size.lower().split('x'))
+SERVER_URL = args.server_url
 FPS = 30
-
-kyber = Kyber()
-client_public_key, client_private_key = kyber.keygen()
-shared_secret = None
-
-sio = socketio.AsyncClient(logger=False, engineio_logger=False)
-
-
-@sio.on('connect', namespace='/video')
-async def video_connect():
-    logging.info(f"Connected to /video namespace")
-    await sio.emit('register_stream', {'stream_id': STREAM_NAME}, namespace='/video')
-
-    await sio.emit('key_exchange', pickle.dumps({
-        'public_key': base64.b64encode(client_public_key).decode('utf-8'),
-        'stream_id': STREAM_NAME
-    }), namespace='/video')
-
-
-@sio.on('key_exchange_response', namespace='/video')
-async def handle_key_exchange_response(data):
-    global shared_secret
-    try:
-        response = pickle.loads(data)
-        ciphertext = base64.b64decode(response['ciphertext'])
-        shared_secret = kyber.decaps(client_private_key, ciphertext)
-        logging.info(f"Shared secret established for stream {STREAM_NAME}")
-
-        # Start video streaming task
-        logging.debug("Starting video capture and streaming task")
-        asyncio.create_task(capture_and_send_video())
-    except Exception as e:
-        logging.error(f"Error during key exchange response handling: {e}")
-
-
-async def capture_and_send_video():
-    global shared_secret
-    if shared_secret is None:
-        logging.error("Shared secret not initialized, cannot start video capture")
-        return
-
-    logging.info(f"Starting video capture for stream {STREAM_NAME}")
-    cap = cv2.VideoCapture(0 if SOURCE == "camera" else SOURCE)
-    if not cap.isOpened():
-        logging.error(f"Failed to open video source: {SOURCE}")
-        return
-
-    chacha20_key = shared_secret[:32]
-    executor = concurrent.futures.ThreadPoolExecutor()
-
-    frame_queue = asyncio.Queue(maxsize=50)  # Limit queue size
-    target_frame_time = 1 / FPS  # Time per frame in seconds
-
-    async def producer():
-        """Capture frames and add them to the queue."""
-        while cap.isOpened():
-            start_time = time.time()
-
-            if frame_queue.full():
-                await asyncio.sleep(0.01)  # Wait if the queue is full
-                continue
-
-            ret, frame = cap.read()
-            if not ret:
-                logging.info("End of video stream or error reading frame.")
-                break
-
-            # Resize frame
-            frame = cv2.resize(frame, (1280, 720))
-            await frame_queue.put(frame)
-
-            # Wait to match target FPS
-            elapsed_time = time.time() - start_time
-            wait_time = max(0, target_frame_time - elapsed_time)
-            await asyncio.sleep(wait_time)
-
-        await frame_queue.put(None)  # Sentinel to signal end of stream
-
-    async def consumer():
-        """Process frames and send them to the server."""
+JPEG_QUALITY = 95
+
+# Lowered when the server signals backpressure, restored once it has been quiet
+MIN_FPS = 5
+MIN_JPEG_QUALITY = 40
+RECOVERY_SECONDS = 2.0
+
+# What a server that predates cipher suites uses
+LEGACY_SUITE = "kyber+chacha20-poly1305"
+
+# How long to wait before registering again when the server still holds a stream for another connection
+REGISTER_RETRY_SECONDS = 2.0
+
+# Shared by every stream in the process: one KEM keypair to start from and one encode/encrypt pool.
+# Each stream still gets its own shared secret, since the server encapsulates per stream.
+kem = suites.kem(args.kem)
+client_public_key, client_private_key = kem.keygen()
+executor = concurrent.futures.ThreadPoolExecutor()
+
+# End-to-end mode: the key that wraps group secrets for viewers; their pages show its fingerprint
+identity = new_identity() if args.e2e else None
+
+
+def stream_specs():
+    """(stream name, source, codec) for each stream to publish, from --manifest or --source/--stream-name."""
+    if args.manifest:
+        with open(args.manifest) as f:
+            entries = json.load(f)
+        return [(entry['stream_name'], entry['source'], entry.get('codec', args.codec)) for entry in entries]
+    sources = args.source or [DEFAULT_SOURCE]
+    names = args.stream_name or ["Big Buck Bunny"]
+    if len(sources) > 1 and len(names) == 1:
+        names = [f"{names[0]} {index + 1}" for index in range(len(sources))]
+    if len(names) != len(sources):
+        parser.error("Give one --stream-name per --source")
+    return [(name, source, args.codec) for name, source in zip(names, sources)]
+
+
+def check_specs(specs):
+    if args.e2e and any(codec_name != 'jpeg' for _, _, codec_name in specs):
+        parser.error("--e2e needs the jpeg codec: browsers decode the frames themselves")
+    return specs
+
+
+class Publisher:
+    """One published stream: its source, codec, key session and rate control."""
+
+    def __init__(self, stream_name, source, codec_name):
+        self.stream_name = stream_name
+        self.source = source
+        self.codec = make_codec(codec_name, quality=JPEG_QUALITY)
+        self.connection = None
+
+        self.public_key, self.private_key = client_public_key, client_private_key
+        self.shared_secret = None
+
+        # Current key epoch, swapped in place on rekey or resumption while frames keep flowing
+        self.session = None
+        self.legacy_cipher = None
+        self.resume_ticket = None  # Lets a reconnect skip the KEM exchange while the server still caches our key
+        self.resume_salt = None
+        self.capture_task = None
+        self.e2e_viewers = {}  # End-to-end mode: viewer sid -> its public key for the group secret
+
+        self.target_fps = FPS
+        self.jpeg_quality = JPEG_QUALITY
+        self.last_backpressure = 0.0
+
+    async def emit(self, event, data):
+        await self.connection.sio.emit(event, data, namespace='/video')
+
+    async def register(self):
+        await self.emit('register_stream', {'stream_id': self.stream_name, 'e2e': args.e2e})
+        if args.e2e:
+            # No key for the server; viewers join the new connection's group and get the key from us
+            self.e2e_viewers.clear()
+            await self.rotate_group_key()
+            self.start_capture()
+            return
+        await self.send_key_exchange()
+
+    async def send_key_exchange(self, rekey=False):
+        """Ask for a key; offers to resume the previous session, with a public key in case the server can't."""
+        request = {
+            'public_key': base64.b64encode(self.public_key).decode('utf-8'),
+            'stream_id': self.stream_name,
+            'rekey': rekey,
+            'suites': suites.offer(args.kem, args.aead),
+        }
+        if self.resume_ticket is not None and not rekey:
+            self.resume_salt = os.urandom(16)
+            proof = resume_proof(self.shared_secret, self.resume_ticket, self.resume_salt)
+            request['ticket'] = base64.b64encode(self.resume_ticket).decode('utf-8')
+            request['salt'] = base64.b64encode(self.resume_salt).decode('utf-8')
+            request['proof'] = base64.b64encode(proof).decode('utf-8')
+        await self.emit('key_exchange', pickle.dumps(request))
+
+    def on_key_exchange_response(self, response):
+        if response.get('resumed'):
+            server_salt = base64.b64decode(response['salt'])
+            secret = resumed_secret(self.shared_secret, self.stream_name, self.resume_salt, server_salt)
+        else:
+            ciphertext = base64.b64decode(response['ciphertext'])
+            secret = kem.decaps(self.private_key, ciphertext)
+            self.resume_ticket = base64.b64decode(response['ticket'])
+
+        # Sequence numbers carry on across epochs; skip one in case a frame is being sealed right now
+        first_sequence = self.session.sequence + 1 if self.session is not None else 0
+        self.shared_secret = secret
+        cipher_class = suites.cipher_class(suites.parse(response.get('suite', LEGACY_SUITE)).aead)
+        self.session = StreamSession(secret, self.stream_name, epoch=response['epoch'], first_sequence=first_sequence,
+                                     cipher_class=cipher_class)
+        self.legacy_cipher = cipher_class(secret[:32])  # Random nonces, for --wire pickle
+        logging.info(f"Shared secret established for stream {self.stream_name} "
+                     f"(epoch {self.session.epoch}, {response.get('suite', LEGACY_SUITE)}, "
+                     f"{'resumed' if response.get('resumed') else 'new key'})")
+        self.start_capture()
+
+    def start_capture(self):
+        if self.capture_task is None or self.capture_task.done():
+            logging.debug(f"Starting video capture and streaming task for {self.stream_name}")
+            self.capture_task = asyncio.create_task(self.capture_and_send_video())
+
+    async def rotate_group_key(self):
+        """End-to-end mode: a new group secret and epoch, given to every current viewer before frames use it."""
+        epoch = (self.session.epoch + 1) % 0x10000 if self.session is not None else 0
+        secret = new_group_secret()
+        await asyncio.gather(*(self.send_group_key(viewer, public_key, secret, epoch)
+                               for viewer, public_key in list(self.e2e_viewers.items())))
+        # Sequence numbers carry on across epochs, as with rekeys
+        first_sequence = self.session.sequence + 1 if self.session is not None else 0
+        self.shared_secret = secret
+        self.session = StreamSession(secret, self.stream_name, epoch=epoch, first_sequence=first_sequence,
+                                     cipher_class=AesGcmFrameCipher)
+        logging.info(f"Group key of stream {self.stream_name} now at epoch {epoch} "
+                     f"for {len(self.e2e_viewers)} viewer(s)")
+
+    async def send_group_key(self, viewer, public_key, secret, epoch):
+        loop = asyncio.get_running_loop()
+        try:
+            wrapped = await loop.run_in_executor(executor, wrap_secret, identity, public_key, secret,
+                                                 self.stream_name, epoch)
+        except ValueError as e:
+            logging.error(f"Viewer {viewer} sent an unusable key for {self.stream_name}: {e}")
+            self.e2e_viewers.pop(viewer, None)
+            return
+        await self.emit('e2e_key', {'stream_id': self.stream_name, 'viewer': viewer, 'epoch': epoch, **wrapped})
+
+    async def on_e2e_join(self, data):
+        self.e2e_viewers[data['viewer']] = data['public_key']
+        await self.send_group_key(data['viewer'], data['public_key'], self.shared_secret, self.session.epoch)
+
+    async def on_e2e_leave(self, data):
+        if self.e2e_viewers.pop(data['viewer'], None) is not None:
+            await self.rotate_group_key()  # So the viewer that left cannot read what follows
+
+    async def on_rekey_request(self):
+        # A fresh keypair for the new epoch, generated off the event loop
+        loop = asyncio.get_running_loop()
+        self.public_key, self.private_key = await loop.run_in_executor(executor, kem.keygen)
+        logging.info(f"Rekeying stream {self.stream_name}")
+        await self.send_key_exchange(rekey=True)
+
+    def on_backpressure(self, data):
+        self.last_backpressure = time.monotonic()
+        self.target_fps = max(MIN_FPS, self.target_fps * 0.75)
+        self.jpeg_quality = max(MIN_JPEG_QUALITY, self.jpeg_quality - 10)
+        logging.warning(f"Server backpressure on {self.stream_name} ({data.get('dropped')} dropped): "
+                        f"lowering to {self.target_fps:.1f} fps, JPEG quality {self.jpeg_quality}")
+
+    def recover_rate(self):
+        """Step FPS and quality back up once the server has been quiet for a while."""
+        if time.monotonic() - self.last_backpressure < RECOVERY_SECONDS:
+            return
+        if self.target_fps < FPS or self.jpeg_quality < JPEG_QUALITY:
+            self.target_fps = min(FPS, self.target_fps + 1)
+            self.jpeg_quality = min(JPEG_QUALITY, self.jpeg_quality + 5)
+            self.last_backpressure = time.monotonic() - RECOVERY_SECONDS / 2  # Pace the recovery
+
+    @staticmethod
+    def timing(captured_at, started, encoded_at):
+        """Stage timings for the frame header, so the server can report where a frame's time went."""
+        return wire.Timing(captured_at, time.time(), int((encoded_at - started) * 1e6),
+                           int((time.perf_counter() - encoded_at) * 1e6))
+
+    async def capture_and_send_video(self):
+        if self.session is None:
+            logging.error("Shared secret not initialized, cannot start video capture")
+            return
+
+        logging.info(f"Starting video capture for stream {self.stream_name}")
+        # Reading and resizing run on the capture thread, paced to target_fps (lowered under backpressure)
+        capture = CaptureThread(self.source, FRAME_SIZE, lambda: self.target_fps, name=self.stream_name)
+        if not capture.start(asyncio.get_running_loop()):
+            return
+
+        writer = wire.FrameWriter(self.stream_name, timing=True)
+        codec = self.codec
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                captured = await capture.get()
+                if captured is None:
+                    break
+                frame, captured_at = captured
+                self.recover_rate()
+                if not self.connection.connected:
+                    continue  # Reconnecting or being redirected; the frame would be stale by then
+
+                # Encode the frame off the event loop
+                codec.quality = self.jpeg_quality
+                started = time.perf_counter()
+                try:
+                    encoded, keyframe = await loop.run_in_executor(executor, codec.encode, frame)
+                except ValueError as e:
+                    logging.error(f"Failed to encode frame: {e}")
+                    continue
+                encoded_at = time.perf_counter()
+                size = memoryview(encoded).nbytes
+                flags = (wire.FLAG_KEYFRAME if keyframe else 0) | (wire.FLAG_TILES if codec.delta else 0)
+                if args.e2e:
+                    flags |= wire.FLAG_E2E
+
+                # Encrypt straight from the encoded buffer into the outgoing message, under the current epoch
+                current = self.session
+                if args.wire == 'binary':
+                    payload = writer.payload(size)
+                    sequence, tag = await loop.run_in_executor(executor, current.encrypt_into, encoded, payload)
+                    timing = self.timing(captured_at, started, encoded_at)
+                    data = writer.finish(sequence, tag, size, flags=flags, epoch=current.epoch, timing=timing)
+                else:
+                    cipher = self.legacy_cipher
+                    nonce, encrypted_frame, tag = await loop.run_in_executor(executor, cipher.encrypt, encoded)
+                    timing = self.timing(captured_at, started, encoded_at)
+                    data = wire.pack_legacy_frame(self.stream_name, current.next_sequence(), nonce, tag,
+                                                  encrypted_frame, epoch=current.epoch, flags=flags, timing=timing)
+
+                # Send the frame
+                await self.connection.send_frame(data)
+                logging.debug(f"Frame sent for stream {self.stream_name}")
+        finally:
+            capture.stop()
+        logging.info(f"Video capture stopped for {self.stream_name} "
+                     f"({capture.delivered} frames, {capture.dropped + capture.replaced} dropped)")
+
+
+class Connection:
+    """One Socket.IO connection to a server, carrying any number of publishers' streams."""
+
+    def __init__(self, url, tasks):
+        self.url = url
+        self.tasks = tasks  # Shared with main(), which waits for every connection to finish
+        self.publishers = {}  # stream name -> Publisher
+        self.connected = False
+        self.batch = []  # Frame messages waiting for the next batch
+        self.batch_bytes = 0
+        self.sio = socketio.AsyncClient(logger=False, engineio_logger=False)
+        self.sio.on('connect', self.on_connect, namespace='/video')
+        self.sio.on('disconnect', self.on_disconnect, namespace='/video')
+        self.sio.on('key_exchange_response', self.on_key_exchange_response, namespace='/video')
+        self.sio.on('rekey_request', self.on_rekey_request, namespace='/video')
+        self.sio.on('keyframe_request', self.on_keyframe_request, namespace='/video')
+        self.sio.on('stream_redirect', self.on_stream_redirect, namespace='/video')
+        self.sio.on('stream_rejected', self.on_stream_rejected, namespace='/video')
+        self.sio.on('backpressure', self.on_backpressure, namespace='/video')
+        self.sio.on('e2e_join', self.on_e2e_join, namespace='/video')
+        self.sio.on('e2e_leave', self.on_e2e_leave, namespace='/video')
+
+    def add(self, publisher):
+        publisher.connection = self
+        self.publishers[publisher.stream_name] = publisher
+
+    async def run(self):
+        flusher = asyncio.create_task(self.flush_batches()) if args.batch_ms > 0 else None
+        try:
+            await self.sio.connect(self.url, namespaces=['/video'])
+            await self.sio.wait()
+        except Exception as e:
+            logging.error(f"Error during connection to {self.url}: {e}")
+        finally:
+            if flusher is not None:
+                flusher.cancel()
+
+    async def send_frame(self, data):
+        """Send a frame message now, or add it to the batch when batching."""
+        if args.batch_ms <= 0:
+            await self.send([data])
+            return
+        self.batch.append(data)
+        self.batch_bytes += len(data)
+        if self.batch_bytes >= args.batch_bytes:
+            await self.flush()
+
+    async def flush(self):
+        if not self.batch:
+            return
+        messages, self.batch, self.batch_bytes = self.batch, [], 0
+        await self.send(messages)
+
+    async def flush_batches(self):
+        """Send whatever every stream has queued, once per batch interval."""
         while True:
-            frame = await frame_queue.get()
-            if frame is None:
-                break
-
-            # Encode and encrypt the frame
-            loop = asyncio.get_event_loop()
-            ret, buffer = cv2.imencode('.jpg', frame)
-            if not ret:
-                logging.error("Failed to encode frame")
-                continue
-
-            cipher = ChaCha20_Poly1305.new(key=chacha20_key)
-            encrypted_frame, tag = await loop.run_in_executor(
-                executor,
-                lambda: cipher.encrypt_and_digest(buffer.tobytes())
-            )
-            nonce = cipher.nonce  # Extract nonce for decryption
-
-            # Prepare data payload
-            data = {
-                'stream_id': STREAM_NAME,
-                'frame': base64.b64encode(encrypted_frame).decode('utf-8'),
-                'nonce': base64.b64encode(nonce).decode('utf-8'),
-                'tag': base64.b64encode(tag).decode('utf-8'),
-            }
-
-            # Send the frame
-            await sio.emit('video_frame', pickle.dumps(data), namespace='/video')
-            logging.debug(f"Frame sent for stream {STREAM_NAME}")
-
-    await asyncio.gather(producer(), consumer())
-
-    cap.release()
-    cv2.destroyAllWindows()
-    logging.info("Video capture stopped")
+            await asyncio.sleep(args.batch_ms / 1000)
+            await self.flush()
+
+    async def send(self, messages):
+        try:
+            if len(messages) == 1:
+                await self.sio.emit('video_frame', messages[0], namespace='/video')
+            else:
+                await self.sio.emit('video_frames', wire.pack_batch(messages), namespace='/video')
+        except socketio.exceptions.SocketIOError as e:
+            logging.warning(f"{len(messages)} frame(s) to {self.url} not sent: {e}")
+
+    async def on_connect(self):
+        logging.info(f"Connected to /video namespace at {self.url}")
+        self.connected = True
+        for publisher in list(self.publishers.values()):
+            await publisher.register()
+
+    async def on_disconnect(self, *reason):
+        self.connected = False
+
+    async def on_key_exchange_response(self, data):
+        try:
+            response = pickle.loads(data)
+            self.publishers[response['stream_id']].on_key_exchange_response(response)
+        except Exception as e:
+            logging.error(f"Error during key exchange response handling: {e}")
+
+    async def on_rekey_request(self, data):
+        publisher = self.publishers.get(data['stream_id'])
+        if publisher is not None:
+            await publisher.on_rekey_request()
+
+    async def on_keyframe_request(self, data):
+        # The server lost track of our tiles (dropped frames, or a viewer just arrived)
+        publisher = self.publishers.get(data['stream_id'])
+        if publisher is not None:
+            publisher.codec.request_keyframe()
+
+    async def on_stream_redirect(self, data):
+        """A clustered server moves one stream to the worker that owns it, over a connection of its own."""
+        publisher = self.publishers.pop(data['stream_id'], None)
+        if publisher is None:
+            return
+        logging.info(f"Stream {publisher.stream_name} redirected to {data['url']}")
+        target = Connection(data['url'], self.tasks)
+        target.add(publisher)
+        self.tasks.add(asyncio.create_task(target.run()))
+        if not self.publishers:
+            await self.sio.disconnect()
+
+    async def on_stream_rejected(self, data):
+        """The server still holds the stream for another connection, usually our previous one; try again later."""
+        publisher = self.publishers.get(data['stream_id'])
+        if publisher is None:
+            return
+        logging.warning(f"Stream {publisher.stream_name} rejected: {data.get('error')}; "
+                        f"registering again in {REGISTER_RETRY_SECONDS:.0f}s")
+        self.tasks.add(asyncio.create_task(self.register_later(publisher)))
+
+    async def register_later(self, publisher):
+        await asyncio.sleep(REGISTER_RETRY_SECONDS)
+        if self.connected and self.publishers.get(publisher.stream_name) is publisher:
+            await publisher.register()
+
+    async def on_backpressure(self, data):
+        publisher = self.publishers.get(data['stream_id'])
+        if publisher is not None and data.get('congested'):
+            publisher.on_backpressure(data)
+
+    async def on_e2e_join(self, data):
+        publisher = self.publishers.get(data['stream_id'])
+        if publisher is not None and publisher.session is not None:
+            await publisher.on_e2e_join(data)
+
+    async def on_e2e_leave(self, data):
+        publisher = self.publishers.get(data['stream_id'])
+        if publisher is not None:
+            await publisher.on_e2e_leave(data)
+
 
 async def main():
-    try:
-        await sio.connect(SERVER_URL, namespaces=['/video'])
-        await sio.wait()
-    except Exception as e:
-        logging.error(f"Error during connection: {e}")
+    tasks = set()
+    connection = Connection(SERVER_URL, tasks)
+    if identity is not None:
+        print(f"End-to-end publisher key fingerprint: {fingerprint(export_point(identity))}")
+    for stream_name, source, codec_name in check_specs(stream_specs()):
+        connection.add(Publisher(stream_name, source, codec_name))
+    tasks.add(asyncio.create_task(connection.run()))
+    while tasks:
+        done, _ = await asyncio.wait(tasks)
+        tasks.difference_update(done)
 
 
 if __name__ == '__main__':
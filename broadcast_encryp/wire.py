@@ -0,0 +1,195 @@
+"""Binary wire format for encrypted video frames.
+
+Each ``video_frame`` message is a single Socket.IO binary attachment laid out
+as a fixed header, the UTF-8 stream id and then the raw ciphertext:
+
+    magic(2) version(1) flags(1) stream_id_len(2) epoch(2) sequence(8) tag(16)
+
+This replaces the pickled dict of base64 strings, which inflated every frame
+by a third and cost several full-frame copies per hop. The nonce is derived
+from the sequence number by the stream's session (``crypto_common.session``)
+and no longer travels with the frame. Version 1 frames, which carried a
+random nonce, are still accepted; their ``Frame.nonce`` is set, while it is
+None for later versions. Version 3 added the key epoch the frame was sealed
+under (see ``key_manager``); version 2 frames, which lack it, count as epoch 0.
+Version 4 has the same header, and with ``FLAG_TIMING`` set the stream id is
+followed by the publisher's stage timings (``Timing``) for the relay's
+metrics:
+
+    captured_at(8) sent_at(8) encode_us(4) encrypt_us(4)
+
+A ``video_frames`` message batches several frame messages (of any streams,
+binary or legacy) into one attachment, to save per-message overhead:
+
+    magic(2) version(1) count(2)  count x length(4)  then the messages back to back
+"""
+import base64
+import pickle
+import struct
+from collections import namedtuple
+
+MAGIC = b"VF"
+VERSION = 4
+HEADER = struct.Struct("!2sBBHHQ16s")  # Versions 3 and 4
+HEADER_V2 = struct.Struct("!2sBBHQ16s")
+HEADER_V1 = struct.Struct("!2sBBHQ12s16s")
+
+BATCH_MAGIC = b"VB"
+BATCH_VERSION = 1
+BATCH_HEADER = struct.Struct("!2sBH")
+BATCH_LENGTH = struct.Struct("!I")
+
+# Header flags
+FLAG_KEYFRAME = 0x01
+FLAG_TILES = 0x02  # Payload is a tile codec frame (crypto_common.codec), not a JPEG
+FLAG_TIMING = 0x04  # A Timing block follows the stream id (version 4)
+FLAG_E2E = 0x08  # Sealed under the viewers' group key (crypto_common.group_key); the relay only forwards it
+
+TIMING = struct.Struct("!ddII")
+
+Frame = namedtuple("Frame", ["stream_id", "sequence", "flags", "nonce", "tag", "payload", "epoch", "timing"],
+                   defaults=(0, None))
+
+# Publisher stage timings: wall-clock capture and send times (seconds), encode and encrypt durations (microseconds)
+Timing = namedtuple("Timing", ["captured_at", "sent_at", "encode_us", "encrypt_us"])
+
+
+class WireFormatError(ValueError):
+    """Raised when a frame message cannot be parsed."""
+
+
+class FrameWriter:
+    """Builds a stream's frame messages in one reusable buffer.
+
+    Encrypt straight into the view returned by ``payload()`` and then call
+    ``finish()``; the only per-frame copy left is the final bytes object
+    handed to Socket.IO. With ``timing`` set, every frame carries a Timing block.
+    """
+
+    def __init__(self, stream_id, timing=False):
+        self.stream_id = stream_id.encode("utf-8")
+        self.timing = timing
+        self._start = HEADER.size + len(self.stream_id) + (TIMING.size if timing else 0)
+        self._buffer = bytearray(self._start)
+        self._buffer[HEADER.size:HEADER.size + len(self.stream_id)] = self.stream_id
+
+    def payload(self, size):
+        """Writable view of the ciphertext area, sized for ``size`` bytes."""
+        needed = self._start + size
+        if len(self._buffer) < needed:
+            # Replace rather than resize: views from earlier frames may still be alive
+            grown = bytearray(needed + size // 4)
+            grown[:self._start] = self._buffer[:self._start]
+            self._buffer = grown
+        return memoryview(self._buffer)[self._start:needed]
+
+    def finish(self, sequence, tag, size, flags=FLAG_KEYFRAME, epoch=0, timing=None):
+        """Fill in the header (and the Timing block, if the writer has one) and return the finished message."""
+        if self.timing:
+            flags |= FLAG_TIMING
+            TIMING.pack_into(self._buffer, HEADER.size + len(self.stream_id), *timing)
+        HEADER.pack_into(self._buffer, 0, MAGIC, VERSION, flags, len(self.stream_id), epoch, sequence, tag)
+        return bytes(memoryview(self._buffer)[:self._start + size])
+
+
+def unpack_frame(data):
+    """Parse a binary frame message without copying the ciphertext."""
+    view = memoryview(data)
+    if len(view) < 3:
+        raise WireFormatError("Frame message shorter than header")
+    version = view[2]
+    if version in (VERSION, 3):
+        header = HEADER
+    elif version == 2:
+        header = HEADER_V2
+    elif version == 1:
+        header = HEADER_V1
+    else:
+        raise WireFormatError(f"Unsupported frame version {version}")
+    if len(view) < header.size:
+        raise WireFormatError("Frame message shorter than header")
+
+    epoch = 0
+    nonce = None
+    timing = None
+    if version >= 3:
+        magic, _, flags, id_len, epoch, sequence, tag = header.unpack_from(view)
+    elif version == 2:
+        magic, _, flags, id_len, sequence, tag = header.unpack_from(view)
+    else:
+        magic, _, flags, id_len, sequence, nonce, tag = header.unpack_from(view)
+    if magic != MAGIC:
+        raise WireFormatError("Bad frame magic")
+    start = header.size + id_len
+    stream_id = str(view[header.size:start], "utf-8")
+    if version >= 4 and flags & FLAG_TIMING:
+        if len(view) < start + TIMING.size:
+            raise WireFormatError("Frame message shorter than its timing block")
+        timing = Timing(*TIMING.unpack_from(view, start))
+        start += TIMING.size
+    return Frame(stream_id, sequence, flags, nonce, tag, view[start:], epoch, timing)
+
+
+def is_binary_frame(data):
+    return isinstance(data, (bytes, bytearray, memoryview)) and bytes(data[:2]) == MAGIC
+
+
+def unpack_legacy_frame(data):
+    """Parse the old pickled, base64-encoded frame dict."""
+    frame_data = pickle.loads(data)
+    return Frame(
+        frame_data["stream_id"],
+        frame_data.get("sequence", 0),
+        frame_data.get("flags", FLAG_KEYFRAME),
+        base64.b64decode(frame_data["nonce"]),
+        base64.b64decode(frame_data["tag"]),
+        memoryview(base64.b64decode(frame_data["frame"])),
+        frame_data.get("epoch", 0),
+        Timing(*frame_data["timing"]) if frame_data.get("timing") else None,
+    )
+
+
+def decode_message(data):
+    """Parse a ``video_frame`` message in either the binary or legacy format."""
+    if is_binary_frame(data):
+        return unpack_frame(data)
+    return unpack_legacy_frame(data)
+
+
+def pack_legacy_frame(stream_id, sequence, nonce, tag, ciphertext, epoch=0, flags=FLAG_KEYFRAME, timing=None):
+    return pickle.dumps({
+        "stream_id": stream_id,
+        "sequence": sequence,
+        "epoch": epoch,
+        "flags": flags,
+        "frame": base64.b64encode(ciphertext).decode("utf-8"),
+        "nonce": base64.b64encode(nonce).decode("utf-8"),
+        "tag": base64.b64encode(tag).decode("utf-8"),
+        "timing": tuple(timing) if timing is not None else None,
+    })
+
+
+def pack_batch(messages):
+    """Join frame messages into one ``video_frames`` message."""
+    lengths = struct.pack(f"!{len(messages)}I", *(len(message) for message in messages))
+    return b"".join((BATCH_HEADER.pack(BATCH_MAGIC, BATCH_VERSION, len(messages)), lengths, *messages))
+
+
+def unpack_batch(data):
+    """Split a ``video_frames`` message into views of its frame messages, without copying them."""
+    view = memoryview(data)
+    if len(view) < BATCH_HEADER.size:
+        raise WireFormatError("Batch message shorter than header")
+    magic, version, count = BATCH_HEADER.unpack_from(view)
+    if magic != BATCH_MAGIC or version != BATCH_VERSION:
+        raise WireFormatError("Not a frame batch")
+    offset = BATCH_HEADER.size + count * BATCH_LENGTH.size
+    if len(view) < offset:
+        raise WireFormatError("Batch message shorter than its length table")
+    messages = []
+    for (length,) in BATCH_LENGTH.iter_unpack(view[BATCH_HEADER.size:offset]):
+        if offset + length > len(view):
+            raise WireFormatError("Batch message truncated")
+        messages.append(view[offset:offset + length])
+        offset += length
+    return messages
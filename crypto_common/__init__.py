@@ -0,0 +1 @@
+"""Crypto, codec and capture helpers shared by the broadcast and video encryption demos."""
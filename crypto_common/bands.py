@@ -0,0 +1,87 @@
+"""Raw frames sealed as independently authenticated row bands.
+
+Sealed as one AEAD message, a raw frame (1280x720x3 is 2.7 MB) is encrypted
+on one core and is all-or-nothing: one bad byte rejects the whole picture.
+``BandCipher`` splits a frame into bands of whole rows and seals each band
+under its own nonce and tag. Bands are sealed and opened in parallel on a
+thread pool, which scales with cores because pycryptodome releases the GIL for
+large buffers. The receiver opens bands straight into a preallocated NumPy
+frame, and a band that fails verification keeps its previous picture while the
+others are shown.
+
+Band ``i`` of a frame sealed under nonce ``N`` uses ``N`` with ``i`` XORed
+into its first two bytes. Banded frames use their own key, derived from the
+frame key, so a band nonce never repeats a whole-frame nonce under the same
+key; counter nonces (``prefix || sequence``) keep band nonces of different
+frames apart as well.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from crypto_common.frame_crypto import FrameCipher, KEY_SIZE, byte_view
+from crypto_common.session import derive
+
+DEFAULT_BAND_ROWS = 90  # Eight bands of a 720-row frame
+MAX_BANDS = 1 << 16
+
+# Shared by every band cipher in the process; its threads only start once bands are sealed or opened
+_executor = ThreadPoolExecutor(thread_name_prefix="bands")
+
+
+def band_nonce(nonce, index):
+    return bytes([nonce[0] ^ (index >> 8), nonce[1] ^ (index & 0xFF)]) + bytes(nonce[2:])
+
+
+class BandCipher:
+    def __init__(self, key, shape, band_rows=DEFAULT_BAND_ROWS, cipher_class=FrameCipher):
+        self.shape = tuple(shape)
+        self.band_rows = band_rows
+        row_bytes = int(np.prod(self.shape[1:]))
+        height = self.shape[0]
+        self.bands = [(row * row_bytes, min(row + band_rows, height) * row_bytes)
+                      for row in range(0, height, band_rows)]
+        if len(self.bands) > MAX_BANDS:
+            raise ValueError(f"Too many bands: {len(self.bands)}")
+        self.size = height * row_bytes
+        self.cipher = cipher_class(derive(key, b"band key", "", KEY_SIZE))
+
+    def encrypt_into(self, frame, output, nonce):
+        """Seal every band of ``frame`` into ``output``. Returns the band tags in order."""
+        plaintext = byte_view(np.ascontiguousarray(frame))
+        if len(plaintext) != self.size:
+            raise ValueError(f"Expected a {self.shape} frame")
+        output = memoryview(output)
+        futures = [_executor.submit(self.cipher.encrypt_into, plaintext[start:end], output[start:end],
+                                    band_nonce(nonce, index))
+                   for index, (start, end) in enumerate(self.bands)]
+        return [future.result()[1] for future in futures]
+
+    def encrypt(self, frame, nonce):
+        """Seal ``frame`` into a new buffer. Returns ``(ciphertext, tags)``."""
+        output = bytearray(self.size)
+        return output, self.encrypt_into(frame, output, nonce)
+
+    def decrypt_into(self, nonce, ciphertext, tags, frame):
+        """Open every band into ``frame`` (a preallocated array of ``shape``).
+
+        Returns the indices of the bands that did not verify; those rows of
+        ``frame`` are left as they were. Raises ValueError if the message does
+        not have this cipher's layout.
+        """
+        ciphertext = byte_view(ciphertext)
+        if len(ciphertext) != self.size or len(tags) != len(self.bands):
+            raise ValueError("Banded frame does not match the expected frame size")
+        output = byte_view(frame)
+        # Decrypt into scratch and copy only verified bands, so a forged band cannot overwrite the picture
+        futures = [_executor.submit(self._open_band, nonce, index, ciphertext[start:end], tags[index],
+                                    output[start:end])
+                   for index, (start, end) in enumerate(self.bands)]
+        return [index for index, future in enumerate(futures) if not future.result()]
+
+    def _open_band(self, nonce, index, ciphertext, tag, output):
+        try:
+            output[:] = self.cipher.decrypt(band_nonce(nonce, index), ciphertext, tag)
+        except ValueError:
+            return False
+        return True
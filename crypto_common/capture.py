@@ -0,0 +1,68 @@
+"""One camera shared by every client of a video encryption server.
+
+``SharedCapture`` opens the source when the first client subscribes and
+releases it when the last one leaves. A reader thread does the blocking read
+and resize once per frame and hands the frame to every subscriber's queue.
+Each queue only holds the latest frame, so a client that falls behind skips
+frames instead of holding up the others. Frames are shared between
+subscribers and must not be modified.
+"""
+import asyncio
+import logging
+import threading
+
+import cv2
+
+
+class SharedCapture:
+    def __init__(self, source, size):
+        self.source = source
+        self.size = size  # (width, height)
+        self._subscribers = set()
+        self._thread = None
+        self._loop = None
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        """A queue of ``(height, width, 3)`` frames, ending with None when the source fails."""
+        queue = asyncio.Queue(maxsize=1)
+        with self._lock:
+            self._loop = asyncio.get_running_loop()
+            self._subscribers.add(queue)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="shared-capture", daemon=True)
+                self._thread.start()
+        return queue
+
+    def unsubscribe(self, queue):
+        with self._lock:
+            self._subscribers.discard(queue)
+
+    def _run(self):
+        cap = cv2.VideoCapture(self.source)
+        if not cap.isOpened():
+            logging.error("Camera not accessible")
+        try:
+            while cap.isOpened():
+                ret, frame = cap.read()
+                if not ret:
+                    logging.error("Error reading from camera")
+                    break
+                frame = cv2.resize(frame, self.size)
+                with self._lock:
+                    if not self._subscribers:
+                        cap.release()  # Before a new subscriber can open the camera again
+                        self._thread = None
+                        return
+                    self._loop.call_soon_threadsafe(self._publish, frame)
+        finally:
+            cap.release()
+        with self._lock:
+            self._thread = None
+            self._loop.call_soon_threadsafe(self._publish, None)
+
+    def _publish(self, frame):
+        for queue in list(self._subscribers):
+            if queue.full():
+                queue.get_nowait()  # Replace the frame this client has not got to yet
+            queue.put_nowait(frame)
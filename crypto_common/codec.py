@@ -0,0 +1,239 @@
+"""Frame codecs shared by the broadcast and video encryption demos.
+
+Every codec turns a BGR frame into bytes to encrypt and back:
+
+    data, keyframe = codec.encode(frame)
+    frame = codec.decode(data)  # None if the frame cannot be shown yet
+
+``jpeg`` and ``raw`` code every frame on its own. ``tiles`` and ``tiles-raw``
+are delta codecs for mostly static scenes: a keyframe carries the whole
+picture, and every other frame only the tiles that changed since they were
+last sent, packed into one strip (JPEG or raw). A decoder that misses a frame
+returns None until the next keyframe; ``request_keyframe()`` asks the
+encoder for one early.
+
+Tile payload layout (big-endian):
+
+    magic(2) version(1) kind(1) format(1) width(2) height(2) tile(2) index(4) count(2)
+    tile numbers (count x 2 bytes, row-major)  then the keyframe or tile strip
+"""
+import struct
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+TILE_MAGIC = b"TC"
+TILE_VERSION = 1
+TILE_HEADER = struct.Struct("!2sBBBHHHIH")
+
+KIND_KEY = 0
+KIND_DELTA = 1
+FORMAT_RAW = 0
+FORMAT_JPEG = 1
+
+DEFAULT_TILE = 40  # Divides 1280x720, 1080x720 and 640x360
+DEFAULT_KEYFRAME_INTERVAL = 60
+DEFAULT_THRESHOLD = 12  # Per-channel difference that counts as a changed pixel
+DEFAULT_MIN_CHANGED = 0.005  # Fraction of a tile's pixels that must change to resend it
+
+CODECS = ["jpeg", "raw", "tiles", "tiles-raw"]
+
+TilePatch = namedtuple("TilePatch", ["kind", "width", "height", "tile", "index", "tiles", "pixels"])
+
+
+class JpegCodec:
+    name = "jpeg"
+    delta = False
+
+    def __init__(self, quality=95):
+        self.quality = quality
+
+    def encode(self, frame):
+        ret, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, int(self.quality)])
+        if not ret:
+            raise ValueError("JPEG encoding failed")
+        return buffer, True
+
+    def decode(self, data):
+        return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+    def request_keyframe(self):
+        pass  # Every frame is one
+
+
+class RawCodec:
+    name = "raw"
+    delta = False
+
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self.quality = None
+
+    def encode(self, frame):
+        return np.ascontiguousarray(frame), True
+
+    def decode(self, data):
+        return np.frombuffer(data, dtype=np.uint8).reshape(self.shape)
+
+    def request_keyframe(self):
+        pass
+
+
+def _tile_view(canvas, tile):
+    """``canvas`` as a (rows, cols, tile, tile, 3) view, so tiles can be gathered and scattered by index."""
+    rows, cols = canvas.shape[0] // tile, canvas.shape[1] // tile
+    return canvas.reshape(rows, tile, cols, tile, 3).transpose(0, 2, 1, 3, 4)
+
+
+class TileCodec:
+    """Keyframes plus changed tiles. One instance encodes or decodes one stream."""
+
+    delta = True
+
+    def __init__(self, quality=80, tile_format=FORMAT_JPEG, tile=DEFAULT_TILE,
+                 keyframe_interval=DEFAULT_KEYFRAME_INTERVAL, threshold=DEFAULT_THRESHOLD,
+                 min_changed=DEFAULT_MIN_CHANGED):
+        self.name = "tiles" if tile_format == FORMAT_JPEG else "tiles-raw"
+        self.quality = quality
+        self.tile_format = tile_format
+        self.tile = tile
+        self.keyframe_interval = keyframe_interval
+        self.threshold = threshold
+        self.min_pixels = max(1, int(tile * tile * min_changed))
+
+        # Encoder state: what the decoder has (padded to whole tiles), and scratch space
+        self._size = None
+        self._reference = None
+        self._current = None
+        self._diff = None
+        self._index = 0
+        self._since_keyframe = 0
+        self._force_keyframe = True
+
+        # Decoder state
+        self._canvas = None
+        self._last_index = None
+
+    def request_keyframe(self):
+        self._force_keyframe = True
+
+    # Encoder
+
+    def _allocate(self, width, height):
+        rows, cols = -(-height // self.tile), -(-width // self.tile)
+        shape = (rows * self.tile, cols * self.tile, 3)
+        self._size = (width, height)
+        self._reference = np.zeros(shape, dtype=np.uint8)
+        self._current = np.zeros(shape, dtype=np.uint8)
+        self._diff = np.empty(shape, dtype=np.uint8)
+        self._peak = np.empty(shape[:2], dtype=np.uint8)
+
+    def _pack(self, pixels):
+        if self.tile_format == FORMAT_JPEG:
+            ret, buffer = cv2.imencode('.jpg', pixels, [cv2.IMWRITE_JPEG_QUALITY, int(self.quality)])
+            if not ret:
+                raise ValueError("JPEG encoding failed")
+            return buffer
+        return np.ascontiguousarray(pixels)
+
+    def encode(self, frame):
+        height, width = frame.shape[:2]
+        if self._size != (width, height):
+            self._allocate(width, height)
+            self._force_keyframe = True
+        self._current[:height, :width] = frame
+        self._index = (self._index + 1) & 0xFFFFFFFF
+
+        keyframe = self._force_keyframe or self._since_keyframe >= self.keyframe_interval
+        if keyframe:
+            self._reference[...] = self._current
+            self._force_keyframe = False
+            self._since_keyframe = 0
+            tiles = np.empty(0, dtype=">u2")
+            body = self._pack(frame)
+        else:
+            self._since_keyframe += 1
+            # Count changed pixels per tile without a Python loop over the picture
+            cv2.absdiff(self._current, self._reference, dst=self._diff)
+            # Largest channel difference per pixel; max(axis=2) over a 3-wide axis is an order of magnitude slower
+            np.maximum(self._diff[..., 0], self._diff[..., 1], out=self._peak)
+            np.maximum(self._peak, self._diff[..., 2], out=self._peak)
+            changed = self._peak > self.threshold
+            rows, cols = changed.shape[0] // self.tile, changed.shape[1] // self.tile
+            counts = changed.reshape(rows, self.tile, cols, self.tile).sum(axis=(1, 3))
+            tiles = np.flatnonzero(counts >= self.min_pixels).astype(">u2")
+            row_index, col_index = np.divmod(tiles.astype(np.intp), cols)
+
+            current = _tile_view(self._current, self.tile)
+            _tile_view(self._reference, self.tile)[row_index, col_index] = current[row_index, col_index]
+            # Changed tiles stacked into one tall strip, coded in one go
+            strip = current[row_index, col_index].reshape(len(tiles) * self.tile, self.tile, 3)
+            body = self._pack(strip) if len(tiles) else b""
+
+        header = TILE_HEADER.pack(TILE_MAGIC, TILE_VERSION, KIND_KEY if keyframe else KIND_DELTA,
+                                  self.tile_format, width, height, self.tile, self._index, len(tiles))
+        return b"".join((header, tiles.tobytes(), memoryview(body).cast("B"))), keyframe
+
+    # Decoder
+
+    def parse(self, data):
+        """Decode a payload into a TilePatch. Holds no state, so it can run on any worker."""
+        view = memoryview(data)
+        magic, version, kind, tile_format, width, height, tile, index, count = TILE_HEADER.unpack_from(view)
+        if magic != TILE_MAGIC or version != TILE_VERSION:
+            raise ValueError("Not a tile codec payload")
+        start = TILE_HEADER.size
+        tiles = np.frombuffer(view, dtype=">u2", count=count, offset=start).astype(np.intp)
+        body = view[start + 2 * count:]
+        if kind == KIND_KEY:
+            shape = (height, width, 3)
+        else:
+            shape = (count * tile, tile, 3)
+        if not count and kind == KIND_DELTA:
+            pixels = None
+        elif tile_format == FORMAT_JPEG:
+            pixels = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if pixels is None or pixels.shape != shape:
+                raise ValueError("Corrupt tile strip")
+        else:
+            pixels = np.frombuffer(body, dtype=np.uint8).reshape(shape)
+        return TilePatch(kind, width, height, tile, index, tiles, pixels)
+
+    def apply(self, patch):
+        """Paint a patch onto the picture. Returns a view of it, or None until a keyframe arrives."""
+        if patch.kind == KIND_KEY:
+            rows, cols = -(-patch.height // patch.tile), -(-patch.width // patch.tile)
+            shape = (rows * patch.tile, cols * patch.tile, 3)
+            if self._canvas is None or self._canvas.shape != shape or self.tile != patch.tile:
+                self._canvas = np.zeros(shape, dtype=np.uint8)
+                self.tile = patch.tile
+            self._canvas[:patch.height, :patch.width] = patch.pixels
+        else:
+            expected = None if self._last_index is None else (self._last_index + 1) & 0xFFFFFFFF
+            if self._canvas is None or patch.index != expected:
+                self._last_index = None
+                return None  # Missed a frame: the picture is wrong until the next keyframe
+            if len(patch.tiles):
+                cols = self._canvas.shape[1] // patch.tile
+                row_index, col_index = np.divmod(patch.tiles, cols)
+                tiles = patch.pixels.reshape(len(patch.tiles), patch.tile, patch.tile, 3)
+                _tile_view(self._canvas, patch.tile)[row_index, col_index] = tiles
+        self._last_index = patch.index
+        return self._canvas[:patch.height, :patch.width]
+
+    def decode(self, data):
+        return self.apply(self.parse(data))
+
+
+def make_codec(name, quality=80, shape=None, **options):
+    """Create a codec by name. ``raw`` needs the frame ``shape`` to decode."""
+    if name == "jpeg":
+        return JpegCodec(quality)
+    if name == "raw":
+        return RawCodec(shape)
+    if name == "tiles":
+        return TileCodec(quality, FORMAT_JPEG, **options)
+    if name == "tiles-raw":
+        return TileCodec(quality, FORMAT_RAW, **options)
+    raise ValueError(f"Unknown codec: {name}")
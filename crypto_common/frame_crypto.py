@@ -0,0 +1,80 @@
+"""Allocation-free ChaCha20-Poly1305 encryption of video frames.
+
+``FrameCipher`` encrypts and decrypts straight into caller-supplied or
+reusable scratch buffers using pycryptodome's ``output=`` support, so a stream
+does not allocate and free a multi-megabyte bytes object per frame. Scratch
+buffers are per thread, which keeps one cipher safe to share between the
+workers decrypting a stream's frames in parallel.
+
+Views returned by ``encrypt`` and ``decrypt`` point into the scratch buffer
+and are only valid until the same thread's next call.
+
+``AesGcmFrameCipher`` is the same with AES-256-GCM, for receivers that only
+have WebCrypto (browsers in end-to-end mode).
+"""
+import os
+import threading
+
+from Crypto.Cipher import AES, ChaCha20_Poly1305
+
+KEY_SIZE = 32
+NONCE_SIZE = 12
+
+
+def byte_view(data):
+    """Flat, unsigned-byte memoryview over bytes, bytearrays or NumPy arrays without copying."""
+    view = memoryview(data)
+    if view.ndim == 1 and view.format == "B":
+        return view
+    return view.cast("B")
+
+
+class FrameCipher:
+    def __init__(self, key):
+        self.key = bytes(key[:KEY_SIZE])
+        self._local = threading.local()
+
+    def _scratch(self, size):
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None or len(buffer) < size:
+            # Grow with some headroom so JPEG size jitter does not reallocate every frame
+            buffer = self._local.buffer = bytearray(size + size // 4)
+        return memoryview(buffer)[:size]
+
+    def encrypt_into(self, plaintext, output, nonce=None):
+        """Encrypt into ``output`` (same length as ``plaintext``). Returns ``(nonce, tag)``."""
+        cipher = ChaCha20_Poly1305.new(key=self.key, nonce=nonce)
+        cipher.encrypt(byte_view(plaintext), output=output)
+        return cipher.nonce, cipher.digest()
+
+    def encrypt(self, plaintext, nonce=None):
+        """Encrypt into scratch space. Returns ``(nonce, ciphertext_view, tag)``."""
+        plaintext = byte_view(plaintext)
+        output = self._scratch(len(plaintext))
+        nonce, tag = self.encrypt_into(plaintext, output, nonce)
+        return nonce, output, tag
+
+    def decrypt_into(self, nonce, ciphertext, tag, output):
+        """Decrypt and verify into ``output``. Raises ValueError if the tag does not match."""
+        cipher = ChaCha20_Poly1305.new(key=self.key, nonce=nonce)
+        cipher.decrypt(byte_view(ciphertext), output=output)
+        cipher.verify(tag)
+        return output
+
+    def decrypt(self, nonce, ciphertext, tag):
+        """Decrypt and verify into scratch space. Returns a view of the plaintext."""
+        ciphertext = byte_view(ciphertext)
+        return self.decrypt_into(nonce, ciphertext, tag, self._scratch(len(ciphertext)))
+
+
+class AesGcmFrameCipher(FrameCipher):
+    def encrypt_into(self, plaintext, output, nonce=None):
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce if nonce is not None else os.urandom(NONCE_SIZE))
+        cipher.encrypt(byte_view(plaintext), output=output)
+        return cipher.nonce, cipher.digest()
+
+    def decrypt_into(self, nonce, ciphertext, tag, output):
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce)
+        cipher.decrypt(byte_view(ciphertext), output=output)
+        cipher.verify(tag)
+        return output
@@ -0,0 +1,86 @@
+"""Group content keys for end-to-end encrypted streams.
+
+In end-to-end mode a publisher seals its frames under a group secret that the
+relay never sees. Each viewer joins with an ephemeral P-256 public key (the
+only KEM a browser's WebCrypto offers); the publisher answers with the group
+secret wrapped for that viewer under its own long-lived P-256 key:
+
+    ECDH(publisher, viewer) -> HKDF "e2e wrap" -> AES-256-GCM(secret)
+
+The wrapped secret is bound to the stream and epoch as associated data. Frame
+keys and nonce prefixes are then derived from the group secret exactly as
+from a KEM secret (``session.derive``), so a ``StreamSession`` with
+``AesGcmFrameCipher`` seals frames a browser can open.
+
+The relay passes join requests and wrapped keys along, so it could swap in its
+own keys; viewers that need to rule that out compare the publisher key
+fingerprint shown by the page with the one the publisher logs.
+"""
+import os
+
+from Crypto.Cipher import AES
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import ECC
+
+from crypto_common.frame_crypto import KEY_SIZE, NONCE_SIZE
+from crypto_common.session import derive
+
+GROUP_SECRET_SIZE = 32
+CURVE = "P-256"
+POINT_SIZE = 65  # Uncompressed SEC1 point, as WebCrypto exports raw ECDH keys
+
+
+def new_group_secret():
+    return os.urandom(GROUP_SECRET_SIZE)
+
+
+def new_identity():
+    """A publisher's P-256 key for wrapping group secrets."""
+    return ECC.generate(curve=CURVE)
+
+
+def export_point(key):
+    point = key.pointQ
+    return b"\x04" + int(point.x).to_bytes(32, "big") + int(point.y).to_bytes(32, "big")
+
+
+def import_point(data):
+    """A P-256 public key from an uncompressed point. Raises ValueError if it is not one."""
+    data = bytes(data)
+    if len(data) != POINT_SIZE or data[0] != 4:
+        raise ValueError("Expected an uncompressed P-256 point")
+    return ECC.construct(curve=CURVE, point_x=int.from_bytes(data[1:33], "big"),
+                         point_y=int.from_bytes(data[33:], "big"))
+
+
+def fingerprint(public_key):
+    """Short, human-comparable digest of a raw public key."""
+    digest = SHA256.new(bytes(public_key)).hexdigest()[:16]
+    return ":".join(digest[i:i + 4] for i in range(0, len(digest), 4))
+
+
+def _wrap_key(private_key, public_key, stream_id):
+    shared = (public_key.pointQ * private_key.d).x
+    return derive(int(shared).to_bytes(32, "big"), b"e2e wrap", stream_id, KEY_SIZE)
+
+
+def _associated_data(stream_id, epoch):
+    return f"{stream_id}|{epoch}".encode("utf-8")
+
+
+def wrap_secret(identity, viewer_public_key, secret, stream_id, epoch):
+    """The group secret wrapped for one viewer: ``{"public_key", "nonce", "wrapped"}`` (ciphertext then tag)."""
+    nonce = os.urandom(NONCE_SIZE)
+    cipher = AES.new(_wrap_key(identity, import_point(viewer_public_key), stream_id), AES.MODE_GCM, nonce=nonce)
+    cipher.update(_associated_data(stream_id, epoch))
+    wrapped, tag = cipher.encrypt_and_digest(secret)
+    return {"public_key": export_point(identity), "nonce": nonce, "wrapped": wrapped + tag}
+
+
+def unwrap_secret(private_key, message, stream_id, epoch):
+    """Open ``wrap_secret``'s message with the viewer's private key. Raises ValueError if it does not verify."""
+    wrapped = bytes(message["wrapped"])
+    cipher = AES.new(_wrap_key(private_key, import_point(message["public_key"]), stream_id), AES.MODE_GCM,
+                     nonce=bytes(message["nonce"]))
+    cipher.update(_associated_data(stream_id, epoch))
+    return cipher.decrypt_and_verify(wrapped[:-16], wrapped[-16:])
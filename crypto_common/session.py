@@ -0,0 +1,126 @@
+"""Per-stream AEAD sessions with counter nonces and replay protection.
+
+A ``StreamSession`` derives the frame key and a 32-bit nonce prefix once from
+the KEM shared secret. Frame ``n`` is sealed under the 96-bit nonce
+``prefix || n``, so only the sequence number travels with a frame and the
+receiver gets in-order sequence numbers for free. The receiver rejects
+sequence numbers that it has already accepted or that fall behind a sliding
+window.
+
+Every key exchange, rekey or resumption produces a new secret and so a new
+key epoch; sequence numbers carry on across epochs, and a fresh secret means
+restarting the counter never reuses a nonce under the same key.
+"""
+import hmac
+import threading
+
+from Crypto.Hash import SHA256
+from Crypto.Protocol.KDF import HKDF
+
+from crypto_common.frame_crypto import FrameCipher, KEY_SIZE
+
+NONCE_PREFIX_SIZE = 4
+REPLAY_WINDOW = 64
+
+
+def derive(shared_secret, label, stream_id, length, salt=b""):
+    context = label + b"|" + stream_id.encode("utf-8")
+    return HKDF(shared_secret, length, salt, SHA256, context=context)
+
+
+def resume_proof(shared_secret, ticket, client_salt):
+    """Proof that a reconnecting client still holds the secret behind ``ticket``."""
+    return hmac.new(shared_secret, b"resume|" + ticket + client_salt, "sha256").digest()
+
+
+def resumed_secret(shared_secret, stream_id, client_salt, server_salt):
+    """Secret for the epoch that a session resumption starts, without a new KEM."""
+    return derive(shared_secret, b"resume", stream_id, len(shared_secret), salt=client_salt + server_salt)
+
+
+class ReplayWindow:
+    """Sliding-window replay check over frame sequence numbers (as in IPsec/DTLS)."""
+
+    def __init__(self, size=REPLAY_WINDOW):
+        self.size = size
+        self.highest = -1
+        self._seen = 0  # Bit i set: sequence ``highest - i`` was accepted
+        self._lock = threading.Lock()
+
+    def check(self, sequence):
+        """Whether ``sequence`` could still be accepted."""
+        with self._lock:
+            return self._fresh(sequence)
+
+    def mark(self, sequence):
+        """Record ``sequence`` as accepted. Returns False if it is a replay or too old."""
+        with self._lock:
+            if not self._fresh(sequence):
+                return False
+            if sequence > self.highest:
+                shift = sequence - self.highest
+                self._seen = ((self._seen << shift) | 1) & ((1 << self.size) - 1)
+                self.highest = sequence
+            else:
+                self._seen |= 1 << (self.highest - sequence)
+            return True
+
+    def _fresh(self, sequence):
+        if sequence > self.highest:
+            return True
+        offset = self.highest - sequence
+        if offset >= self.size:
+            return False
+        return not (self._seen >> offset) & 1
+
+
+class StreamSession:
+    def __init__(self, shared_secret, stream_id, window=REPLAY_WINDOW, epoch=0, first_sequence=0,
+                 cipher_class=FrameCipher):
+        self.stream_id = stream_id
+        self.epoch = epoch
+        self.key = derive(shared_secret, b"frame key", stream_id, KEY_SIZE)
+        self.nonce_prefix = derive(shared_secret, b"nonce prefix", stream_id, NONCE_PREFIX_SIZE)
+        self.cipher = cipher_class(self.key)
+        self.replay = ReplayWindow(window)
+        self._next_sequence = first_sequence
+        self._lock = threading.Lock()
+
+    def nonce(self, sequence):
+        return self.nonce_prefix + sequence.to_bytes(12 - NONCE_PREFIX_SIZE, "big")
+
+    @property
+    def sequence(self):
+        """The sequence number the next frame will get."""
+        return self._next_sequence
+
+    def next_sequence(self):
+        with self._lock:
+            sequence = self._next_sequence
+            self._next_sequence += 1
+            return sequence
+
+    # Sender side
+
+    def encrypt_into(self, plaintext, output):
+        """Seal the next frame into ``output``. Returns ``(sequence, tag)``."""
+        sequence = self.next_sequence()
+        _, tag = self.cipher.encrypt_into(plaintext, output, self.nonce(sequence))
+        return sequence, tag
+
+    def encrypt(self, plaintext):
+        """Seal the next frame into scratch space. Returns ``(sequence, ciphertext_view, tag)``."""
+        sequence = self.next_sequence()
+        _, ciphertext, tag = self.cipher.encrypt(plaintext, self.nonce(sequence))
+        return sequence, ciphertext, tag
+
+    # Receiver side
+
+    def decrypt(self, sequence, ciphertext, tag):
+        """Open a frame, enforcing the replay window. Raises ValueError on replay or bad tag."""
+        if not self.replay.check(sequence):
+            raise ValueError(f"Replayed or stale frame {sequence}")
+        plaintext = self.cipher.decrypt(self.nonce(sequence), ciphertext, tag)
+        if not self.replay.mark(sequence):
+            raise ValueError(f"Replayed frame {sequence}")
+        return plaintext
@@ -0,0 +1,180 @@
+"""Cipher suites: which KEM agrees a stream's secret and which AEAD seals its frames.
+
+A suite is named ``<kem>+<aead>``, e.g. ``kyber+aes-gcm``. The receiving side
+of a key exchange offers the suites it supports, most preferred first; the
+side that encapsulates picks the first of its own preference that was
+offered (``negotiate``) and names it in its response. Requests without an
+offer get the stack's legacy suite, so old clients keep working.
+
+Both AEADs are pycryptodome ciphers with the same ``FrameCipher`` interface.
+Which is faster depends on the host: AES-GCM is usually several times faster
+where the CPU has AES instructions, ChaCha20-Poly1305 where it has not. With
+``--aead auto`` the AEADs are benchmarked once at startup
+(``aead_preference``) and the fastest is preferred.
+
+KEMs share quantcrypt's ``keygen() / encaps(public) / decaps(private,
+ciphertext)`` interface:
+
+- ``kyber``: ML-KEM via quantcrypt (only needed if a Kyber suite is used);
+- ``ecdh-p256``: ephemeral-static ECDH on P-256, the public key as ciphertext;
+- ``rsa-oaep``: a random secret sealed with RSA-OAEP (pycryptodome's default
+  hash, as the RSA stack has always used).
+"""
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+
+from Crypto.Cipher import PKCS1_OAEP
+from Crypto.PublicKey import ECC, RSA
+
+from crypto_common.frame_crypto import AesGcmFrameCipher, FrameCipher, KEY_SIZE
+from crypto_common.group_key import CURVE, export_point, import_point
+
+AEADS = {
+    "aes-gcm": AesGcmFrameCipher,
+    "chacha20-poly1305": FrameCipher,
+}
+DEFAULT_AEAD = "chacha20-poly1305"  # What the broadcast and Kyber stacks used before suites were negotiated
+AEAD_CHOICES = ["auto"] + list(AEADS)
+
+# Startup benchmark: a frame-sized buffer, sealed repeatedly for a short while per AEAD
+BENCHMARK_BYTES = 1024 * 1024
+BENCHMARK_SECONDS = 0.05
+
+RSA_BITS = 2048
+SECRET_SIZE = 32
+
+Suite = namedtuple("Suite", ["kem", "aead"])
+
+
+class EcdhP256:
+    def keygen(self):
+        key = ECC.generate(curve=CURVE)
+        return export_point(key), key.export_key(format="DER")
+
+    def encaps(self, public_key):
+        ephemeral = ECC.generate(curve=CURVE)
+        shared = (import_point(public_key).pointQ * ephemeral.d).x
+        return export_point(ephemeral), int(shared).to_bytes(SECRET_SIZE, "big")
+
+    def decaps(self, private_key, ciphertext):
+        shared = (import_point(ciphertext).pointQ * ECC.import_key(private_key).d).x
+        return int(shared).to_bytes(SECRET_SIZE, "big")
+
+
+class RsaOaep:
+    def keygen(self):
+        key = RSA.generate(RSA_BITS)
+        return key.publickey().export_key(format="DER"), key.export_key(format="DER")
+
+    def encaps(self, public_key):
+        secret = os.urandom(SECRET_SIZE)
+        return PKCS1_OAEP.new(RSA.import_key(public_key)).encrypt(secret), secret
+
+    def decaps(self, private_key, ciphertext):
+        return PKCS1_OAEP.new(RSA.import_key(private_key)).decrypt(ciphertext)
+
+
+def _kyber():
+    from quantcrypt.kem import Kyber  # Optional: only the Kyber suites need quantcrypt
+    return Kyber()
+
+
+KEMS = {
+    "kyber": _kyber,
+    "ecdh-p256": EcdhP256,
+    "rsa-oaep": RsaOaep,
+}
+
+_kems = {}
+_preference = None
+_lock = threading.Lock()
+
+
+def parse(name):
+    """The Suite named ``kem+aead``. Raises ValueError for unknown names."""
+    kem, _, aead = name.partition("+")
+    if kem not in KEMS or aead not in AEADS:
+        raise ValueError(f"Unknown cipher suite: {name}")
+    return Suite(kem, aead)
+
+
+def suite_name(suite):
+    return f"{suite.kem}+{suite.aead}"
+
+
+def kem(name):
+    """The (shared) KEM instance for ``name``."""
+    with _lock:
+        if name not in _kems:
+            _kems[name] = KEMS[name]()
+        return _kems[name]
+
+
+def cipher_class(aead):
+    return AEADS[aead]
+
+
+def benchmark_aeads(size=BENCHMARK_BYTES, seconds=BENCHMARK_SECONDS):
+    """``{aead: bytes sealed per second}`` on this host."""
+    plaintext = os.urandom(size)
+    output = bytearray(size)
+    nonce = bytes(12)
+    rates = {}
+    for name, cls in AEADS.items():
+        cipher = cls(bytes(KEY_SIZE))
+        cipher.encrypt_into(plaintext, output, nonce)  # Warm up
+        rounds = 0
+        started = time.perf_counter()
+        while True:
+            cipher.encrypt_into(plaintext, output, nonce)
+            rounds += 1
+            elapsed = time.perf_counter() - started
+            if elapsed >= seconds:
+                break
+        rates[name] = rounds * size / elapsed
+    return rates
+
+
+def aead_preference(choice="auto"):
+    """AEAD names, most preferred first: ``choice`` first, or with "auto" the fastest on this host.
+
+    The benchmark runs once per process.
+    """
+    global _preference
+    if choice != "auto":
+        return [choice] + [name for name in AEADS if name != choice]
+    with _lock:
+        if _preference is None:
+            rates = benchmark_aeads()
+            _preference = sorted(rates, key=rates.get, reverse=True)
+            logging.info("AEAD throughput on this host: " + ", ".join(
+                f"{name} {rates[name] / 1e6:.0f} MB/s" for name in _preference))
+        return list(_preference)
+
+
+def offer(kem_name, aead="auto"):
+    """Suite names to offer in a key exchange using ``kem_name``, most preferred first."""
+    return [suite_name(Suite(kem_name, name)) for name in aead_preference(aead)]
+
+
+def negotiate(offered, kems, aead="auto"):
+    """The Suite to use: our most preferred AEAD among the ``offered`` names whose KEM is in ``kems``.
+
+    Returns None if nothing offered is acceptable.
+    """
+    acceptable = []
+    for name in offered:
+        try:
+            suite = parse(name)
+        except ValueError:
+            continue
+        if suite.kem in kems:
+            acceptable.append(suite)
+    for name in aead_preference(aead):
+        for suite in acceptable:
+            if suite.aead == name:
+                return suite
+    return None
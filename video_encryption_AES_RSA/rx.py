@@ -2,14 +2,20 @@
 import base64
 import logging
 import pickle
-from Crypto.PublicKey import RSA
-from Crypto.Cipher import PKCS1_OAEP, AES
 import cv2
 import numpy as np
 import asyncio
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from crypto_common import suites
+from crypto_common.bands import BandCipher
+from crypto_common.codec import make_codec
 
 WIDTH = 1280
 HEIGHT = 720
+LEGACY_SUITE = "rsa-oaep+aes-gcm"  # What a server without cipher suites uses
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -17,33 +23,57 @@ logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %
 sio = socketio.AsyncClient()
 
 # Initialize RSA for key exchange
-rsa_key = RSA.generate(2048)
-private_key = rsa_key.export_key()
-public_key = rsa_key.publickey().export_key()
+rsa = suites.kem("rsa-oaep")
+public_key, private_key = rsa.keygen()
 shared_secret = None
+cipher = None  # The negotiated AEAD under the shared secret
+decoders = {}  # codec name -> decoder; delta codecs keep the current picture
+bands = None  # BandCipher for the server's band size, once it sends banded frames
+picture = None  # Preallocated frame that bands are opened into
 
 @sio.event
 async def connect():
     logging.info("Connected to server")
     # Send public key to the server
     await sio.emit('key_exchange', pickle.dumps({
-        'public_key': base64.b64encode(public_key).decode('utf-8')
+        'public_key': base64.b64encode(public_key).decode('utf-8'),
+        'suites': suites.offer("rsa-oaep"),  # Fastest AEAD on this host first
     }))
 
 @sio.on('key_exchange_response')
 async def handle_key_exchange_response(data):
-    global shared_secret
+    global shared_secret, cipher, bands
     try:
         response = pickle.loads(data)
         encrypted_secret = base64.b64decode(response['shared_secret'])
         # Decrypt shared secret using private key
-        cipher_rsa = PKCS1_OAEP.new(RSA.import_key(private_key))
-        shared_secret = cipher_rsa.decrypt(encrypted_secret)
-        logging.info("Shared secret successfully derived with server.")
+        shared_secret = rsa.decaps(private_key, encrypted_secret)
+        suite = suites.parse(response.get('suite', LEGACY_SUITE))
+        cipher = suites.cipher_class(suite.aead)(shared_secret)
+        bands = None
+        logging.info(f"Shared secret successfully derived with server ({suites.suite_name(suite)}).")
 
     except Exception as e:
         logging.error(f"Error during key exchange: {e}")
 
+def band_cipher(band_rows):
+    global bands, picture
+    if bands is None or bands.band_rows != band_rows:
+        bands = BandCipher(shared_secret, (HEIGHT, WIDTH, 3), band_rows, type(cipher))
+    if picture is None:
+        picture = np.zeros((HEIGHT, WIDTH, 3), dtype=np.uint8)
+    return bands
+
+# Opens a banded raw frame into the preallocated picture, bands in parallel
+def open_bands(nonce, encrypted_frame, frame_data):
+    tags = [base64.b64decode(tag) for tag in frame_data['tags']]
+    failed = band_cipher(frame_data['band_rows']).decrypt_into(nonce, encrypted_frame, tags, picture)
+    if len(failed) == len(tags):
+        raise ValueError("No band of the frame verified")
+    if failed:
+        logging.warning(f"Bands {failed} failed verification; showing their previous rows")
+    return picture
+
 @sio.on('video_frame')
 async def handle_video_frame(data):
     global shared_secret
@@ -55,19 +85,25 @@ async def handle_video_frame(data):
         frame_data = pickle.loads(data)
         encrypted_frame = base64.b64decode(frame_data['frame'])
         nonce = base64.b64decode(frame_data['nonce'])
-        tag = base64.b64decode(frame_data['tag'])
 
-        # Display encrypted video feed (simulated as noisy frame)
-        noisy_frame = np.frombuffer(encrypted_frame[:HEIGHT * WIDTH * 3], dtype=np.uint8).reshape((HEIGHT, WIDTH, 3))
+        # Display encrypted video feed (simulated as noisy frame; compressed frames are tiled to fill it)
+        noisy = np.resize(np.frombuffer(encrypted_frame, dtype=np.uint8), HEIGHT * WIDTH * 3)
+        noisy_frame = noisy.reshape((HEIGHT, WIDTH, 3))
         cv2.imshow("Encrypted Video Feed (Client)", noisy_frame)
 
-        # Decrypt using AES-GCM
-        cipher = AES.new(shared_secret, AES.MODE_GCM, nonce=nonce)
-        decrypted_frame = cipher.decrypt_and_verify(encrypted_frame, tag)
+        if 'tags' in frame_data:
+            frame = open_bands(nonce, encrypted_frame, frame_data)
+        else:
+            # Decrypt with the negotiated AEAD
+            decrypted_frame = cipher.decrypt(nonce, encrypted_frame, base64.b64decode(frame_data['tag']))
 
-        # Display decrypted video feed
-        frame = np.frombuffer(decrypted_frame, dtype=np.uint8).reshape((HEIGHT, WIDTH, 3))
-        cv2.imshow("Decrypted Video Feed (Client)", frame)
+            # Decode and display decrypted video feed
+            codec_name = frame_data.get('codec', 'raw')
+            if codec_name not in decoders:
+                decoders[codec_name] = make_codec(codec_name, shape=(HEIGHT, WIDTH, 3))
+            frame = decoders[codec_name].decode(decrypted_frame)
+        if frame is not None:  # None: a delta frame before the first keyframe
+            cv2.imshow("Decrypted Video Feed (Client)", frame)
 
         if cv2.waitKey(1) & 0xFF == ord('q'):
             await sio.disconnect()
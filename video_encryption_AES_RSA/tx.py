@@ -1,18 +1,39 @@
 ﻿import socketio
 import base64
 import logging
+import argparse
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import FastAPI
 from Crypto.PublicKey import RSA
-from Crypto.Cipher import PKCS1_OAEP, AES
 import pickle
 import uvicorn
-import cv2
 import numpy as np
-import hashlib
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from crypto_common import suites
+from crypto_common.bands import BandCipher
+from crypto_common.capture import SharedCapture
+from crypto_common.codec import CODECS, make_codec
+from crypto_common.frame_crypto import NONCE_SIZE
 
 HEIGHT = 720
 WIDTH = 1280
+LEGACY_SUITE = "rsa-oaep+aes-gcm"  # For clients that offer no cipher suites
+
+parser = argparse.ArgumentParser(description="Send encrypted camera frames")
+parser.add_argument('--codec', choices=CODECS, default='raw',
+                    help='raw: whole frames; tiles/tiles-raw: keyframes plus only the tiles that changed')
+parser.add_argument('--aead', choices=suites.AEAD_CHOICES, default='auto',
+                    help='Frame cipher to prefer; auto benchmarks them and prefers the fastest on this host')
+parser.add_argument('--band-rows', type=int, default=0,
+                    help='Seal raw frames as bands of this many rows, each with its own tag, in parallel '
+                         '(0: seal each frame whole)')
+args = parser.parse_args()
+if args.band_rows and args.codec != 'raw':
+    parser.error("--band-rows needs --codec raw")
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -25,60 +46,89 @@ app = socketio.ASGIApp(sio, app)
 rsa_key = RSA.generate(2048)
 private_key = rsa_key.export_key()
 public_key = rsa_key.publickey().export_key()
-shared_secret = None
+
+# One camera and one resize per frame however many clients watch; each client gets its own key
+camera = SharedCapture(0, (WIDTH, HEIGHT))
+executor = ThreadPoolExecutor()  # Encodes and encrypts off the event loop, clients in parallel
+clients = {}  # sid -> task sending that client's frames
 
 @sio.event
 async def connect(sid, environ):
     logging.info(f"Client connected: {sid}")
 
+@sio.event
+async def disconnect(sid):
+    task = clients.pop(sid, None)
+    if task:
+        task.cancel()
+    logging.info(f"Client disconnected: {sid}")
+
 @sio.on('key_exchange')
 async def handle_key_exchange(sid, data):
-    global shared_secret
     try:
         received_data = pickle.loads(data)
         client_public_key = base64.b64decode(received_data['public_key'])
-        client_key = RSA.import_key(client_public_key)
+        suite = suites.negotiate(received_data.get('suites', [LEGACY_SUITE]), suites.KEMS, args.aead)
+        if suite is None:
+            logging.error(f"No acceptable cipher suite offered: {received_data.get('suites')}")
+            return
 
-        # Generate shared secret
-        shared_secret = hashlib.sha256(b"Some predetermined secret").digest()
-        cipher_rsa = PKCS1_OAEP.new(client_key)
-        encrypted_secret = cipher_rsa.encrypt(shared_secret)
+        # A fresh random shared secret, sealed for the client
+        encrypted_secret, shared_secret = suites.kem(suite.kem).encaps(client_public_key)
 
         await sio.emit('key_exchange_response', pickle.dumps({
-            'shared_secret': base64.b64encode(encrypted_secret).decode('utf-8')
+            'shared_secret': base64.b64encode(encrypted_secret).decode('utf-8'),
+            'suite': suites.suite_name(suite),
         }), room=sid)
 
-        asyncio.create_task(capture_and_send_video(sid))
+        cipher = suites.cipher_class(suite.aead)(shared_secret)  # Random nonce per frame
+        bands = None
+        if args.band_rows:
+            bands = BandCipher(shared_secret, (HEIGHT, WIDTH, 3), args.band_rows, suites.cipher_class(suite.aead))
+        previous = clients.pop(sid, None)
+        if previous:
+            previous.cancel()  # The client exchanged keys again
+        clients[sid] = asyncio.create_task(send_video(sid, cipher, bands))
     except Exception as e:
         logging.error(f"Error during key exchange: {e}")
 
-async def capture_and_send_video(sid):
-    global shared_secret
-    cap = cv2.VideoCapture(0)
-    if not cap.isOpened():
-        logging.error("Camera not accessible")
-        return
-
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret:
-            logging.error("Error reading from camera")
-            break
-
-        frame = cv2.resize(frame, (WIDTH, HEIGHT))
-        cipher = AES.new(shared_secret, AES.MODE_GCM)
-        encrypted_frame, tag = cipher.encrypt_and_digest(frame.tobytes())
-        nonce = cipher.nonce
-
-        data = {
-            'frame': base64.b64encode(encrypted_frame).decode('utf-8'),
-            'nonce': base64.b64encode(nonce).decode('utf-8'),
-            'tag': base64.b64encode(tag).decode('utf-8'),
-        }
-        await sio.emit('video_frame', pickle.dumps(data), room=sid)
-        await asyncio.sleep(0.03)
-    cap.release()
-    cv2.destroyAllWindows()
+def seal_frame(codec, cipher, bands, frame):
+    """Encode and encrypt one frame for one client (runs in the executor)."""
+    encoded, _ = codec.encode(frame)
+    if bands:
+        # Row bands sealed in parallel, each under a nonce derived from the frame's random nonce
+        nonce = os.urandom(NONCE_SIZE)
+        encrypted_frame, tags = bands.encrypt(encoded, nonce)
+    else:
+        nonce, encrypted_frame, tag = cipher.encrypt(encoded)
+
+    data = {
+        'frame': base64.b64encode(encrypted_frame).decode('utf-8'),
+        'nonce': base64.b64encode(nonce).decode('utf-8'),
+        'codec': codec.name,
+    }
+    if bands:
+        data['tags'] = [base64.b64encode(tag).decode('utf-8') for tag in tags]
+        data['band_rows'] = bands.band_rows
+    else:
+        data['tag'] = base64.b64encode(tag).decode('utf-8')
+    return pickle.dumps(data)
+
+async def send_video(sid, cipher, bands):
+    loop = asyncio.get_running_loop()
+    codec = make_codec(args.codec, shape=(HEIGHT, WIDTH, 3))
+    frames = camera.subscribe()
+    try:
+        while True:
+            frame = await frames.get()  # Latest frame; ones this client was too slow for are skipped
+            if frame is None:
+                break
+            data = await loop.run_in_executor(executor, seal_frame, codec, cipher, bands, frame)
+            await sio.emit('video_frame', data, room=sid)
+    finally:
+        camera.unsubscribe(frames)
+        if clients.get(sid) is asyncio.current_task():
+            del clients[sid]
 
 if __name__ == '__main__':
     uvicorn.run(app, host="0.0.0.0", port=8765)
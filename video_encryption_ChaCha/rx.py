@@ -3,11 +3,22 @@ import socketio
 import base64
 import logging
 import pickle
-from quantcrypt.kem import Kyber
-from Crypto.Cipher import ChaCha20_Poly1305
 import cv2
 import numpy as np
 import asyncio
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from crypto_common import suites
+from crypto_common.bands import BandCipher
+from crypto_common.codec import make_codec
+from crypto_common.session import StreamSession
+
+STREAM_LABEL = "camera"  # Must match tx.py
+LEGACY_SUITE = "kyber+chacha20-poly1305"  # What a server without cipher suites uses
+HEIGHT = 720
+WIDTH = 1080
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -15,24 +26,29 @@ logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %
 sio = socketio.AsyncClient()
 
 # Initialize Kyber for key exchange
-kyber = Kyber()
+kyber = suites.kem("kyber")
 
 # Generate client key pair
 client_public_key, client_private_key = kyber.keygen()
 shared_secret = None
+session = None
+decoders = {}  # codec name -> decoder; delta codecs keep the current picture
+bands = None  # BandCipher for the server's band size, once it sends banded frames
+picture = None  # Preallocated frame that bands are opened into
 
 @sio.event
 async def connect():
     logging.info("Connected to server")
     # Send client public key to the server
     await sio.emit('key_exchange', pickle.dumps({
-        'public_key': base64.b64encode(client_public_key).decode('utf-8')
+        'public_key': base64.b64encode(client_public_key).decode('utf-8'),
+        'suites': suites.offer("kyber"),  # Fastest AEAD on this host first
     }))
 
 # Handle the encapsulated ciphertext from the server and decapsulate
 @sio.on('key_exchange_response')
 async def handle_key_exchange_response(data):
-    global shared_secret
+    global shared_secret, session, bands
     try:
         # Decode the ciphertext received from the server
         response = pickle.loads(data)
@@ -40,11 +56,36 @@ async def handle_key_exchange_response(data):
 
         # Decapsulate the ciphertext to derive the shared secret
         shared_secret = kyber.decaps(client_private_key, ciphertext)
-        logging.info("Shared secret successfully derived with server.")
+        suite = suites.parse(response.get('suite', LEGACY_SUITE))
+        session = StreamSession(shared_secret, STREAM_LABEL, cipher_class=suites.cipher_class(suite.aead))
+        bands = None
+        logging.info(f"Shared secret successfully derived with server ({suites.suite_name(suite)}).")
 
     except Exception as e:
         logging.error(f"Error during key exchange (decapsulation): {e}")
 
+def band_cipher(band_rows):
+    global bands, picture
+    if bands is None or bands.band_rows != band_rows:
+        bands = BandCipher(session.key, (HEIGHT, WIDTH, 3), band_rows, type(session.cipher))
+    if picture is None:
+        picture = np.zeros((HEIGHT, WIDTH, 3), dtype=np.uint8)
+    return bands
+
+# Opens a banded raw frame into the preallocated picture, bands in parallel
+def open_bands(sequence, encrypted_frame, frame_data):
+    if not session.replay.check(sequence):
+        raise ValueError(f"Replayed or stale frame {sequence}")
+    tags = [base64.b64decode(tag) for tag in frame_data['tags']]
+    failed = band_cipher(frame_data['band_rows']).decrypt_into(session.nonce(sequence), encrypted_frame, tags,
+                                                               picture)
+    if len(failed) == len(tags):
+        raise ValueError(f"No band of frame {sequence} verified")
+    if failed:
+        logging.warning(f"Frame {sequence}: bands {failed} failed verification; showing their previous rows")
+    session.replay.mark(sequence)
+    return picture
+
 # Handle incoming encrypted video frames, decrypt, and display
 @sio.on('video_frame')
 async def handle_video_frame(data):
@@ -57,16 +98,23 @@ async def handle_video_frame(data):
         # Decode and unpack data
         frame_data = pickle.loads(data)
         encrypted_frame = base64.b64decode(frame_data['frame'])
-        nonce = base64.b64decode(frame_data['nonce'])
-        tag = base64.b64decode(frame_data['tag'])
-
-        # Decrypt frame using shared secret
-        chacha20_key = shared_secret[:32]
-        cipher = ChaCha20_Poly1305.new(key=chacha20_key, nonce=nonce)
-        decrypted_frame = cipher.decrypt_and_verify(encrypted_frame, tag)
-
-        # Convert to NumPy array and reshape for display
-        frame = np.frombuffer(decrypted_frame, dtype=np.uint8).reshape((720, 1080, 3))
+        sequence = frame_data['sequence']
+
+        if 'tags' in frame_data:
+            frame = open_bands(sequence, encrypted_frame, frame_data)
+        else:
+            tag = base64.b64decode(frame_data['tag'])
+
+            # Decrypt with the session key and counter nonce, rejecting replays
+            decrypted_frame = session.decrypt(sequence, encrypted_frame, tag)
+
+            # Decode into a NumPy frame for display
+            codec_name = frame_data.get('codec', 'raw')
+            if codec_name not in decoders:
+                decoders[codec_name] = make_codec(codec_name, shape=(HEIGHT, WIDTH, 3))
+            frame = decoders[codec_name].decode(decrypted_frame)
+            if frame is None:
+                return  # A delta frame before the first keyframe
 
         # Display the decrypted frame
         cv2.imshow("Decrypted Video Feed (Client)", frame)
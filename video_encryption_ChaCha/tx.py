@@ -2,17 +2,40 @@
 import socketio
 import base64
 import logging
+import argparse
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import FastAPI
-from quantcrypt.kem import Kyber
-from Crypto.Cipher import ChaCha20_Poly1305
 import pickle
 import uvicorn
 import cv2
 import numpy as np
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from crypto_common import suites
+from crypto_common.bands import BandCipher
+from crypto_common.capture import SharedCapture
+from crypto_common.codec import CODECS, make_codec
+from crypto_common.session import StreamSession
 
 HEIGHT = 720
 WIDTH = 1080
+STREAM_LABEL = "camera"  # Binds the derived key and nonce prefix to this feed
+LEGACY_SUITE = "kyber+chacha20-poly1305"  # For clients that offer no cipher suites
+
+parser = argparse.ArgumentParser(description="Send encrypted camera frames")
+parser.add_argument('--codec', choices=CODECS, default='raw',
+                    help='raw: whole frames; tiles/tiles-raw: keyframes plus only the tiles that changed')
+parser.add_argument('--aead', choices=suites.AEAD_CHOICES, default='auto',
+                    help='Frame cipher to prefer; auto benchmarks them and prefers the fastest on this host')
+parser.add_argument('--band-rows', type=int, default=0,
+                    help='Seal raw frames as bands of this many rows, each with its own tag, in parallel '
+                         '(0: seal each frame whole)')
+args = parser.parse_args()
+if args.band_rows and args.codec != 'raw':
+    parser.error("--band-rows needs --codec raw")
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -21,83 +44,110 @@ app = FastAPI()
 sio = socketio.AsyncServer(async_mode='asgi', cors_allowed_origins='*')
 app = socketio.ASGIApp(sio, app)
 
-# Initialize Kyber for key exchange
-kyber = Kyber()
-shared_secret = None
+# One camera and one resize per frame however many clients watch; each client gets its own key
+camera = SharedCapture(0, (WIDTH, HEIGHT))
+executor = ThreadPoolExecutor()  # Encodes and encrypts off the event loop, clients in parallel
+clients = {}  # sid -> task sending that client's frames
 
 @sio.event
 async def connect(sid, environ):
     logging.info(f"Client connected: {sid}")
 
+@sio.event
+async def disconnect(sid):
+    task = clients.pop(sid, None)
+    if task:
+        task.cancel()
+    logging.info(f"Client disconnected: {sid}")
+
 # Handle key exchange from client
 @sio.on('key_exchange')
 async def handle_key_exchange(sid, data):
-    global shared_secret
     try:
-        # Receive client public key
+        # Receive client public key and the cipher suites it supports
         received_data = pickle.loads(data)
         client_public_key = base64.b64decode(received_data['public_key'])
+        suite = suites.negotiate(received_data.get('suites', [LEGACY_SUITE]), suites.KEMS, args.aead)
+        if suite is None:
+            logging.error(f"No acceptable cipher suite offered: {received_data.get('suites')}")
+            return
 
         # Encapsulate shared secret with client public key
-        ciphertext, shared_secret = kyber.encaps(client_public_key)
-        logging.info("Shared secret successfully established with client.")
+        ciphertext, shared_secret = suites.kem(suite.kem).encaps(client_public_key)
+        logging.info(f"Shared secret successfully established with client ({suites.suite_name(suite)}).")
 
         # Send ciphertext back to client
         await sio.emit('key_exchange_response', pickle.dumps({
-            'ciphertext': base64.b64encode(ciphertext).decode('utf-8')
+            'ciphertext': base64.b64encode(ciphertext).decode('utf-8'),
+            'suite': suites.suite_name(suite),
         }), room=sid)
 
-        # Start video capture and encryption task
-        asyncio.create_task(capture_and_send_video(sid))
+        # Key derived once per client; nonces come from its frame counter
+        session = StreamSession(shared_secret, STREAM_LABEL, cipher_class=suites.cipher_class(suite.aead))
+        bands = None
+        if args.band_rows:
+            bands = BandCipher(session.key, (HEIGHT, WIDTH, 3), args.band_rows, suites.cipher_class(suite.aead))
+        previous = clients.pop(sid, None)
+        if previous:
+            previous.cancel()  # The client exchanged keys again
+        clients[sid] = asyncio.create_task(send_video(sid, session, bands))
 
     except Exception as e:
         logging.error(f"Error during key exchange with client: {e}")
 
-# Capture, encrypt, and send video frames
-async def capture_and_send_video(sid):
-    global shared_secret
-    cap = cv2.VideoCapture(0)
-
-    if not cap.isOpened():
-        logging.error("Camera not accessible")
-        return
-
-    chacha20_key = shared_secret[:32]
-
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret:
-            logging.error("Error reading from camera")
-            break
-
-        # Resize frame
-        frame = cv2.resize(frame, (WIDTH, HEIGHT))
-
-        # Encrypt frame
-        cipher = ChaCha20_Poly1305.new(key=chacha20_key)
-        encrypted_frame, tag = cipher.encrypt_and_digest(frame.tobytes())
-        nonce = cipher.nonce
-
-        # Display the encrypted (noisy) frame locally for verification
-        noisy_frame = np.frombuffer(encrypted_frame[:WIDTH*HEIGHT*3], dtype=np.uint8).reshape((HEIGHT, WIDTH, 3))
-        cv2.imshow("Encrypted Video Feed (Server)", noisy_frame)
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            break
-
-        # Package data for transmission
-        data = {
-            'frame': base64.b64encode(encrypted_frame).decode('utf-8'),
-            'nonce': base64.b64encode(nonce).decode('utf-8'),
-            'tag': base64.b64encode(tag).decode('utf-8'),
-        }
-
-        # Send encrypted frame to client
-        await sio.emit('video_frame', pickle.dumps(data), room=sid)
-
-        await asyncio.sleep(0.03)  # Control frame rate
-
-    cap.release()
-    cv2.destroyAllWindows()
+def seal_frame(codec, session, bands, frame):
+    """Encode and encrypt one frame for one client (runs in the executor)."""
+    # Raw frames are passed through as the NumPy buffer
+    encoded, _ = codec.encode(frame)
+    if bands:
+        # Row bands sealed in parallel under nonces derived from the frame's counter nonce
+        sequence = session.next_sequence()
+        encrypted_frame, tags = bands.encrypt(encoded, session.nonce(sequence))
+    else:
+        sequence, encrypted_frame, tag = session.encrypt(encoded)
+
+    # The encrypted (noisy) frame to display locally for verification; compressed frames are tiled to fill it
+    noisy = np.resize(np.frombuffer(encrypted_frame, dtype=np.uint8), HEIGHT * WIDTH * 3)
+    noisy_frame = noisy.reshape((HEIGHT, WIDTH, 3))
+
+    # Package data for transmission
+    data = {
+        'frame': base64.b64encode(encrypted_frame).decode('utf-8'),
+        'sequence': sequence,
+        'codec': codec.name,
+    }
+    if bands:
+        data['tags'] = [base64.b64encode(tag).decode('utf-8') for tag in tags]
+        data['band_rows'] = bands.band_rows
+    else:
+        data['tag'] = base64.b64encode(tag).decode('utf-8')
+    return pickle.dumps(data), noisy_frame
+
+# Encrypt and send the shared camera's frames to one client
+async def send_video(sid, session, bands):
+    loop = asyncio.get_running_loop()
+    codec = make_codec(args.codec, shape=(HEIGHT, WIDTH, 3))
+    frames = camera.subscribe()
+    try:
+        while True:
+            frame = await frames.get()  # Latest frame; ones this client was too slow for are skipped
+            if frame is None:
+                break
+
+            data, noisy_frame = await loop.run_in_executor(executor, seal_frame, codec, session, bands, frame)
+
+            cv2.imshow("Encrypted Video Feed (Server)", noisy_frame)
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                break
+
+            # Send encrypted frame to client
+            await sio.emit('video_frame', data, room=sid)
+    finally:
+        camera.unsubscribe(frames)
+        if clients.get(sid) is asyncio.current_task():
+            del clients[sid]
+        if not clients:
+            cv2.destroyAllWindows()
 
 # Run the server
 if __name__ == '__main__':